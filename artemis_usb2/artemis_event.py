@@ -0,0 +1,166 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" artemis_event
+
+An event that wakes up its waiters as soon as it is set
+
+On Python 2 waiting on a threading.Event with a timeout polls, the waiter
+sleeps for up to 50 ms between two looks at the event. A response that takes
+3 ms is seen after 3.5 or 7.5 ms. Waiting on a plain lock doesn't poll, so a
+waiter blocks on a lock of its own: setting the event releases it and the
+timeouts are handled by an alarm thread that releases it when it runs out.
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import time
+import threading
+
+#Longest sleep of the alarm thread while there are threads waiting
+ALARM_POLL = 0.05
+
+
+class _Waiter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lock.acquire()
+
+    def wake(self):
+        try:
+            self.lock.release()
+        except threading.ThreadError:
+            #Already woken up
+            pass
+
+    def wait(self):
+        self.lock.acquire()
+
+
+class _Alarm(threading.Thread):
+    """
+    Wakes up the waiters whose timeout ran out. Only the alarm thread polls,
+    it looks at the waiters every ALARM_POLL seconds at most, which is fine
+    for a timeout
+    """
+
+    def __init__(self):
+        super(_Alarm, self).__init__(name = "Artemis alarm")
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        #Deadline of the threads that are waiting, by waiter
+        self.alarms = {}
+        #Released when there are waiters again
+        self.wakeup = _Waiter()
+
+    def add(self, deadline, waiter):
+        with self.lock:
+            self.alarms[waiter] = deadline
+        self.wakeup.wake()
+
+    def remove(self, waiter):
+        with self.lock:
+            self.alarms.pop(waiter, None)
+
+    def run(self, sleep = time.sleep, now = time.time):
+        #The module globals are gone while the interpreter shuts down, this
+        #daemon thread only uses locks and what it has a reference to
+        while True:
+            with self.lock:
+                idle = len(self.alarms) == 0
+            if idle:
+                self.wakeup.wait()
+                continue
+            with self.lock:
+                current = now()
+                expired = []
+                wait = ALARM_POLL
+                for waiter, deadline in self.alarms.items():
+                    if deadline <= current:
+                        expired.append(waiter)
+                        del self.alarms[waiter]
+                    else:
+                        wait = min(wait, deadline - current)
+            for waiter in expired:
+                waiter.wake()
+            sleep(wait)
+
+
+_alarm = None
+_alarm_lock = threading.Lock()
+
+
+def _get_alarm():
+    global _alarm
+    if _alarm is None:
+        with _alarm_lock:
+            if _alarm is None:
+                alarm = _Alarm()
+                alarm.start()
+                _alarm = alarm
+    return _alarm
+
+
+class ArtemisEvent(object):
+    """
+    ArtemisEvent
+
+    Same interface as threading.Event, 'wait' returns as soon as the event
+    is set even with a timeout
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flag = False
+        self.waiters = []
+
+    def is_set(self):
+        return self.flag
+
+    isSet = is_set
+
+    def set(self):
+        with self.lock:
+            self.flag = True
+            waiters = self.waiters
+            self.waiters = []
+        for waiter in waiters:
+            waiter.wake()
+
+    def clear(self):
+        with self.lock:
+            self.flag = False
+
+    def wait(self, timeout = None):
+        with self.lock:
+            if self.flag:
+                return True
+            waiter = _Waiter()
+            self.waiters.append(waiter)
+        if timeout is None:
+            waiter.wait()
+        else:
+            alarm = _get_alarm()
+            alarm.add(time.time() + timeout, waiter)
+            waiter.wait()
+            alarm.remove(waiter)
+        with self.lock:
+            if waiter in self.waiters:
+                #Woken up by the alarm
+                self.waiters.remove(waiter)
+            return self.flag
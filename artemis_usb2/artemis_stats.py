@@ -0,0 +1,194 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" artemis_stats
+
+Counters and latency histograms for the commands sent to an Artemis
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import math
+import threading
+
+#Each power of two of microseconds is split up into this many buckets, this
+#keeps the error of a latency to about 10%
+HISTOGRAM_SUB_BUCKETS = 8
+
+HISTOGRAM_PERCENTILES = (50, 90, 99, 99.9)
+
+#Phases of a command, in order
+PHASES = ("queue_wait", "usb_write", "first_byte", "payload")
+
+
+class LatencyHistogram(object):
+    """
+    LatencyHistogram
+
+    Log bucketed histogram of latencies, the memory used only depends on the
+    range of the latencies and not on the number of samples
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        us = seconds * 1000000.0
+        if us < 1.0:
+            index = 0
+        else:
+            index = int(math.log(us, 2) * HISTOGRAM_SUB_BUCKETS) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if (self.min is None) or (seconds < self.min):
+            self.min = seconds
+        if (self.max is None) or (seconds > self.max):
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket the percentile falls in, in
+        seconds
+        """
+        if self.count == 0:
+            return None
+        target = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                break
+        upper = 2.0 ** (float(index) / HISTOGRAM_SUB_BUCKETS) / 1000000.0
+        return min(upper, self.max)
+
+    def snapshot(self):
+        snapshot = {"count": self.count,
+                    "min": self.min,
+                    "max": self.max,
+                    "mean": None}
+        if self.count > 0:
+            snapshot["mean"] = self.total / self.count
+        for percent in HISTOGRAM_PERCENTILES:
+            snapshot["p%s" % str(percent).replace(".", "_")] = self.percentile(percent)
+        return snapshot
+
+
+class CommandStats(object):
+    """
+    CommandStats
+
+    Counters and a latency histogram per phase for one kind of command
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.phases = {}
+        for phase in PHASES:
+            self.phases[phase] = LatencyHistogram()
+
+    def snapshot(self):
+        snapshot = {"count": self.count,
+                    "errors": self.errors,
+                    "timeouts": self.timeouts,
+                    "bytes_out": self.bytes_out,
+                    "bytes_in": self.bytes_in}
+        for phase in PHASES:
+            snapshot[phase] = self.phases[phase].snapshot()
+        return snapshot
+
+
+class ArtemisStats(object):
+    """
+    ArtemisStats
+
+    Collects the statistics of the finished commands, keyed by the name of
+    the command. The worker and reader threads stamp the times of each phase
+    on the command:
+
+        queued:     handed to the worker thread
+        sent:       the worker thread starts to write the command, after
+                    there was room for it in the pipeline
+        written:    the USB write of the command is finished
+        first_byte: the start of the response was decoded
+        finished:   the response was complete
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def get(self, name):
+        #Call with the lock held
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = CommandStats()
+            self.commands[name] = stats
+        return stats
+
+    def record(self, command, response_bytes, ok, timeout = False):
+        """
+        Record a finished command, 'response_bytes' is the number of bytes
+        that were read back
+        """
+        times = (command.queued, command.sent, command.written,
+                 command.first_byte, command.finished)
+        with self.lock:
+            stats = self.get(command.name)
+            stats.count += 1
+            if not ok:
+                stats.errors += 1
+            if timeout:
+                stats.timeouts += 1
+            if (command.data is not None) and not isinstance(command.data, tuple):
+                stats.bytes_out += len(command.data)
+            if command.payload is not None:
+                stats.bytes_out += len(command.payload)
+            stats.bytes_in += response_bytes
+            if not ok:
+                return
+            for i in range(len(PHASES)):
+                if (times[i] is None) or (times[i + 1] is None):
+                    continue
+                stats.phases[PHASES[i]].record(times[i + 1] - times[i])
+
+    def record_interrupt(self, length):
+        with self.lock:
+            stats = self.get("interrupt")
+            stats.count += 1
+            stats.bytes_in += length
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for name in self.commands:
+                snapshot[name] = self.commands[name].snapshot()
+            return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
@@ -36,6 +36,7 @@ import sys
 import os
 import Queue
 import threading
+import collections
 import time
 import gc
 from array import array as Array
@@ -52,25 +53,30 @@ from nysa.common import status
 from nysa.host.nysa import NysaCommError
 
 from ftdi import Ftdi
-from array import array as Array
+from ftdi import FtdiError
+from ftdi import AdaptiveLatency
 
 from bitbang.bitbang import BitBangController
 import artemis_utils
+from artemis_stats import ArtemisStats
+from artemis_event import ArtemisEvent
 
 
 ARTEMIS_QUEUE_TIMEOUT = 7
 ARTEMIS_PING_TIMEOUT = 1
 ARTEMIS_WRITE_TIMEOUT = 5
 ARTEMIS_READ_TIMEOUT = 3
+ARTEMIS_DUMP_CORE_TIMEOUT = 5
 
 INTERRUPT_COUNT = 32
 
-MAX_WRITE_QUEUE_SIZE = 10
+MAX_WRITE_QUEUE_SIZE = 64
 MAX_READ_QUEUE_SIZE = 10
 
-#50 mS sleep between interrupt checks
-INTERRUPT_SLEEP = 0.050
-#INTERRUPT_SLEEP = 1
+#Response bytes that can be outstanding, this is the size of the FT2232H RX
+#FIFO, if the host asks for more than this the FPGA will stall on the output
+#and stop accepting new commands
+ARTEMIS_MAX_IN_FLIGHT_BYTES = 4096
 
 ARTEMIS_RESET = 1
 ARTEMIS_WRITE = 2
@@ -79,374 +85,786 @@ ARTEMIS_PING = 4
 ARTEMIS_DUMP_CORE = 5
 ARTEMIS_IS_PROGRAMMED = 6
 
+#Commands that can be pipelined, everything else waits for the pipeline to
+#drain before it is executed
+ARTEMIS_PIPELINED = (ARTEMIS_WRITE, ARTEMIS_READ, ARTEMIS_PING)
+
 ARTEMIS_RESP_OK = 0
 ARTEMIS_RESP_ERR = -1
 
+ARTEMIS_ID = 0xCD
+ARTEMIS_RESP_ID = 0xDC
+#Bytes that follow the response ID for a write, ping or interrupt
+ARTEMIS_RESP_LENGTH = 12
+#Bytes that follow the response ID before the data of a read
+ARTEMIS_READ_RESP_HEADER = 8
+ARTEMIS_RESP_ID_BYTE = chr(ARTEMIS_RESP_ID)
+
+#States of the response decoder
+ARTEMIS_DECODE_ID = 0
+ARTEMIS_DECODE_HEADER = 1
+ARTEMIS_DECODE_PAYLOAD = 2
+
+#Largest read or write length in words, the length field is 24-bits
+ARTEMIS_MAX_LENGTH = 0xFFFFFF
+
+#Number of chunks of a streaming read that can be waiting for the reader
+ARTEMIS_STREAM_QUEUE_SIZE = 8
+ARTEMIS_STREAM_CHUNK_WORDS = 0x4000
+ARTEMIS_STREAM_POLL = 0.1
+#Longest time the reader thread waits for the reader of a stream to take a
+#chunk, after that the rest of the stream is dropped and the stream fails.
+#The commands behind the stream wait as well so this is below their timeouts
+ARTEMIS_STREAM_TIMEOUT = 1
+
+#Size of the buffer that reads are received into when the caller does not
+#supply one, larger reads get a buffer of their own
+ARTEMIS_POOL_SIZE = 0x10000
+
+#Size of the buffer the response decoder reads into
+ARTEMIS_RX_SIZE = 0x4000
+
+#Bulk IN transfers kept in flight so the FTDI is drained while the reader
+#thread is busy, 0 to read synchronously
+ARTEMIS_ASYNC_READS = 8
+
+#A FIFO writer sends what it collected once it has this many bytes or the
+#oldest byte has waited this long
+ARTEMIS_FIFO_WRITE_SIZE = 0x1000
+ARTEMIS_FIFO_WRITE_DELAY = 0.005
+
+#Latency timer used for bulk transfers, register accesses use the minimum
+#latency of 2 ms
+ARTEMIS_BULK_LATENCY = 16
+
 ARTEMIS_MEMORY_OFFSET = 0x0100000000
 
 _artemis_instances = {}
 
-def Artemis(idVendor = 0x0403, idProduct = 0x8531, sernum = None, status = False):
+def Artemis(idVendor = 0x0403, idProduct = 0x8531, sernum = None, status = False, lazy = False):
     global _artemis_instances
     if sernum in _artemis_instances:
         return _artemis_instances[sernum]
-    _artemis_instances[sernum] = _Artemis(idVendor, idProduct, sernum, status)
+    _artemis_instances[sernum] = _Artemis(idVendor, idProduct, sernum, status, lazy)
     return _artemis_instances[sernum]
 
-class ArtemisData(object):
-    data = None
-    length = 0
+class ArtemisCommand(object):
+    """
+    ArtemisCommand
 
-class WorkerThread(threading.Thread):
+    A command for the worker thread, it doubles as a future: the worker
+    completes it when the matching response is read back from the FPGA
+    """
+
+    def __init__(self, name, opcode, data = None, length = 0, timeout = ARTEMIS_READ_TIMEOUT):
+        self.name = name
+        self.opcode = opcode
+        self.data = data
+        #Data that is sent after 'data' without being copied into it
+        self.payload = None
+        self.length = length
+        self.timeout = timeout
+        if opcode == ARTEMIS_READ:
+            self.response_length = ARTEMIS_READ_RESP_HEADER + (length * 4)
+        else:
+            self.response_length = ARTEMIS_RESP_LENGTH
+        self.deadline = None
+        #Streaming reads hand their data over in chunks through this queue
+        self.stream = None
+        self.chunk_size = 0
+        #The reader of the stream fell behind and the data was dropped
+        self.dropped = False
+        #Reads go straight into this buffer if the caller supplied one
+        self.buffer = None
+        self.cancelled = False
+        #Times of the phases of the command, see ArtemisStats
+        self.stats = None
+        self.queued = None
+        self.sent = None
+        self.written = None
+        self.first_byte = None
+        self.finished = None
+        self.timed_out = False
+        self.response = None
+        self.status = ARTEMIS_RESP_OK
+        self.event = ArtemisEvent()
+        self.callbacks = []
+        self.cb_lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout = ARTEMIS_QUEUE_TIMEOUT):
+        """result
+
+        Wait for the response of this command
+
+        Args:
+            timeout (float): seconds to wait for the response
+
+        Returns:
+            The response of the command (A Byte Array for a read)
+
+        Raises:
+            NysaCommError: Timeout or failure in communication
+        """
+        if not self.event.wait(timeout):
+            raise NysaCommError("Artemis error %s: timeout: %d" % (self.name, timeout))
+        if self.status != ARTEMIS_RESP_OK:
+            raise NysaCommError("Artemis response error %s: %d" % (self.name, self.status))
+        return self.response
+
+    def add_done_callback(self, callback):
+        """
+        Call 'callback(command)' when the command is finished, if the command
+        is already finished the callback is called immediately
+        """
+        with self.cb_lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_response(self, response, status = ARTEMIS_RESP_OK):
+        if self.stats is not None:
+            self.finished = time.time()
+            received = 0
+            if (status == ARTEMIS_RESP_OK) and (self.opcode in ARTEMIS_PIPELINED):
+                received = self.response_length + 1
+            self.stats.record(self, received, status == ARTEMIS_RESP_OK, self.timed_out)
+
+        with self.cb_lock:
+            self.response = response
+            self.status = status
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        if (self.stream is not None) and (status != ARTEMIS_RESP_OK):
+            #Wake up the reader of the stream, the chunks that are left are
+            #no use to it
+            try:
+                while True:
+                    self.stream.get_nowait()
+            except Queue.Empty:
+                pass
+            try:
+                self.stream.put_nowait(None)
+            except Queue.Full:
+                pass
+
+        for cb in callbacks:
+            try:
+                cb(self)
+            except Exception as ex:
+                print "Error in %s callback: %s" % (self.name, str(ex))
+
+class ArtemisTransaction(object):
+    """
+    ArtemisTransaction
+
+    Collects reads and writes, they are all sent to the Artemis when the
+    'with' block is finished. Each call returns an ArtemisCommand that holds
+    the response once the transaction is done
+    """
+
+    def __init__(self, artemis):
+        self.artemis = artemis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            #Don't send a partial transaction
+            return False
+
+        for command in self.artemis.submit_batch(self.commands):
+            command.result()
+        return False
+
+    def read(self, address, length = 1, disable_auto_inc = False, buf = None):
+        command = self.artemis._read_command(address, length, disable_auto_inc, buf)
+        self.commands.append(command)
+        return command
+
+    def write(self, address, data, disable_auto_inc = False):
+        command = self.artemis._write_command(address, data, disable_auto_inc)
+        self.commands.append(command)
+        return command
+
+class ArtemisFifoWriter(object):
+    """
+    ArtemisFifoWriter
+
+    Coalesces small writes to a single address (disable_auto_inc) into large
+    write commands. The collected data is sent when there are 'max_bytes' of
+    it, when 'max_delay' seconds have passed since the first write or when
+    'flush' is called. Errors of writes that were sent in the background are
+    raised by the next call
+    """
+
+    def __init__(self, artemis, address, max_bytes, max_delay):
+        self.artemis = artemis
+        self.address = address
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.data = Array('B')
+        self.timer = None
+        self.commands = collections.deque()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+    def write(self, data):
+        """
+        Add 'data' (a Byte Array, a multiple of 4 bytes) to the FIFO
+        """
+        with self.lock:
+            self.data.extend(data)
+            if len(self.data) >= self.max_bytes:
+                self.send()
+            elif (self.timer is None) and (self.max_delay is not None):
+                self.timer = threading.Timer(self.max_delay, self.expire)
+                self.timer.daemon = True
+                self.timer.start()
+        self.check()
+
+    def flush(self):
+        """
+        Send everything that was collected and wait for all the writes to
+        finish
+
+        Raises:
+            NysaCommError: Failure in communication
+        """
+        with self.lock:
+            self.send()
+        while len(self.commands) > 0:
+            self.commands.popleft().result()
+
+    def expire(self):
+        with self.lock:
+            if self.timer is not None:
+                self.send()
+
+    def send(self):
+        #Call with the lock held
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if len(self.data) == 0:
+            return
+        self.commands.append(self.artemis.submit_write(self.address, self.data, True))
+        self.data = Array('B')
+
+    def check(self):
+        """
+        Forget the writes that are finished, raise the error of a failed one
+        """
+        while (len(self.commands) > 0) and self.commands[0].done():
+            self.commands.popleft().result(0)
+
+class ReaderThread(threading.Thread):
+    """
+    ReaderThread
+
+    Reads the FTDI RX stream continuously, responses are handed to the
+    commands that are waiting for them and interrupt packets are processed as
+    soon as they arrive
+    """
 
     def __init__(   self,
                     dev,
-                    host_write_queue,
-                    host_read_queue,
-                    artemis_data,
                     lock,
-                    interrupt_update_callback):
-        super(WorkerThread, self).__init__()
+                    interrupt_update_callback,
+                    stats):
+        super(ReaderThread, self).__init__()
         self.dev = dev
-        self.hwq = host_write_queue
-        self.hrq = host_read_queue
-        self.iuc = interrupt_update_callback
-        self.d = artemis_data
         self.lock = lock
+        self.iuc = interrupt_update_callback
+        self.stats = stats
         self.interrupts = 0
+        self.finished = False
+
+        #In trusted stream mode the FTDI is only purged when the stream is
+        #known to be corrupt, headers are checked against the command instead
+        self.trusted = False
+        self.resyncs = 0
+        #Held while using the read side of the FTDI and the decoder
+        self.dev_lock = threading.RLock()
+
+        #Whatever the FTDI returns is read into this buffer and run through
+        #the response decoder
+        self.rx = bytearray(ARTEMIS_RX_SIZE)
+        self.reset_decoder()
+
+        #Reads without a buffer of their own are read into this first
+        self.pool = bytearray(ARTEMIS_POOL_SIZE)
+
+        #Commands waiting for a response, oldest first
+        self.in_flight = collections.deque()
+        self.in_flight_bytes = 0
+        self.in_flight_cond = threading.Condition()
+        #Purges are done by this thread between two reads, they are counted
+        #under in_flight_cond, see ask_for_purge
+        self.purges_asked = 0
+        self.purges_done = 0
+        self.stopped = False
 
         self.interrupts_cb = []
         for i in range(INTERRUPT_COUNT):
             self.interrupts_cb.append([])
 
-    def last_ref(self):
-        #Put an empty signal in the queue to signify that this is the last
-        #reference
-        self.hwq.put(None)
+    def stop(self):
+        self.finished = True
 
     def run(self):
-        wdata = None
-        rdata = None
-        while (1):
+        try:
+            self.read_loop()
+        finally:
+            #Nobody is going to do the purges that are still asked for
+            with self.in_flight_cond:
+                self.stopped = True
+                self.in_flight_cond.notify_all()
+
+    def read_loop(self):
+        while not self.finished:
             try:
-                try:
-                    wdata = self.hwq.get(block = True, timeout = INTERRUPT_SLEEP)
+                asked = self.purges_asked
+                if asked != self.purges_done:
+                    self.purge()
+                    with self.in_flight_cond:
+                        self.purges_done = asked
+                        self.in_flight_cond.notify_all()
+
+                with self.dev_lock:
+                    view = self.payload_view()
+                    if view is not None:
+                        #Data of a read goes straight to its destination
+                        count = self.dev.read_data_into(view)
+                        if count > 0:
+                            self.payload_received(count)
+                    else:
+                        count = self.dev.read_data_into(self.rx)
+                        if count > 0:
+                            self.feed(self.rx, 0, count)
+
+                if count == 0:
+                    self.check_timeout()
 
-                except Queue.Empty:
-                    #Timeout has occured, read and process interrupts
-                    self.check_interrupt()
-                    continue
+            except AttributeError:
+                print "closing artemis reader thread"
+                #The device was destroyed by the main thread, we are done then
+                return
 
-                #Check for finish condition
-                if wdata is None:
-                    #if write data is None then we are done
+    def reset_decoder(self):
+        """
+        Go back to looking for the ID of a packet, whatever was decoded of the
+        current packet is thrown away
+        """
+        self.state = ARTEMIS_DECODE_ID
+        self.command = None
+        self.header = bytearray()
+        self.header_size = ARTEMIS_READ_RESP_HEADER
+        self.remaining = 0
+        self.target = None
+        self.view = None
+        self.offset = 0
+        self.tail = None
+        self.chunk = None
+        self.deadline = None
+
+    def feed(self, data, start, end):
+        """
+        Run the bytes data[start:end] of the bytearray 'data' through the
+        response decoder, the bytes don't need to line up with packets
+        """
+        pos = start
+        while pos < end:
+            if self.state == ARTEMIS_DECODE_ID:
+                pos = data.find(ARTEMIS_RESP_ID_BYTE, pos, end)
+                if pos < 0:
+                    #Not the start of a packet
                     return
+                pos += 1
+                self.start_packet()
 
-                if wdata == ARTEMIS_RESET:
-                    self.reset()
-                elif wdata == ARTEMIS_IS_PROGRAMMED:
-                    self.is_programmed()
-                elif wdata == ARTEMIS_PING:
-                    self.ping()
-                elif wdata == ARTEMIS_WRITE:
-                    self.write()
-                elif wdata == ARTEMIS_READ:
-                    self.read()
-                elif wdata == ARTEMIS_DUMP_CORE:
-                    self.dump_core()
-                else:
-                    print "Unrecognized command from write queue: %d" % wdata
-                    pass
+            elif self.state == ARTEMIS_DECODE_HEADER:
+                count = min(self.header_size - len(self.header), end - pos)
+                self.header += data[pos:pos + count]
+                pos += count
+                if len(self.header) == self.header_size:
+                    self.decode_header()
 
-            except AttributeError:
-                print "closing artemis worker thread"
-                #If the queue is none then it was destroyed by the main thread
-                #we are done then
+            else:
+                count = min(self.remaining, end - pos)
+                self.payload(buffer(data, pos, count))
+                pos += count
+
+    def start_packet(self):
+        """
+        A response ID was found, the packet is either the response to the
+        oldest command or an interrupt
+        """
+        with self.in_flight_cond:
+            command = None
+            if len(self.in_flight) > 0:
+                command = self.in_flight[0]
+
+        self.state = ARTEMIS_DECODE_HEADER
+        self.command = command
+        self.header = bytearray()
+        self.header_size = ARTEMIS_READ_RESP_HEADER
+        if command is None:
+            self.deadline = time.time() + ARTEMIS_READ_TIMEOUT
+        else:
+            self.deadline = command.deadline
+            if command.opcode == ARTEMIS_DUMP_CORE:
+                #Status and the number of registers
+                self.header_size = 4
+
+    def decode_header(self):
+        """
+        The header of the packet is complete, decide what the payload is
+
+        In trusted stream mode a packet whose header doesn't check out is
+        treated as noise: the bytes after the ID are scanned again for the
+        real start of a packet
+        """
+        command = self.command
+        header = self.header
+
+        if (command is not None) and (command.opcode == ARTEMIS_DUMP_CORE) and \
+                (len(header) < ARTEMIS_READ_RESP_HEADER):
+            if self.is_response(command, header[0]):
+                command.first_byte = time.time()
+                #The Wishbone Master sets the number of registers in the response
+                self.start_payload((header[1] << 16 | header[2] << 8 | header[3]) * 4)
                 return
+            #Could still be an interrupt
+            self.header_size = ARTEMIS_READ_RESP_HEADER
+            return
 
-    def reset(self):
-        vendor = self.d.data[0]
-        product = self.d.data[1]
-        bbc = BitBangController(vendor, product, 2)
-        bbc.set_soft_reset_to_output()
-        bbc.soft_reset_high()
-        time.sleep(.2)
-        bbc.soft_reset_low()
-        time.sleep(.2)
-        bbc.soft_reset_high()
-        bbc.pins_on()
-        bbc.set_pins_to_input()
-        self.hrq.put(ARTEMIS_RESP_OK)
+        if (command is not None) and self.is_response(command, header[0]) and \
+                (not self.trusted or self.is_echo(command, header)):
+            command.first_byte = time.time()
+            length = command.response_length - ARTEMIS_READ_RESP_HEADER
+            if command.stream is not None:
+                self.chunk = bytearray()
+            elif command.opcode == ARTEMIS_READ:
+                #Read straight into the buffer of the caller, if there isn't
+                #one the data goes through the pool buffer
+                if command.buffer is not None:
+                    self.target = command.buffer
+                elif length <= ARTEMIS_POOL_SIZE:
+                    self.target = self.pool
+                else:
+                    self.target = bytearray(length)
+                self.view = memoryview(self.target)
+                self.offset = 0
+            else:
+                self.tail = bytearray()
+            self.start_payload(length)
+            return
 
-    def is_programmed(self):
-        vendor = self.d.data[0]
-        product = self.d.data[1]
-        bbc = BitBangController(vendor, product, 2)
-        self.d.data = bbc.read_done_pin()
-        bbc.pins_on()
-        bbc.set_pins_to_input()
-        self.hrq.put(ARTEMIS_RESP_OK)
+        if self.trusted and any(header[1:]):
+            #Neither a response nor an interrupt, the ID was part of something
+            #else, look for the next one
+            self.resyncs += 1
+            self.reset_decoder()
+            self.feed(header, 1, len(header))
+            return
 
-    def write(self):
-        #print "Writing: %s" % str(self.d.data)
-        self.dev.purge_buffers()
-        self.dev.write_data(self.d.data)
+        #Interrupt
+        self.command = None
+        self.tail = bytearray()
+        self.start_payload(ARTEMIS_RESP_LENGTH - ARTEMIS_READ_RESP_HEADER)
 
-        rsp = Array ('B')
-        rsp = self.dev.read_data_bytes(1)
+    def start_payload(self, length):
+        self.state = ARTEMIS_DECODE_PAYLOAD
+        self.remaining = length
+        if length == 0:
+            self.finish_packet()
 
-        if len(rsp) > 0 and rsp[0] == 0xDC:
-            #Got a response
-            pass
-        else:
-            timeout = time.time() + ARTEMIS_WRITE_TIMEOUT
-            while time.time() < timeout:
-                rsp = self.dev.read_data_bytes(1)
-                if len(rsp) > 0 and rsp[0] == 0xDC:
-                    #Got a response
-                    break
+    def payload_view(self):
+        """
+        Returns the part of the read buffer that the rest of the current
+        payload goes into, None if the payload isn't read into a buffer
+        """
+        if (self.state != ARTEMIS_DECODE_PAYLOAD) or (self.view is None):
+            return None
+        return self.view[self.offset:self.offset + self.remaining]
 
-        if len(rsp) > 0:
-            if rsp[0] != 0xDC:
-                #Response ID Not found!
-                self.hrq.put(ARTEMIS_RESP_ERR)
-                return
+    def payload_received(self, count):
+        """
+        'count' bytes were read into the view from payload_view
+        """
+        self.offset += count
+        self.remaining -= count
+        if self.remaining == 0:
+            self.finish_packet()
 
-        else:
-            #Timed out waiting for response
-            self.hrq.put(ARTEMIS_RESP_ERR)
+    def payload(self, data):
+        """
+        Part of the payload of the current packet, 'data' is a buffer
+        """
+        count = len(data)
+        if self.view is not None:
+            self.view[self.offset:self.offset + count] = data
+            self.payload_received(count)
             return
 
-        #Got ID byte now look for the rest of the data
-        read_count = 0
-        rsp = self.dev.read_data_bytes(12)
-        timeout = time.time() + ARTEMIS_WRITE_TIMEOUT
-        read_count = len(rsp)
-
-        while (time.time() < timeout) and (read_count < 12):
-            rsp += self.dev.read_data_bytes(12 - read_count)
-            read_count = len(rsp)
+        self.remaining -= count
+        if self.chunk is not None:
+            self.stream_data(data)
+        elif self.tail is not None:
+            self.tail += data
 
-        self.hrq.put(ARTEMIS_RESP_OK)
+        if self.remaining == 0:
+            self.finish_packet()
 
-    def read(self):
-        length = self.d.length
-        self.dev.purge_buffers()
-        dout = self.d.data
+    def stream_data(self, data):
+        """
+        Hand the data of a streaming read to the reader of the stream one
+        chunk at a time, the timeout is restarted after every chunk
+        """
+        command = self.command
+        pos = 0
+        while pos < len(data):
+            count = min(command.chunk_size - len(self.chunk), len(data) - pos)
+            self.chunk += data[pos:pos + count]
+            pos += count
+            if (len(self.chunk) < command.chunk_size) and \
+                    ((pos < len(data)) or (self.remaining > 0)):
+                continue
 
-        self.dev.write_data(self.d.data)
+            chunk = Array('B')
+            chunk.fromstring(buffer(self.chunk))
+            self.chunk = bytearray()
 
-        rsp = Array ('B')
-        rsp = self.dev.read_data_bytes(2)
-        if len(rsp) > 1 and rsp[0] == 0xDC and rsp[1] == 0xFD:
-            #Got a response
-            pass
-        else:
-            timeout = time.time() + ARTEMIS_READ_TIMEOUT
-            while time.time() < timeout:
-                rsp = self.dev.read_data_bytes(1)
-                if len(rsp) > 0 and rsp[0] == 0xDC:
-                    #Got an ack
+            #Wait for the reader of the stream to catch up, if it went away
+            #the data still has to be read to stay in step with the FPGA.
+            #Don't hold up the other commands for long, a reader that is
+            #too slow loses the rest of the stream
+            deadline = time.time() + ARTEMIS_STREAM_TIMEOUT
+            while not command.cancelled:
+                try:
+                    command.stream.put(chunk, timeout = ARTEMIS_STREAM_POLL)
                     break
+                except Queue.Full:
+                    if time.time() >= deadline:
+                        print "Reader of the %s stream fell behind, dropping the stream" % command.name
+                        command.dropped = True
+                        command.cancelled = True
+            command.deadline = time.time() + command.timeout
+
+    def finish_packet(self):
+        """
+        The whole packet was decoded, complete the command it belongs to
+        """
+        command = self.command
+        header = self.header
+        tail = self.tail
+        target = self.target
+        length = self.offset
+        self.reset_decoder()
+
+        if command is None:
+            self.stats.record_interrupt(len(header) + len(tail) + 1)
+            self.interrupt(header + tail)
+            return
 
-        if len(rsp) > 0:
-            if rsp[0] != 0xDC:
-                #Didn't get a response
-                self.hrq.put(ARTEMIS_RESP_ERR)
-                return
-
-        else:
-            #Timeout while waiting for a response
-            self.hrq.put(ARTEMIS_RESP_ERR)
+        if not self.pop_in_flight(command):
+            #The command was given up on while the response was decoded
             return
 
-        #Finished
-        #Watch out for the modem status bytes
-        rsp = rsp[1:]
-        read_count = len(rsp)
-        timeout = time.time() + ARTEMIS_READ_TIMEOUT
-
-        total_length = length * 4 + 8
-        rsp += self.dev.read_data_bytes(total_length - read_count)
-        read_count = len(rsp)
-
-        while (time.time() < timeout) and (read_count < total_length):
-            rsp += self.dev.read_data_bytes(total_length - read_count)
-            read_count = len(rsp)
-
-        '''
-        print "DEBUG READ:"
-        if (time.time() > timeout):
-            self.d.Error("\tTimeout condition occured!")
-        print "Time left on timeout: %d" % (timeout - time.time())
-
-        print "\tResponse Length: %d" % len(rsp)
-        print "\tResponse Status: %s" % str(rsp[:8])
-        print "\tResponse Dev ID: %d Addr: 0x%06X" % (rsp[4], (rsp[5] << 16 | rsp[6] << 8 | rsp[7]))
-        if len(rsp[8:]) > 32:
-            #print "\tResponse Data:\n\t%s" % str(rsp[8:40])
-            print "\tResponse Data:\n\t%s" % str(rsp[:40])
+        if command.opcode == ARTEMIS_DUMP_CORE:
+            #XXX: The core registers are not parsed yet
+            command.set_response(Array('L'))
+        elif command.dropped:
+            command.set_response(None, ARTEMIS_RESP_ERR)
+        elif (command.opcode == ARTEMIS_READ) and (command.stream is None):
+            if command.buffer is not None:
+                command.set_response(memoryview(target)[:length])
+            else:
+                data = Array('B')
+                data.fromstring(buffer(target, 0, length))
+                command.set_response(data)
         else:
-            print "\tResponse Data:\n\t%s" % str(rsp)
-        '''
-        self.d.data = rsp[8:]
-        self.hrq.put(ARTEMIS_RESP_OK)
+            command.set_response(None)
 
-    def ping(self):
-        self.dev.purge_buffers()
-        data = Array('B')
-        #data.extend([0xCD, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-        data.extend([0xCD, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-        #if self.s:
-        #    self.s.Debug( "Sending ping...",)
+    def is_echo(self, command, header):
+        """
+        The response repeats the length and address of the command
+        """
+        return header[1:ARTEMIS_READ_RESP_HEADER] == \
+            bytearray(command.data[2:ARTEMIS_READ_RESP_HEADER + 1])
 
+    def is_response(self, command, status):
+        """
+        The status of a response is the inverted command, the upper bits of
+        the command are flags so only the command bits are compared
+        """
+        return (status & 0x0F) == (~command.data[1] & 0x0F)
 
-        self.dev.write_data(data)
+    def interrupt(self, data):
+        """
+        Process an interrupt packet, 'data' is everything after the ID
+        """
+        interrupts = (data[8]  << 24 |
+                      data[9]  << 16 |
+                      data[10] << 8  |
+                      data[11])
 
-        #Set up a response
-        rsp = Array('B')
-        temp = Array('B')
-        rsp = self.dev.read_data_bytes(1)
-        if len(rsp) > 0 and rsp[0] == 0xDC:
-            #Got a response
-            pass
-        else:
-            timeout = time.time() + ARTEMIS_PING_TIMEOUT
-            while time.time() < timeout:
-                rsp = self.dev.read_data_bytes(1)
-                if len(rsp) > 0 and rsp[0] == 0xDC:
-                    #Got a response
-                    break
+        #self.s.Verbose("data: %s" % str(data))
+        with self.lock:
+            self.interrupts = interrupts
+            if self.interrupts > 0:
+                self.iuc(self.interrupts)
 
-        if len(rsp) > 0:
-            if rsp[0] != 0xDC:
-                self.hrq.put(ARTEMIS_REP_ERR)
+        if interrupts > 0:
+            self.process_interrupts(interrupts)
+
+    def check_timeout(self):
+        """
+        Nothing was read, if the oldest command has run out of time then give
+        up on everything that is in flight
+        """
+        with self.in_flight_cond:
+            command = None
+            if len(self.in_flight) > 0:
+                command = self.in_flight[0]
+                deadline = command.deadline
+            elif self.state != ARTEMIS_DECODE_ID:
+                deadline = self.deadline
+            else:
                 return
-        else:
-            self.hrq.put(ARTEMIS_RESP_ERR)
-            return
 
-        read_count = 0
-        rsp = self.dev.read_data_bytes(12)
-        timeout = time.time() + ARTEMIS_PING_TIMEOUT
-        read_count = len(rsp)
-        while time.time() < timeout and read_count < 12:
-            rsp += self.dev.read_data_bytes(12 - read_count)
-            read_count = len(rsp)
+        if time.time() < deadline:
+            return
 
-        self.hrq.put(ARTEMIS_RESP_OK)
+        if command is None:
+            print "Interrupt packet is too short: %s" % str(list(self.header))
+            with self.dev_lock:
+                self.reset_decoder()
+            return
 
-    def dump_core(self):
-        data = Array ('B')
-        data.extend([0xCD, 0x0F, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-        #if self.s:
-        #    self.s.Debug( "Sending core dump request...")
+        print "Timeout while waiting for %s response" % command.name
+        command.timed_out = True
+        self.abort_in_flight()
 
-        self.dev.purge_buffers()
-        self.dev.write_data(data)
-
-        core_dump = Array('L')
-        wait_time = 5
-        timeout = time.time() + wait_time
-
-        temp = Array ('B')
-        while time.time() < timeout:
-            rsp = self.dev.read_data_bytes(1)
-            temp.extend(rsp)
-            if 0xDC in rsp:
-                #self.s.Debug( "Read a response from the core dump")
-                break
-
-        if not 0xDC in rsp:
-            #if self.s:
-            #    self.s.Debug( "Response not found!")
-            raise NysaCommError("Response Not Found")
-
-        rsp = Array ('B')
-        read_total = 4
-        read_count = len(rsp)
-
-        #Get the number of items from the incomming data, This size is set by the
-        #Wishbone Master
-        timeout = time.time() + wait_time
-        while (time.time() < timeout) and (read_count < read_total):
-            rsp += self.dev.read_data_bytes(read_total - read_count)
-            read_count = len(rsp)
-
-
-        count = (rsp[1] << 16 | rsp[2] << 8 | rsp[3]) * 4
-        '''
-        if self.s:
-            self.s.Debug( "Length of read:%d" % len(rsp))
-            self.s.Debug( "Data: %s" % str(rsp))
-            self.s.Debug( "Number of core registers: %d" % (count / 4))
-        '''
-
-        timeout = time.time() + wait_time
-        read_total = count
-        read_count = 0
-        temp = Array ('B')
-        rsp = Array('B')
-        while (time.time() < timeout) and (read_count < read_total):
-            rsp += self.dev.read_data_bytes(read_total - read_count)
-            read_count = len(rsp)
-
-        #if self.s:
-        #    self.s.Debug( "Length read: %d" % (len(rsp) / 4))
-        #    self.s.Debug( "Data: %s" % str(rsp))
-
-        core_data = Array('L')
-        '''
-        for i in range(0, count, 4):
-            if self.s:
-                self.s.Debug( "Count: %d" % i)
-                core_data.append(rsp[i] << 24 | rsp[i + 1] << 16 | rsp[i + 2] << 8 | rsp[i + 3])
-
-
-        if self.s:
-            self.s.Debug( "Core Data: %s" % str(core_data))
-        '''
-
-        self.d.data = core_data
-        self.hrq.put(ARTEMIS_RESP_OK)
-
-    def check_interrupt(self):
-        self.interrupts = 0
-        data = None
-        if not self.lock.acquire(False):
-            #Could not aquire lock, return
-            return
+    def add_in_flight(self, commands, length):
+        """
+        Add commands that are about to be written to the FPGA, 'length' is
+        the number of response bytes they take up
+        """
+        now = time.time()
+        with self.in_flight_cond:
+            for command in commands:
+                command.sent = now
+                command.deadline = now + command.timeout
+            self.in_flight.extend(commands)
+            self.in_flight_bytes += length
+
+    def pop_in_flight(self, command):
+        """
+        Remove 'command' from the pipeline, returns False if it isn't the
+        oldest command anymore
+        """
+        with self.in_flight_cond:
+            if (len(self.in_flight) == 0) or (self.in_flight[0] is not command):
+                return False
+            self.in_flight.popleft()
+            if command.opcode == ARTEMIS_DUMP_CORE:
+                #Dump core needs the link to itself
+                self.in_flight_bytes = 0
+            else:
+                self.in_flight_bytes -= command.response_length + 1
+            if (len(self.in_flight) == 0) and not self.trusted:
+                #Clear out the FTDI now instead of in front of the next
+                #command, the next command only waits if it comes before the
+                #purge is done
+                self.purges_asked += 1
+            self.in_flight_cond.notify_all()
+            return True
 
-        try:
-            data = self.dev.read_data_bytes(2)
-            if len(data) == 0 or data[0] != 0xDC:
-                return
+    def wait_for_room(self, length):
+        """
+        Block until 'length' more response bytes fit in the pipeline
+        """
+        with self.in_flight_cond:
+            while (len(self.in_flight) > 0) and \
+                  (self.in_flight_bytes + length > ARTEMIS_MAX_IN_FLIGHT_BYTES):
+                self.in_flight_cond.wait()
 
-            data += self.dev.read_data_bytes(11)
+    def drain(self):
+        """
+        Block until all the outstanding commands have finished
+        """
+        with self.in_flight_cond:
+            while len(self.in_flight) > 0:
+                self.in_flight_cond.wait()
 
-            #self.s.Verbose("data: %s" % str(data))
+    def is_idle(self):
+        with self.in_flight_cond:
+            return len(self.in_flight) == 0
 
-            if len(data) != 13:
-                print "data length is not 13!: %s" % str(data)
+    def abort_in_flight(self):
+        """
+        The position of the responses in the stream is lost, fail all the
+        outstanding commands and clear out the FTDI
+        """
+        with self.in_flight_cond:
+            commands = list(self.in_flight)
+            self.in_flight.clear()
+            self.in_flight_bytes = 0
+            self.purges_asked += 1
+            self.in_flight_cond.notify_all()
 
-            self.interrupts =   (data[9]  << 24 |
-                                data[10] << 16 |
-                                data[11] << 8  |
-                                data[12])
+        for command in commands:
+            command.set_response(None, ARTEMIS_RESP_ERR)
 
-            if self.interrupts > 0:
-                self.process_interrupts(self.interrupts)
-                self.iuc(self.interrupts)
-                #print "Interrupt finished"
+    def purge(self):
+        """
+        Clear out the FTDI buffers, this is safe to call while the reader is
+        running
+        """
+        with self.dev_lock:
+            self.dev.purge_buffers()
+            self.reset_decoder()
 
-        except TypeError as ex:
-            print "Type Error: %s" % str(ex)
-        except:
-            print "Error while reading interrupts: %s" % sys.exc_info()[0]
-            #print "Exception when reading interrupts"
+    def ask_for_purge(self):
+        """
+        Have the reader thread clear out the FTDI buffers before its next
+        read. Another thread waiting for dev_lock can lose it to the reader
+        for several reads in a row
+        """
+        with self.in_flight_cond:
+            self.purges_asked += 1
 
-        finally:
-            self.lock.release()
+    def wait_for_purge(self):
+        """
+        Block until the purges asked for so far are done, the reader does
+        them itself if it isn't running
+        """
+        with self.in_flight_cond:
+            if (current_thread() is not self) and self.is_alive():
+                while (self.purges_done != self.purges_asked) and \
+                      not self.stopped:
+                    self.in_flight_cond.wait()
+            asked = self.purges_asked
+            if asked == self.purges_done:
+                return
+        self.purge()
+        with self.in_flight_cond:
+            self.purges_done = asked
 
     def process_interrupts(self, interrupts):
         for i in range(INTERRUPT_COUNT):
@@ -456,14 +874,14 @@ class WorkerThread(threading.Thread):
                 continue
             #Call all callbacks
             #self.s.Debug( "Calling callback for: %d" % i)
-            for cb in self.interrupts_cb[i]:
+            for cb in self.interrupts_cb[i][:]:
                 try:
                     #print "callback %s" % str(cb)
                     cb()
                 except TypeError:
                     #If an error occured when calling a callback removed if from
                     #our list
-                    self.interrupts_cb.remove(cb)
+                    self.interrupts_cb[i].remove(cb)
                     #self.s.Debug( "Error need to remove callback")
 
     def register_interrupt_cb(self, index, cb):
@@ -476,11 +894,150 @@ class WorkerThread(threading.Thread):
             raise NysaCommError("Index of interrupt device is out of range (> %d)" % (INTERRUPT_COUNT - 1))
         interrupt_list = self.interrupts_cb[index]
         if cb is None:
-            interrupt_list = []
+            del interrupt_list[:]
 
         elif cb in interrupt_list:
             interrupt_list.remove(cb)
 
+class WorkerThread(threading.Thread):
+    """
+    WorkerThread
+
+    Writes commands to the FPGA, the reader thread collects the responses
+    """
+
+    def __init__(   self,
+                    dev,
+                    host_write_queue,
+                    reader):
+        super(WorkerThread, self).__init__()
+        self.dev = dev
+        self.hwq = host_write_queue
+        self.reader = reader
+
+    def last_ref(self):
+        #Put an empty signal in the queue to signify that this is the last
+        #reference
+        self.hwq.put(None)
+
+    def run(self):
+        command = None
+        while (1):
+            try:
+                command = self.hwq.get(block = True)
+
+                #Check for finish condition
+                if command is None:
+                    #if write data is None then we are done
+                    self.reader.drain()
+                    self.reader.stop()
+                    return
+
+                if isinstance(command, list):
+                    #A batch of commands from a transaction
+                    self.send(command)
+                    continue
+
+                if command.opcode in ARTEMIS_PIPELINED:
+                    self.send([command])
+                    continue
+
+                #Everything else needs the link to itself
+                self.reader.drain()
+                if command.opcode == ARTEMIS_RESET:
+                    command.sent = time.time()
+                    self.reset(command)
+                elif command.opcode == ARTEMIS_IS_PROGRAMMED:
+                    command.sent = time.time()
+                    self.is_programmed(command)
+                elif command.opcode == ARTEMIS_DUMP_CORE:
+                    self.send([command], ARTEMIS_MAX_IN_FLIGHT_BYTES)
+                else:
+                    print "Unrecognized command from write queue: %d" % command.opcode
+                    command.set_response(None, ARTEMIS_RESP_ERR)
+
+            except AttributeError:
+                print "closing artemis worker thread"
+                #If the queue is none then it was destroyed by the main thread
+                #we are done then
+                return
+
+    def send(self, commands, segment_bytes = None):
+        """
+        Write commands to the FPGA and hand them to the reader thread to wait
+        for their responses
+
+        The commands are sent with as few USB writes as the space in the
+        pipeline allows
+        """
+        pos = 0
+        while pos < len(commands):
+            #Collect the commands that fit in the pipeline, at least one
+            end = pos + 1
+            if segment_bytes is None:
+                length = commands[pos].response_length + 1
+                while (end < len(commands)) and \
+                      (length + commands[end].response_length + 1 <= ARTEMIS_MAX_IN_FLIGHT_BYTES):
+                    length += commands[end].response_length + 1
+                    end += 1
+            else:
+                length = segment_bytes
+
+            #Make room in the pipeline
+            self.reader.wait_for_room(length)
+            self.reader.wait_for_purge()
+
+            segment = commands[pos:end]
+            pos = end
+            buffers = []
+            for command in segment:
+                buffers.append(command.data)
+                if command.payload is not None:
+                    buffers.append(command.payload)
+
+            #A short answer must not wait for the bulk latency timer
+            self.dev.expect_response(sum([command.response_length + 1
+                                          for command in segment]))
+
+            #The reader needs to know about the commands before the responses
+            #show up
+            self.reader.add_in_flight(segment, length)
+            try:
+                self.dev.write_datav(buffers)
+            except FtdiError as ex:
+                print "Error while writing %s: %s" % (segment[0].name, str(ex))
+                self.reader.abort_in_flight()
+                continue
+            written = time.time()
+            for command in segment:
+                command.written = written
+
+    def reset(self, command):
+        vendor, product, sernum = command.data
+        bbc = BitBangController(vendor, product, 2, serial = sernum)
+        bbc.set_soft_reset_to_output()
+        bbc.soft_reset_high()
+        time.sleep(.2)
+        bbc.soft_reset_low()
+        time.sleep(.2)
+        bbc.soft_reset_high()
+        bbc.pins_on()
+        bbc.set_pins_to_input()
+        command.written = time.time()
+        command.set_response(None)
+
+    def is_programmed(self, command):
+        vendor, product, sernum = command.data
+        bbc = BitBangController(vendor, product, 2, serial = sernum)
+        programmed = bbc.read_done_pin()
+        bbc.pins_on()
+        bbc.set_pins_to_input()
+        if not self.reader.trusted:
+            self.reader.ask_for_purge()
+            self.reader.wait_for_purge()
+        command.written = time.time()
+        command.set_response(programmed)
+
 class _Artemis (Nysa):
     """
     Artemis
@@ -488,39 +1045,87 @@ class _Artemis (Nysa):
     Concrete Class that implemented Artemis specific communication functions
     """
 
-    def __init__(self, idVendor = 0x0403, idProduct = 0x8531, sernum = None, status = False):
+    def __init__(self, idVendor = 0x0403, idProduct = 0x8531, sernum = None, status = False, lazy = False):
         Nysa.__init__(self, status)
         self.vendor = idVendor
         self.product = idProduct
         self.sernum = sernum
+        #Bus and hub ports of the board, filled in by the platform scan
+        self.location = None
 
         self.dev = None
+        self.hwq = None
+        self.reader = None
+        self.worker = None
+        #Held while opening, closing or queueing a command for the board
+        self.open_lock = threading.RLock()
+        #Time of the last command, None if the board was never used
+        self.last_used = None
+        #Reader settings that are kept when the board is closed
+        self.trusted = False
+        self.interrupts_cb = None
+
         #Run a full garbage collection so any previous references to Artemis will be removed
         gc.collect()
         self.lock = threading.Lock()
-
-
-        self.dev = Ftdi()
-        self._open_dev()
         self.name = "Artemis"
         self.interrupts = 0x00
         self.events = []
         for i in range (INTERRUPT_COUNT):
-            e = threading.Event()
+            e = ArtemisEvent()
             e.set()
             self.events.append(e)
 
-        self.hwq = Queue.Queue(10)
-        self.hrq = Queue.Queue(10)
+        self.stats = ArtemisStats()
+
+        if not lazy:
+            self.open()
+
+    def open(self):
+        """ open
 
-        self.d = ArtemisData()
+        Open the FTDI, start the worker and reader threads and reset the
+        board. Handles from a lazy scan are opened by the first command,
+        opening an open board does nothing
+
+        Args:
+            Nothing
+
+        Returns:
+            Nothing
+
+        Raises:
+            NysaCommError: Failue in communication
+            FtdiError: The board could not be opened
+        """
+        with self.open_lock:
+            if self.worker is not None:
+                return
+            try:
+                self._start()
+            except:
+                self.close()
+                raise
+
+    def _start(self):
+        self.dev = Ftdi()
+        self._open_dev()
+
+        self.hwq = Queue.Queue(MAX_WRITE_QUEUE_SIZE)
+
+        self.reader = ReaderThread(self.dev,
+                                   self.lock,
+                                   self.interrupt_update_callback,
+                                   self.stats)
+        self.reader.trusted = self.trusted
+        if self.interrupts_cb is not None:
+            self.reader.interrupts_cb = self.interrupts_cb
+        self.reader.setDaemon(True)
+        self.reader.start()
 
         self.worker = WorkerThread(self.dev,
                                    self.hwq,
-                                   self.hrq,
-                                   self.d,
-                                   self.lock,
-                                   self.interrupt_update_callback)
+                                   self.reader)
         #Is there a way to indicate closing
         self.worker.setDaemon(True)
         self.worker.start()
@@ -537,14 +1142,47 @@ class _Artemis (Nysa):
 
         self.reset()
 
-        '''
-        #status = True
-        self.reader_thread = ReaderThread(self.dev, self.interrupt_update_callback, self.lock, status = status)
-        self.reader_thread.setName("Reader Thread")
-        #XXX: Need to find a better way to shut this down
-        self.reader_thread.setDaemon(True)
-        self.reader_thread.start()
-        '''
+    def close(self):
+        """ close
+
+        Finish the commands that were queued, stop the worker and reader
+        threads and close the FTDI. The next command opens the board again,
+        the interrupt callbacks and the trusted stream setting are kept
+
+        Args:
+            Nothing
+
+        Returns:
+            Nothing
+
+        Raises:
+            Nothing
+        """
+        with self.open_lock:
+            if self.worker is not None:
+                self.worker.last_ref()
+                self.worker.join()
+            if self.reader is not None:
+                self.reader.stop()
+                self.reader.join()
+                self.interrupts_cb = self.reader.interrupts_cb
+            if self.dev is not None:
+                self.dev.close()
+            self.dev = None
+            self.hwq = None
+            self.reader = None
+            self.worker = None
+
+    def is_open(self):
+        return self.worker is not None
+
+    def _use(self):
+        """
+        Open the board if this is the first command since it was scanned or
+        closed
+        """
+        if self.worker is None:
+            self.open()
 
     def __del__(self):
         #if self.s: self.s.Debug( "Close reader thread")
@@ -579,7 +1217,8 @@ class _Artemis (Nysa):
         #crash
         latency  = 2
         #Ftdi.add_type(self.vendor, self.product, 0x700, "ft2232h")
-        self.dev.open(self.vendor, self.product, 0, serial = self.sernum)
+        self.dev.open(self.vendor, self.product, 0, serial = self.sernum,
+                      async_reads = ARTEMIS_ASYNC_READS)
 
         #Drain the input buffer
         self.dev.purge_buffers()
@@ -601,18 +1240,111 @@ class _Artemis (Nysa):
         #Enable MPSSE Mode
         self.dev.set_bitmode(0x00, Ftdi.BITMODE_SYNCFF)
 
-    def ipc_comm_response(self, name):
+        #Raise the latency timer while there is a bulk transfer going on
+        self.dev.set_adaptive_latency(AdaptiveLatency(lmin = latency,
+                                                      lmax = ARTEMIS_BULK_LATENCY,
+                                                      chunk_max = 0x10000))
+
+    def _submit(self, command, block = True):
+        """
+        Hand a command to the worker thread
+
+        Returns:
+            (ArtemisCommand): the command, use 'result' to wait for the
+            response
+
+        Raises:
+            Queue.Full: 'block' is False and the command can't be queued
+            without waiting
+        """
+        self._put(self._track(command), block)
+        return command
+
+    def _put(self, item, block = True):
+        """
+        Put a command or a list of commands in the queue of the worker
+        thread, opening the board first if needed. The open lock is held so
+        a close can't get in between, the item goes in front of the last
+        reference of the worker or into the queue of the next open.
+
+        With 'block' False Queue.Full is raised instead of waiting for the
+        board to be opened or closed or for room in the queue
+        """
+        if not self.open_lock.acquire(block):
+            raise Queue.Full
         try:
-            resp = self.hrq.get(block = True, timeout = ARTEMIS_QUEUE_TIMEOUT)
-            if resp == ARTEMIS_RESP_OK:
-                #print "%s got an OK response!" % current_thread().name
-                return self.d.data
-            else:
-                raise NysaCommError("Artemis response error %s: %d" % (name, resp))
-        except Queue.Empty:
-            raise NysaCommError("Artemis error %s: timeout: %d" % (name, ARTEMIS_QUEUE_TIMEOUT))
+            if (not block) and (self.worker is None):
+                raise Queue.Full
+            self._use()
+            self.hwq.put(item, block)
+        finally:
+            self.open_lock.release()
+
+    def _track(self, command):
+        """
+        Start collecting the statistics of a command that is about to be
+        queued
+        """
+        command.stats = self.stats
+        command.queued = time.time()
+        self.last_used = command.queued
+        return command
+
+    def _read_command(self, address, length, disable_auto_inc, buf = None):
+        data = self._build_header(0x02, address, length, disable_auto_inc)
+        command = ArtemisCommand("read", ARTEMIS_READ, data, length,
+                                 ARTEMIS_READ_TIMEOUT)
+        if buf is not None:
+            if len(buf) < length * 4:
+                raise NysaCommError("Read buffer is too small: %d < %d" % (len(buf), length * 4))
+            command.buffer = buf
+        return command
+
+    def _write_command(self, address, data, disable_auto_inc):
+        length = len(data) / 4
+        #Create an Array with the identification byte and code for writing
+        header = self._build_header(0x01, address, length, disable_auto_inc)
+        command = ArtemisCommand("write", ARTEMIS_WRITE, header, length,
+                                 ARTEMIS_WRITE_TIMEOUT)
+        #The data is written straight from the buffer of the caller
+        command.payload = data
+        return command
+
+    def _ping_command(self):
+        data = Array('B', [ARTEMIS_ID, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+                           0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+        return ArtemisCommand("ping", ARTEMIS_PING, data,
+                              timeout = ARTEMIS_PING_TIMEOUT)
+
+    def _dump_core_command(self):
+        data = Array('B', [ARTEMIS_ID, 0x0F, 0x00, 0x00, 0x00, 0x00, 0x00,
+                           0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+        return ArtemisCommand("dump core", ARTEMIS_DUMP_CORE, data,
+                              timeout = ARTEMIS_DUMP_CORE_TIMEOUT)
+
+    def _build_header(self, command, address, length, disable_auto_inc):
+        """
+        Build the ID, command, length and address bytes common to reads and
+        writes
+        """
+        data = Array('B', [ARTEMIS_ID, command])
+        if address >= ARTEMIS_MEMORY_OFFSET:
+            address -= ARTEMIS_MEMORY_OFFSET
+            data[1] = data[1] | 0x10
+
+        if disable_auto_inc:
+            data[1] = data[1] | 0x20
 
-    def read(self, address, length = 1, disable_auto_inc = False):
+        #Append the length into the first 24 bits
+        fmt_string = "%06X" % length
+        data.fromstring(fmt_string.decode('hex'))
+
+        #Add the address
+        addr_string = "%08X" % (address & 0xFFFFFFFF)
+        data.fromstring(addr_string.decode('hex'))
+        return data
+
+    def read(self, address, length = 1, disable_auto_inc = False, buf = None):
         """read
 
         read data from Artemis
@@ -632,32 +1364,94 @@ class _Artemis (Nysa):
             length (int): Number of 32-bit words to read
             disable_auto_inc (bool): if true, auto increment feature will be
                 disabled
+            buf (bytearray or memoryview): Optional, the data is read
+                directly into this buffer, it must hold at least length * 4
+                bytes
 
         Returns:
             (Byte Array): A byte array containing the raw data returned from
             Artemis
+            (memoryview): if 'buf' was supplied, a view of the data in 'buf'
 
         Raises:
             NysaCommError
         """
-        with self.lock:
-            self.d.data = Array('B', [0xCD, 0x02])
-            if address >= ARTEMIS_MEMORY_OFFSET:
-                address -= ARTEMIS_MEMORY_OFFSET
-                self.d.data[1] = self.d.data[1] | 0x10
+        return self.submit_read(address, length, disable_auto_inc, buf).result()
 
-            if disable_auto_inc:
-                self.d.data[1] = self.d.data[1] | 0x20
+    def submit_read(self, address, length = 1, disable_auto_inc = False, buf = None):
+        """submit_read
 
-            fmt_string = "%06X" % length
-            self.d.data.fromstring(fmt_string.decode('hex'))
+        Queue up a read without waiting for the response, many commands can
+        be in flight at the same time. See 'read' for the arguments
 
-            #Add the address
-            addr_string = "%08X" % (address & 0xFFFFFFFF)
-            self.d.data.fromstring(addr_string.decode('hex'))
-            self.d.length = length
-            self.hwq.put(ARTEMIS_READ)
-            return self.ipc_comm_response("read")
+        Returns:
+            (ArtemisCommand): call 'result' to get the Byte Array that was read
+
+        Raises:
+            Nothing
+        """
+        return self._submit(self._read_command(address, length, disable_auto_inc, buf))
+
+    def read_stream(self, address, words, chunk_words = ARTEMIS_STREAM_CHUNK_WORDS, disable_auto_inc = False):
+        """read_stream
+
+        Read a large region a chunk at a time, each chunk is handed over as
+        soon as it has been read off the wire so only a few chunks are held
+        in memory at a time. Reads longer than the 24-bit length field are
+        split up automatically. The reader thread waits up to
+        ARTEMIS_STREAM_TIMEOUT seconds for a chunk to be taken, if the
+        generator is left alone for longer the rest of the stream is dropped
+        and the next chunk raises an error
+
+        for chunk in artemis.read_stream(address, words):
+            f.write(chunk.tostring())
+
+        Args:
+            address (long): Address of the register/memory to read
+            words (int): Number of 32-bit words to read
+            chunk_words (int): Number of 32-bit words in each chunk, the last
+                chunk of a read may be shorter
+            disable_auto_inc (bool): if true, auto increment feature will be
+                disabled
+
+        Returns:
+            (generator): yields Byte Arrays
+
+        Raises:
+            NysaCommError
+        """
+        pos = 0
+        while pos < words:
+            length = min(words - pos, ARTEMIS_MAX_LENGTH)
+            offset = 0
+            if not disable_auto_inc:
+                #Memory is byte addressed, peripherals are word addressed
+                offset = pos
+                if address >= ARTEMIS_MEMORY_OFFSET:
+                    offset = pos * 4
+
+            command = self._read_command(address + offset, length, disable_auto_inc)
+            command.stream = Queue.Queue(ARTEMIS_STREAM_QUEUE_SIZE)
+            command.chunk_size = chunk_words * 4
+            self._submit(command)
+            try:
+                received = 0
+                while received < length * 4:
+                    try:
+                        chunk = command.stream.get(timeout = ARTEMIS_QUEUE_TIMEOUT)
+                    except Queue.Empty:
+                        #Raise the error if the read failed, otherwise timeout
+                        if command.done():
+                            command.result()
+                        raise NysaCommError("Artemis error %s: timeout: %d" % (command.name, ARTEMIS_QUEUE_TIMEOUT))
+                    if chunk is None:
+                        command.result()
+                    received += len(chunk)
+                    yield chunk
+            finally:
+                command.cancelled = True
+
+            pos += length
 
     def write(self, address, data, disable_auto_inc = False):
         """write
@@ -680,7 +1474,8 @@ class _Artemis (Nysa):
             memory_device (boolean):
                 True: Memory device
                 False: Peripheral device
-            data (array of bytes): Array of raw bytes to send to the devcie
+            data (array of bytes): Array of raw bytes to send to the devcie,
+                any object that supports the buffer interface
             disable_auto_inc (boolean): Default False
                 Set to true if only writing to one memory address (FIFO Mode)
 
@@ -689,24 +1484,93 @@ class _Artemis (Nysa):
         Raises:
             NysaCommError
         """
-        with self.lock:
-            length = len(data) / 4
-            #Create an Array with the identification byte and code for writing
-            self.d.data = Array ('B', [0xCD, 0x01])
-            if address >= ARTEMIS_MEMORY_OFFSET:
-                address -= ARTEMIS_MEMORY_OFFSET
-                self.d.data[1] = self.d.data[1] | 0x10
-            if disable_auto_inc:
-                self.d.data[1] = self.d.data[1] | 0x20
-
-            #Append the length into the first 24 bits
-            fmt_string = "%06X" % length
-            self.d.data.fromstring(fmt_string.decode('hex'))
-            addr_string = "%08X" % (address & 0xFFFFFFFF)
-            self.d.data.fromstring(addr_string.decode('hex'))
-            self.d.data.extend(data)
-            self.hwq.put(ARTEMIS_WRITE)
-            self.ipc_comm_response("write")
+        self.submit_write(address, data, disable_auto_inc).result()
+
+    def submit_write(self, address, data, disable_auto_inc = False):
+        """submit_write
+
+        Queue up a write without waiting for the acknowledgement, many
+        commands can be in flight at the same time. See 'write' for the
+        arguments. The data is sent straight from 'data', it must not be
+        changed until the write is finished
+
+        Returns:
+            (ArtemisCommand): call 'result' to wait for the write to finish
+
+        Raises:
+            Nothing
+        """
+        return self._submit(self._write_command(address, data, disable_auto_inc))
+
+    def submit_batch(self, commands):
+        """submit_batch
+
+        Send a list of commands to the Artemis with a single USB write (as
+        long as the responses fit in the FTDI FIFO), the responses are parsed
+        in one pass
+
+        Args:
+            commands (list of ArtemisCommand): commands from a transaction
+
+        Returns:
+            (list of ArtemisCommand): the commands
+
+        Raises:
+            Nothing
+        """
+        commands = list(commands)
+        for command in commands:
+            self._track(command)
+        if len(commands) > 0:
+            self._put(commands)
+        return commands
+
+    def transaction(self):
+        """transaction
+
+        Collect reads and writes then send them all at once when the 'with'
+        block is finished
+
+        with artemis.transaction() as t:
+            t.write(0x01, data)
+            command = t.read(0x02)
+        print command.result()
+
+        Args:
+            Nothing
+
+        Returns:
+            (ArtemisTransaction): context manager with 'read' and 'write'
+
+        Raises:
+            Nothing
+        """
+        return ArtemisTransaction(self)
+
+    def fifo_writer(self, address, max_bytes = ARTEMIS_FIFO_WRITE_SIZE, max_delay = ARTEMIS_FIFO_WRITE_DELAY):
+        """fifo_writer
+
+        Create a writer that coalesces small writes to a FIFO at 'address'
+        into large write commands (with disable_auto_inc set)
+
+        with artemis.fifo_writer(address) as fifo:
+            for block in blocks:
+                fifo.write(block)
+
+        Args:
+            address (long): Address of the FIFO
+            max_bytes (int): Send the collected data once there is this much
+            max_delay (float): Seconds the data can wait before it is sent,
+                None to only send on size or 'flush'
+
+        Returns:
+            (ArtemisFifoWriter): call 'write' to add data and 'flush' to
+            send it and wait for the writes to finish
+
+        Raises:
+            Nothing
+        """
+        return ArtemisFifoWriter(self, address, max_bytes, max_delay)
 
     def ping (self):
         """ping
@@ -727,9 +1591,7 @@ class _Artemis (Nysa):
         Raises:
             NysaCommError
         """
-        with self.lock:
-            self.hwq.put(ARTEMIS_PING)
-            self.ipc_comm_response("ping")
+        self._submit(self._ping_command()).result()
 
     def reset (self):
         """ reset
@@ -751,10 +1613,9 @@ class _Artemis (Nysa):
         Raises:
             NysaCommError: Failue in communication
         """
-        with self.lock:
-            self.d.data = (self.vendor, self.product)
-            self.hwq.put(ARTEMIS_RESET)
-            self.ipc_comm_response("reset")
+        self._submit(ArtemisCommand("reset", ARTEMIS_RESET,
+                                    (self.vendor, self.product,
+                                     self.sernum))).result()
 
     def is_programmed(self):
         """
@@ -770,11 +1631,10 @@ class _Artemis (Nysa):
         Raises:
             NysaCommError: Failue in communication
         """
-        with self.lock:
-            self.d.data = (self.vendor, self.product)
-            self.hwq.put(ARTEMIS_IS_PROGRAMMED)
-            self.dev.purge_buffers()
-            return self.ipc_comm_response("is programmed")
+        return self._submit(ArtemisCommand("is programmed",
+                                           ARTEMIS_IS_PROGRAMMED,
+                                           (self.vendor, self.product,
+                                            self.sernum))).result()
 
     def dump_core(self):
         """ dump_core
@@ -798,9 +1658,74 @@ class _Artemis (Nysa):
         Raises:
             NysaCommError: A failure in communication is detected
         """
-        with self.lock:
-            self.hwq.put(ARTEMIS_DUMP_CORE)
-            return self.ipc_comm_response("dump core")
+        return self._submit(self._dump_core_command()).result()
+
+    def set_trusted_stream(self, enable):
+        """ set_trusted_stream
+
+        Enable or disable trusted stream mode. Normally the FTDI buffers are
+        purged (two USB control transfers) before a command is sent to an idle
+        link. In trusted stream mode the RX stream is left alone and the
+        reader checks the length and address echoed in each response header
+        instead, the buffers are only purged when the stream is corrupt
+
+        Args:
+            enable (boolean): True to enable trusted stream mode
+
+        Returns:
+            Nothing
+
+        Raises:
+            Nothing
+        """
+        with self.open_lock:
+            self.trusted = enable
+            if self.reader is not None:
+                self.reader.trusted = enable
+
+    def get_stats(self):
+        """ get_stats
+
+        Snapshot of the statistics of the commands that finished since the
+        Artemis was opened or 'reset_stats' was called
+
+        The statistics are keyed by command name ("read", "write", "ping",
+        "reset", "dump core", "is programmed" and "interrupt" for interrupt
+        packets). Each holds the counts: "count", "errors", "timeouts",
+        "bytes_out" and "bytes_in" and a latency histogram summary (count,
+        min, max, mean and percentiles in seconds) for each phase:
+
+            "queue_wait": waiting in the queue and for room in the pipeline
+            "usb_write":  writing the command to the FTDI
+            "first_byte": waiting for the start of the response
+            "payload":    reading the rest of the response
+
+        Args:
+            Nothing
+
+        Returns:
+            (dict): statistics keyed by command name
+
+        Raises:
+            Nothing
+        """
+        return self.stats.snapshot()
+
+    def reset_stats(self):
+        """ reset_stats
+
+        Clear the statistics of the commands
+
+        Args:
+            Nothing
+
+        Returns:
+            Nothing
+
+        Raises:
+            Nothing
+        """
+        self.stats.reset()
 
     def register_interrupt_callback(self, index, callback):
         """ register_interrupt
@@ -818,7 +1743,8 @@ class _Artemis (Nysa):
         Raises:
             Nothing
         """
-        self.worker.register_interrupt_cb(index, callback)
+        self._use()
+        self.reader.register_interrupt_cb(index, callback)
 
     def unregister_interrupt_callback(self, index, callback = None):
         """ unregister_interrupt_callback
@@ -836,7 +1762,8 @@ class _Artemis (Nysa):
         Raises:
             Nothing (This function fails quietly if ther callback is not found)
         """
-        self.worker.unregister_interrupt_cb(index, callback)
+        self._use()
+        self.reader.unregister_interrupt_cb(index, callback)
 
     def wait_for_interrupts(self, wait_time = 1, dev_id = None):
         """ wait_for_interrupts
@@ -873,6 +1800,8 @@ class _Artemis (Nysa):
         if dev_id is None:
             dev_id = 0
 
+        #Interrupts are only seen while the reader thread runs
+        self._use()
         e = self.events[dev_id]
         #print "Checking events!"
 
@@ -0,0 +1,244 @@
+#! /usr/bin/python
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" async_artemis
+
+Event loop interface for the Artemis, many boards can be driven from one
+thread without blocking the loop
+
+    artemis = AsyncArtemis(Artemis(sernum = sernum))
+    data = yield From(artemis.read(0x01, 4))    #trollius
+    data = await artemis.read(0x01, 4)          #asyncio
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import Queue
+import collections
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from nysa.host.nysa import NysaCommError
+
+from artemis_usb2 import INTERRUPT_COUNT
+
+
+class AsyncArtemis(object):
+    """
+    AsyncArtemis
+
+    Wraps an Artemis, every call returns an asyncio Future. The futures are
+    completed from the reader thread of the Artemis as soon as the response
+    is decoded, no thread is blocked waiting for a response
+    """
+
+    def __init__(self, artemis, loop = None):
+        self.artemis = artemis
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        #Future of the open that is going on, see _open
+        self.opening = None
+        #Commands and their futures in the order they were made, see _drain
+        self.backlog = collections.deque()
+        #Future of the command that is queued from the executor
+        self.putting = None
+
+    def read(self, address, length = 1, disable_auto_inc = False, buf = None):
+        """read
+
+        See Artemis.read
+
+        Returns:
+            (Future): the Byte Array that was read
+
+        Raises:
+            NysaCommError: The buffer is too small
+        """
+        command = self.artemis._read_command(address, length, disable_auto_inc, buf)
+        return self._submit(command)
+
+    def write(self, address, data, disable_auto_inc = False):
+        """write
+
+        See Artemis.write
+
+        Returns:
+            (Future): done when the write is acknowledged
+
+        Raises:
+            Nothing
+        """
+        return self._submit(self.artemis._write_command(address, data, disable_auto_inc))
+
+    def ping(self):
+        """ping
+
+        Returns:
+            (Future): done when the ping is answered
+
+        Raises:
+            Nothing
+        """
+        return self._submit(self.artemis._ping_command())
+
+    def dump_core(self):
+        """dump_core
+
+        See Artemis.dump_core
+
+        Returns:
+            (Future): Array of 32-bit values
+
+        Raises:
+            Nothing
+        """
+        return self._submit(self.artemis._dump_core_command())
+
+    def wait_for_interrupts(self, wait_time = 1, dev_id = None):
+        """wait_for_interrupts
+
+        Wait for an interrupt from a device without blocking the loop
+
+        Args:
+            wait_time (float): the amount of time in seconds to wait for an
+                interrupt
+            dev_id (Integer): Optional device id, defaults to 0
+
+        Returns:
+            (Future): True if interrupts were detected, False on a timeout
+
+        Raises:
+            NysaCommError: Index of the device is out of range
+        """
+        if dev_id is None:
+            dev_id = 0
+        if dev_id > INTERRUPT_COUNT - 1:
+            raise NysaCommError("Index of interrupt device is out of range (> %d)" % (INTERRUPT_COUNT - 1))
+
+        future = asyncio.Future(loop = self.loop)
+        deadline = self.loop.time() + wait_time
+
+        def start(opened = None):
+            if future.done():
+                #Cancelled by the caller while the board was opened
+                return
+            if (opened is not None) and (opened.exception() is not None):
+                future.set_exception(opened.exception())
+                return
+            reader = self.artemis.reader
+
+            def interrupt():
+                #Called from the reader thread
+                self.loop.call_soon_threadsafe(self._set_result, future, True)
+
+            #The callback goes in first, an interrupt that comes in after
+            #the look at the interrupts below calls it
+            reader.register_interrupt_cb(dev_id, interrupt)
+            timer = self.loop.call_at(deadline, self._set_result, future, False)
+
+            def cleanup(future):
+                timer.cancel()
+                reader.unregister_interrupt_cb(dev_id, interrupt)
+
+            future.add_done_callback(cleanup)
+            with self.artemis.lock:
+                if (self.artemis.interrupts & (1 << dev_id)) > 0:
+                    #There are already existing interrupts, we're done
+                    future.set_result(True)
+
+        if self.artemis.is_open() and (self.opening is None):
+            start()
+        else:
+            self._open().add_done_callback(start)
+        return future
+
+    def _open(self):
+        """
+        Open the board from a thread of the executor, opening resets the
+        board and blocks for a while. Returns a Future, the waits for
+        interrupts made while the board opens share it
+        """
+        if self.opening is None:
+            self.opening = self.loop.run_in_executor(None, self.artemis._use)
+            self.opening.add_done_callback(self._opened)
+        return self.opening
+
+    def _opened(self, opening):
+        self.opening = None
+
+    def _submit(self, command):
+        """
+        Hand a command to the worker thread, returns a Future that completes
+        with the response of the command
+        """
+        future = asyncio.Future(loop = self.loop)
+
+        def done(command):
+            #Called from the reader thread
+            self.loop.call_soon_threadsafe(self._complete, future, command)
+
+        command.add_done_callback(done)
+        self.backlog.append((command, future))
+        self._drain()
+        return future
+
+    def _drain(self):
+        """
+        Queue the commands of the backlog in order. When the board has to be
+        opened or the worker is behind the command at the front is queued
+        from a thread of the executor, the others wait for it in the backlog
+        """
+        while (len(self.backlog) > 0) and (self.putting is None):
+            command, future = self.backlog[0]
+            try:
+                self.artemis._submit(command, block = False)
+            except Queue.Full:
+                self.putting = self.loop.run_in_executor(None, self.artemis._submit, command)
+                self.putting.add_done_callback(self._put)
+                return
+            except Exception as ex:
+                self._set_exception(future, ex)
+            self.backlog.popleft()
+
+    def _put(self, putting):
+        self.putting = None
+        command, future = self.backlog.popleft()
+        if putting.exception() is not None:
+            self._set_exception(future, putting.exception())
+        self._drain()
+
+    def _complete(self, future, command):
+        if future.done():
+            #Cancelled by the caller
+            return
+        try:
+            future.set_result(command.result(0))
+        except Exception as ex:
+            future.set_exception(ex)
+
+    def _set_exception(self, future, exception):
+        if not future.done():
+            future.set_exception(exception)
+
+    def _set_result(self, future, result):
+        if not future.done():
+            future.set_result(result)
@@ -30,13 +30,14 @@ class BitBangController(object):
     PROGRAM_PIN         = 0x40
     SOFT_RESET_PIN      = 0x80
 
-    def __init__(self, vendor_id, product_id, interface, debug = False):
+    def __init__(self, vendor_id, product_id, interface, debug = False, serial = None):
         self.vendor = vendor_id
         self.product = product_id
         self.interface = interface
+        self.serial = serial
         self.f = Ftdi()
         self.debug = True
-        self.f.open_bitbang(vendor_id, product_id, interface)
+        self.f.open_bitbang(vendor_id, product_id, interface, serial = serial)
 
     def hiz(self):
         pass
@@ -87,6 +88,7 @@ class BitBangController(object):
         self.f.open_bitbang(self.vendor,
                             self.product,
                             self.interface,
+                            serial = self.serial,
                             direction = pin_dir)
 
     def set_program_pin_to_output(self):
@@ -94,18 +96,21 @@ class BitBangController(object):
         self.f.open_bitbang(self.vendor,
                             self.product,
                             self.interface,
+                            serial = self.serial,
                             direction = pin_dir)
 
     def set_pins_to_input(self):
         self.f.open_bitbang(self.vendor,
                             self.product,
                             self.interface,
+                            serial = self.serial,
                             direction = 0x00)
 
     def set_pins_to_output(self):
         self.f.open_bitbang(self.vendor,
                             self.product,
                             self.interface,
+                            serial = self.serial,
                             direction = 0xFF)
 
     def pins_on(self):
@@ -26,20 +26,256 @@ Require: pyusb
 """
 
 import os
+import errno
 import struct
+import time
+import threading
 import usb.core
 import usb.util
 from array import array as Array
+from ctypes import pythonapi, py_object, byref, string_at, c_void_p, \
+                   c_ssize_t, POINTER
 from usbtools import UsbTools
+from usbasync import AsyncBulkReader
 
 
-__all__ = ['Ftdi', 'FtdiError']
+__all__ = ['Ftdi', 'FtdiError', 'RingBuffer', 'AdaptiveLatency']
 
 
 class FtdiError(IOError):
     """Communication error with the FTDI device"""
 
 
+pythonapi.PyObject_AsReadBuffer.argtypes = [py_object, POINTER(c_void_p),
+                                            POINTER(c_ssize_t)]
+
+
+def _buffer_info(data):
+    """Return the object that owns the memory of a buffer object, the
+       address and the size in bytes of the memory. The memory is not
+       copied, except for memoryviews and sequences that do not support the
+       buffer interface"""
+    if isinstance(data, Array):
+        address, count = data.buffer_info()
+        return data, address, count*data.itemsize
+    if isinstance(data, memoryview):
+        # memoryviews do not export the old buffer interface
+        data = data.tobytes()
+    elif isinstance(data, (list, tuple)):
+        data = Array('B', data)
+        address, count = data.buffer_info()
+        return data, address, count
+    address = c_void_p()
+    size = c_ssize_t()
+    pythonapi.PyObject_AsReadBuffer(data, byref(address), byref(size))
+    return data, address.value or 0, size.value
+
+
+class _BufferSlice(object):
+    """A range of memory in the form the pyusb backends expect for a
+       transfer, they only use buffer_info() and itemsize"""
+
+    itemsize = 1
+
+    def __init__(self, owner, address, length):
+        # keep the owner of the memory alive during the transfer
+        self.owner = owner
+        self.address = address
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def buffer_info(self):
+        return (self.address, self.length)
+
+
+# Keeps the error bits of a line status byte, see Ftdi.LINE_ERRORS
+_LINE_ERRORS = ''.join([chr(i & 0x9e) for i in range(256)])
+
+
+class RingBuffer(object):
+    """Fixed capacity FIFO of bytes, used to keep the received payload that
+       was not requested yet. Data is copied in and out with at most two
+       slice copies, and nothing is reallocated as data comes and goes. The
+       capacity must be at least the size of a USB read, more data than
+       that is never kept."""
+
+    def __init__(self, capacity):
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+    def clear(self):
+        """Drop all the buffered data"""
+        self._head = 0
+        self._count = 0
+
+    def write(self, data):
+        """Append the content of a buffer object to the ring. Raise
+           FtdiError if it does not fit"""
+        size = len(data)
+        if self._count+size > len(self._buffer):
+            raise FtdiError('Receive buffer overflow: %d bytes in a ring of '
+                            '%d with %d bytes' %
+                            (size, len(self._buffer), self._count))
+        tail = (self._head+self._count) % len(self._buffer)
+        first = min(size, len(self._buffer)-tail)
+        self._view[tail:tail+first] = buffer(data, 0, first)
+        if first < size:
+            self._view[0:size-first] = buffer(data, first, size-first)
+        self._count += size
+
+    def peek(self, size):
+        """Return up to size bytes from the ring as an array, without
+           consuming them"""
+        size = min(size, self._count)
+        data = Array('B')
+        first = min(size, len(self._buffer)-self._head)
+        data.fromstring(buffer(self._buffer, self._head, first))
+        if first < size:
+            data.fromstring(buffer(self._buffer, 0, size-first))
+        return data
+
+    def consume(self, size):
+        """Drop up to size bytes from the ring, return the number of bytes
+           that were dropped"""
+        size = min(size, self._count)
+        self._head = (self._head+size) % len(self._buffer)
+        self._count -= size
+        if not self._count:
+            self._head = 0
+        return size
+
+    def read(self, size):
+        """Return and consume up to size bytes from the ring, as an array"""
+        data = self.peek(size)
+        self.consume(len(data))
+        return data
+
+    def read_into(self, buf):
+        """Copy and consume as many bytes as fit in a writable buffer, return
+           the number of bytes that were copied"""
+        dst = memoryview(buf)
+        size = min(len(dst), self._count)
+        first = min(size, len(self._buffer)-self._head)
+        dst[0:first] = buffer(self._buffer, self._head, first)
+        if first < size:
+            dst[first:size] = buffer(self._buffer, 0, size-first)
+        return self.consume(size)
+
+
+class AdaptiveLatency(object):
+    """Pick the latency timer and the read chunk size from the workload.
+       Small register accesses want a short latency timer and small reads,
+       so a short answer is not held back in the chip; bulk captures want a
+       long latency timer and large reads, so the bus carries full packets.
+       The workload is measured over windows of 'window' seconds: achieved
+       throughput, mean fill of the USB reads and mean request size. The
+       bulk profile is only entered after 'settle' windows in a row ask for
+       it, and never sooner than 'min_interval' seconds after the last
+       change, which caps the rate of control transfers. The interactive
+       profile comes back as soon as a window or a command asks for it, a
+       short answer is never held back by the bulk latency timer."""
+
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
+
+    def __init__(self, lmin=2, lmax=16, chunk_min=4096, chunk_max=16384,
+                 window=0.25, bulk_rate=1 << 20, fill_high=0.5,
+                 fill_low=0.125, bulk_request=4096, settle=2,
+                 min_interval=1.0):
+        for lat in (lmin, lmax):
+            if not (Ftdi.LATENCY_MIN <= lat <= Ftdi.LATENCY_MAX):
+                raise AssertionError("Latency out of range: %d" % lat)
+        self.profiles = {self.INTERACTIVE: (lmin, chunk_min),
+                         self.BULK: (lmax, chunk_max)}
+        self.window = window
+        self.bulk_rate = bulk_rate
+        self.fill_high = fill_high
+        self.fill_low = fill_low
+        self.bulk_request = bulk_request
+        self.settle = settle
+        self.min_interval = min_interval
+        self.mode = self.INTERACTIVE
+        self.changes = 0
+        self.last_change = None
+        self.votes = 0
+        self._start_window(time.time())
+
+    def profile(self):
+        """Return the latency and the chunk size of the current mode"""
+        return self.profiles[self.mode]
+
+    def sample(self, request, received, capacity):
+        """Account for a USB read of 'received' bytes, status bytes
+           included, out of 'capacity', done to serve a request of 'request'
+           bytes. Return the (latency, chunksize) profile to switch to, or
+           None to keep the current one"""
+        now = time.time()
+        self.reads += 1
+        self.received += max(received-2, 0)
+        self.fill += float(received)/capacity
+        self.requested += request
+        elapsed = now-self.started
+        if elapsed < self.window:
+            return None
+        rate = self.received/elapsed
+        fill = self.fill/self.reads
+        request = self.requested/self.reads
+        self._start_window(now)
+        if self.mode == self.BULK:
+            # leave bulk mode at lower thresholds than it was entered at
+            if (fill < self.fill_low) or (rate < self.bulk_rate/4):
+                return self._switch(self.INTERACTIVE, now)
+            return None
+        wanted = (fill >= self.fill_high) and \
+                 ((rate >= self.bulk_rate) or (request >= self.bulk_request))
+        if not wanted:
+            self.votes = 0
+            return None
+        self.votes += 1
+        if self.votes < self.settle:
+            return None
+        if self.last_change is not None and \
+           (now-self.last_change) < self.min_interval:
+            return None
+        return self._switch(self.BULK, now)
+
+    def expect(self, request):
+        """A command that waits for an answer of 'request' bytes is about
+           to be sent. A small answer switches back to the interactive
+           profile right away. Return the (latency, chunksize) profile to
+           switch to, or None to keep the current one"""
+        if (self.mode == self.BULK) and (request < self.bulk_request):
+            now = time.time()
+            self._start_window(now)
+            return self._switch(self.INTERACTIVE, now)
+        return None
+
+    def _switch(self, mode, now):
+        self.mode = mode
+        self.votes = 0
+        self.last_change = now
+        self.changes += 1
+        return self.profile()
+
+    def _start_window(self, now):
+        self.started = now
+        self.reads = 0
+        self.received = 0
+        self.fill = 0.0
+        self.requested = 0
+
+
 class Ftdi(object):
     """FTDI device driver"""
 
@@ -194,6 +430,8 @@ class Ftdi(object):
     # err:  Error in RCVR FIFO
     MODEM_STATUS = [('_0 _1 _2 _3 cts dsr ri dcd'.split()),
                     ('dr oe pe fe bi thre temt error'.split())]
+    # Line status bits counted as errors when they show up in the data
+    LINE_ERRORS = ('oe', 'pe', 'fe', 'bi', 'error')
 
     # Clocks and baudrates
     BUS_CLOCK_BASE = 6.0E6 # 6 MHz
@@ -208,6 +446,19 @@ class Ftdi(object):
     LATENCY_MIN = 1
     LATENCY_MAX = 255
     LATENCY_THRESHOLD = 1000
+    LATENCY_MARGIN = 10 # ms, for an answer to cross the bus once it is sent
+
+    # Buffers smaller than this are gathered into a single USB write
+    WRITE_GATHER_SIZE = 512
+
+    # Last configuration applied to each interface, keyed by bus, address
+    # and interface. It outlives the Ftdi instances so reopening an
+    # interface doesn't send the same configuration again
+    SHADOWS = {}
+
+    # Divisors already computed, keyed by IC type and requested rate
+    BAUDRATES = {}
+    FREQUENCIES = {}
 
     # Special devices
     LEGACY_DEVICES = ('ft232am', )
@@ -219,9 +470,8 @@ class Ftdi(object):
         self.usb_read_timeout = 5000
         self.usb_write_timeout = 5000
         self.baudrate = -1
-        self.readbuffer = Array('B')
-        self.readoffset = 0
         self.readbuffer_chunksize = 4 << 10 # 4KiB
+        self.readbuffer = RingBuffer(self.readbuffer_chunksize)
         self.writebuffer_chunksize = 4 << 10 # 4KiB
         self.max_packet_size = 0
         self.interface = None
@@ -234,6 +484,17 @@ class Ftdi(object):
         self.latency_min = self.LATENCY_MIN
         self.latency_max = self.LATENCY_MAX
         self.latency_threshold = None # disable dynamic latency
+        self.latency_control = None # disable adaptive latency
+        # the control is fed by the reader and told about the commands by
+        # the writer
+        self.latency_lock = threading.Lock()
+        self.async_reads = 0
+        self.async_reader = None
+        self.shadow = {}
+        # status bytes of the last packet received, see poll_modem_status
+        self.last_status = None
+        self.line_errors = {}
+        self.reset_line_errors()
         self._wrap_api()
 
     # --- Public API -------------------------------------------------------
@@ -245,8 +506,12 @@ class Ftdi(object):
         return UsbTools.find_all(vps, nocache)
 
     def open(self, vendor, product, interface, index=0, serial=None,
-             description=None):
-        """Open a new interface to the specified FTDI device"""
+             description=None, async_reads=0):
+        """Open a new interface to the specified FTDI device.
+           If async_reads is not null, that many bulk IN transfers are kept
+           in flight with the asynchronous libusb API. Devices that do not
+           use the libusb 1.0 backend silently fall back to synchronous
+           reads"""
         self.usb_dev = UsbTools.get_device(vendor, product, index, serial,
                                            description)
         # detect invalid interface as early as possible
@@ -254,12 +519,19 @@ class Ftdi(object):
         if interface > config.bNumInterfaces:
             raise FtdiError('No such FTDI port: %d' % interface)
         self._set_interface(config, interface)
+        self.shadow = Ftdi.SHADOWS.setdefault(self._shadow_key(), {})
         self.max_packet_size = self._get_max_packet_size()
         self._reset_device()
         self.set_latency_timer(self.LATENCY_MIN)
+        self.async_reads = async_reads
+        if async_reads:
+            self._read = self._read_async
+        else:
+            self._read = self._read_sync
 
     def close(self):
         """Close the FTDI interface"""
+        self._stop_async_reader()
         self.set_latency_timer(self.LATENCY_MAX)
         UsbTools.release_device(self.usb_dev)
 
@@ -376,16 +648,19 @@ class Ftdi(object):
         except usb.core.USBError, e:
             raise FtdiError('UsbError: %s' % str(e))
 
-    def set_frequency(self, frequency):
-        return self._set_frequency(frequency)
+    def set_frequency(self, frequency, force=False):
+        return self._set_frequency(frequency, force)
 
     def purge_rx_buffer(self):
-        """Clear the read buffer on the chip and the internal read buffer."""
+        """Clear the read buffer on the chip and the internal read buffer.
+           The purge always reaches the chip, the Artemis sends interrupt
+           data on its own so the buffer is never known to be empty"""
         if self._ctrl_transfer_out(Ftdi.SIO_RESET, Ftdi.SIO_RESET_PURGE_RX):
             raise FtdiError('Unable to flush RX buffer')
         # Invalidate data in the readbuffer
-        self.readoffset = 0
-        self.readbuffer = Array('B')
+        self.readbuffer.clear()
+        if self.async_reader:
+            self.async_reader.flush()
 
     def purge_tx_buffer(self):
         """Clear the write buffer on the chip."""
@@ -408,26 +683,32 @@ class Ftdi(object):
 
     def read_data_set_chunksize(self, chunksize):
         """Configure read buffer chunk size."""
-        # Invalidate all remaining data
-        self.readoffset = 0
-        self.readbuffer = Array('B')
         import sys
         if sys.platform == 'linux':
             if chunksize > 16384:
                 chunksize = 16384
-        self.readbuffer = []
         self.readbuffer_chunksize = chunksize
+        # Invalidate all remaining data
+        self.readbuffer = RingBuffer(max(chunksize, self._largest_chunk()))
+        # the transfers are resized on the next read
+        self._stop_async_reader()
 
     def read_data_get_chunksize(self):
         """Get read buffer chunk size."""
         return self.readbuffer_chunksize
     # --- end of todo section ---------------------
 
-    def set_bitmode(self, bitmask, mode):
-        """Enable/disable bitbang modes."""
+    def set_bitmode(self, bitmask, mode, force=False):
+        """Enable/disable bitbang modes.
+           Skipped if the interface is already in this mode, unless force is
+           set."""
         value = (bitmask & 0xff) | ((mode & self.BITMODE_MASK) << 8)
-        if self._ctrl_transfer_out(Ftdi.SIO_SET_BITMODE, value):
-            raise FtdiError('Unable to set bitmode')
+        if force or self.shadow.get('bitmode') != value:
+            # the clock divisor doesn't survive a mode switch
+            self._invalidate_shadow('bitmode', 'frequency')
+            if self._ctrl_transfer_out(Ftdi.SIO_SET_BITMODE, value):
+                raise FtdiError('Unable to set bitmode')
+            self.shadow['bitmode'] = value
         self.bitbang_mode = mode
 
     def read_pins(self):
@@ -438,15 +719,21 @@ class Ftdi(object):
             raise FtdiError('Unable to read pins')
         return pins[0]
 
-    def set_latency_timer(self, latency):
+    def set_latency_timer(self, latency, force=False):
         """Set latency timer
            The FTDI chip keeps data in the internal buffer for a specific
            amount of time if the buffer is not full yet to decrease
-           load on the usb bus."""
+           load on the usb bus.
+           Skipped if the timer already has this value, unless force is
+           set."""
         if not (Ftdi.LATENCY_MIN <= latency <= Ftdi.LATENCY_MAX):
             raise AssertionError("Latency out of range")
+        if not force and self.shadow.get('latency') == latency:
+            return
+        self._invalidate_shadow('latency')
         if self._ctrl_transfer_out(Ftdi.SIO_SET_LATENCY_TIMER, latency):
             raise FtdiError('Unable to latency timer')
+        self.shadow['latency'] = latency
 
     def get_latency_timer(self):
         """Get latency timer"""
@@ -465,9 +752,14 @@ class Ftdi(object):
         status, = struct.unpack('<H', value)
         return status
 
-    def modem_status(self):
-        """Provide the current modem status as a tuple of set signals"""
-        value = self._ctrl_transfer_in(Ftdi.SIO_POLL_MODEM_STATUS, 2)
+    def modem_status(self, inband=False):
+        """Provide the current modem status as a tuple of set signals
+           If inband is set, the status of the last packet received is used
+           instead of asking the chip, if there was one"""
+        if inband and self.last_status is not None:
+            value = (self.last_status & 0xff, self.last_status >> 8)
+        else:
+            value = self._ctrl_transfer_in(Ftdi.SIO_POLL_MODEM_STATUS, 2)
         if not value or len(value) != 2:
             raise FtdiError('Unable to get modem status')
         status = []
@@ -477,12 +769,28 @@ class Ftdi(object):
                     status.append(Ftdi.MODEM_STATUS[pos][b])
         return tuple(status)
 
-    def set_flowctrl(self, flowctrl):
-        """Set flowcontrol for ftdi chip"""
+    def get_line_errors(self):
+        """Return how many packets received since the counters were reset
+           had each of the line error bits set, in the 'packets' entry how
+           many packets were received. The status bytes come with every
+           packet, this costs no USB transfer"""
+        return dict(self.line_errors)
+
+    def reset_line_errors(self):
+        """Clear the line error counters"""
+        self.line_errors = dict.fromkeys(Ftdi.LINE_ERRORS+('packets',), 0)
+
+    def set_flowctrl(self, flowctrl, force=False):
+        """Set flowcontrol for ftdi chip
+           Skipped if the flow control is already set, unless force is
+           set."""
         ctrl = { 'hw' : Ftdi.SIO_RTS_CTS_HS,
                  'sw' : Ftdi.SIO_XON_XOFF_HS,
                  '' : Ftdi.SIO_DISABLE_FLOW_CTRL }
         value = ctrl[flowctrl] | self.index
+        if not force and self.shadow.get('flowctrl') == value:
+            return
+        self._invalidate_shadow('flowctrl')
         try:
             if self.usb_dev.ctrl_transfer(Ftdi.REQ_OUT,
                                           Ftdi.SIO_SET_FLOW_CTRL, 0,
@@ -490,6 +798,7 @@ class Ftdi(object):
                 raise FtdiError('Unable to set flow control')
         except usb.core.USBError, e:
             raise FtdiError('UsbError: %s' % str(e))
+        self.shadow['flowctrl'] = value
 
     def set_dtr(self, state):
         """Set dtr line"""
@@ -563,19 +872,35 @@ class Ftdi(object):
             raise FtdiError('Unable to set line property')
 
     def write_data(self, data):
-        """Write data in chunks to the chip"""
-        offset = 0
-        size = len(data)
+        """Write data in chunks to the chip. Data may be any object that
+           supports the buffer interface, the chunks are handed over to the
+           USB backend as ranges of its memory without being copied"""
+        return self.write_datav((data,))
+
+    def write_datav(self, buffers):
+        """Write a sequence of buffers to the chip, as if they were
+           concatenated. Small buffers are gathered into a single transfer,
+           large ones are sent from their own memory without being copied"""
+        gathered = Array('B')
+        total = 0
         try:
-            while offset < size:
-                write_size = self.writebuffer_chunksize
-                if offset + write_size > size:
-                    write_size = size - offset
-                length = self._write(data[offset:offset+write_size])
-                if length <= 0:
-                    raise FtdiError("Usb bulk write error")
-                offset += length
-            return offset
+            for data in buffers:
+                owner, address, size = _buffer_info(data)
+                if size < self.WRITE_GATHER_SIZE:
+                    if isinstance(owner, Array) and owner.typecode == 'B':
+                        gathered.extend(owner)
+                    else:
+                        gathered.fromstring(string_at(address, size))
+                    if len(gathered) < self.writebuffer_chunksize:
+                        continue
+                if len(gathered):
+                    total += self._write_gathered(gathered)
+                    gathered = Array('B')
+                if size >= self.WRITE_GATHER_SIZE:
+                    total += self._write_memory(owner, address, size)
+            if len(gathered):
+                total += self._write_gathered(gathered)
+            return total
         except usb.core.USBError, e:
             raise FtdiError('UsbError: %s' % str(e))
 
@@ -583,89 +908,217 @@ class Ftdi(object):
         """Read data in chunks from the chip.
            Automatically strips the two modem status bytes transfered during
            every read."""
+        buf = bytearray(size)
+        count = self._read_data(buf, attempt, False)
+        data = Array('B')
+        data.fromstring(buffer(buf, 0, count))
+        return data
+
+    def read_data_into(self, buf, attempt=1):
+        """Read data from the chip directly into a writable buffer (bytearray
+           or memoryview), without building intermediate arrays.
+           Automatically strips the two modem status bytes transfered during
+           every read. Return the number of bytes written to the buffer: the
+           cached data or whatever a single USB read returned, which may be
+           less than the buffer size."""
+        return self._read_data(buf, attempt, True)
+
+    def read_exact(self, size, deadline=None):
+        """Read size bytes from the chip, waiting for them until deadline, a
+           time.time() value, which defaults to the USB read timeout from
+           now. Every USB read waits at most until the deadline, there is no
+           polling: the chip answers within its latency timer.
+           Return the data as an array and a flag telling whether the
+           deadline passed before all the data was received."""
+        if deadline is None:
+            deadline = time.time()+self.usb_read_timeout/1000.0
+        buf = bytearray(size)
+        dst = memoryview(buf)
+        count = self.readbuffer.read_into(dst)
+        first = True
+        while count < size:
+            payload = self._read_before(deadline, first, size-count)
+            first = False
+            if payload is None:
+                break
+            part_size = min(len(payload), size-count)
+            dst[count:count+part_size] = buffer(payload, 0, part_size)
+            count += part_size
+            if part_size < len(payload):
+                self.readbuffer.write(buffer(payload, part_size))
+        data = Array('B')
+        data.fromstring(buffer(buf, 0, count))
+        return data, count < size
+
+    def read_until(self, byte, deadline=None):
+        """Read from the chip up to and including the first byte of value
+           byte, waiting for it until deadline, see read_exact. What was
+           received after that byte is kept for the next read.
+           Return the data as an array and a flag telling whether the
+           deadline passed before the byte was received."""
+        if deadline is None:
+            deadline = time.time()+self.usb_read_timeout/1000.0
+        marker = chr(byte)
+        data = Array('B')
+        cached = self.readbuffer.peek(len(self.readbuffer)).tostring()
+        index = cached.find(marker)
+        if index >= 0:
+            self.readbuffer.consume(index+1)
+            data.fromstring(cached[:index+1])
+            return data, False
+        self.readbuffer.clear()
+        data.fromstring(cached)
+        first = True
+        while True:
+            payload = self._read_before(deadline, first, 1)
+            first = False
+            if payload is None:
+                return data, True
+            payload = str(payload)
+            index = payload.find(marker)
+            if index >= 0:
+                data.fromstring(payload[:index+1])
+                if index+1 < len(payload):
+                    self.readbuffer.write(buffer(payload, index+1))
+                return data, False
+            data.fromstring(payload)
+
+    def _read_before(self, deadline, first, request):
+        """Do USB reads until some payload is received for a request of
+           request bytes, each one waiting at most until deadline. The first
+           read is done even if the deadline has passed already. Return the
+           payload, or None once the deadline has passed"""
+        try:
+            while True:
+                remaining = deadline-time.time()
+                if remaining <= 0 and not first:
+                    self._empty_read()
+                    return None
+                first = False
+                timeout = min(max(int(remaining*1000), 1),
+                              self.usb_read_timeout)
+                try:
+                    tempbuf = self._read(timeout)
+                except usb.core.USBError, e:
+                    if not self._is_timeout(e):
+                        raise
+                    continue
+                payload = self._received(tempbuf, request)
+                if payload is not None:
+                    return payload
+        except usb.core.USBError, e:
+            raise FtdiError('UsbError: %s' % str(e))
+
+    def _is_timeout(self, error):
+        """Tell whether a USB error is a timeout"""
+        timeout_error = getattr(usb.core, 'USBTimeoutError', None)
+        if timeout_error and isinstance(error, timeout_error):
+            return True
+        return getattr(error, 'errno', None) == errno.ETIMEDOUT
+
+    def _read_data(self, buf, attempt, once):
+        """Fill a writable buffer from the read cache, then from the chip
+           until it is full or no more data is available. If once is set,
+           stop as soon as some data has been copied. Return the number of
+           bytes that were copied"""
         # Packet size sanity check
         if not self.max_packet_size:
             raise FtdiError("max_packet_size is bogus")
-        packet_size = self.max_packet_size
-        length = 1 # initial condition to enter the usb_read loop
-        data = Array('B')
-        # everything we want is still in the cache?
-        if size <= len(self.readbuffer)-self.readoffset:
-            data = self.readbuffer[self.readoffset:self.readoffset+size]
-            self.readoffset += size
-            return data
-        # something still in the cache, but not enough to satisfy 'size'?
-        if len(self.readbuffer)-self.readoffset != 0:
-            data = self.readbuffer[self.readoffset:]
-            # end of readbuffer reached
-            self.readoffset = len(self.readbuffer)
-        # read from USB, filling in the local cache as it is empty
+        dst = memoryview(buf)
+        size = len(dst)
+        # serve whatever is still in the cache
+        count = self.readbuffer.read_into(dst)
+        if once and count:
+            return count
+        # read from USB, the cache is empty at this point
         try:
-            while (len(data) < size) and (length > 0):
-                while True:
-                    tempbuf = self._read()
-                    attempt -= 1
-                    length = len(tempbuf)
-                    # the received buffer contains at least one useful databyte
-                    # (first 2 bytes in each packet represent the current modem
-                    # status)
-                    if length > 2:
-                        if self.latency_threshold:
-                            self.latency_count = 0
-                            if self.latency != self.latency_min:
-                                self.set_latency_timer(self.latency_min)
-                                self.latency = self.latency_min
-                        # skip the status bytes
-                        chunks = (length+packet_size-1) // packet_size
-                        count = packet_size - 2
-                        self.readbuffer = Array('B')
-                        self.readoffset = 0
-                        srcoff = 2
-                        for i in xrange(chunks):
-                            self.readbuffer += tempbuf[srcoff:srcoff+count]
-                            srcoff += packet_size
-                        length = len(self.readbuffer)
-                        break
-                    else:
-                        # received buffer only contains the modem status bytes
-                        # no data received, may be late, try again
-                        if attempt > 0:
-                            continue
-                        # no actual data
-                        self.readbuffer = Array('B')
-                        self.readoffset = 0
-                        if self.latency_threshold:
-                            self.latency_count += 1
-                            if self.latency != self.latency_max:
-                                if self.latency_count > self.latency_threshold:
-                                    self.set_latency_timer(self.latency_max)
-                                    self.latency = self.latency_max
-                        # no more data to read?
-                        return data
-                if length > 0:
-                    # data still fits in buf?
-                    if (len(data) + length) <= size:
-                        data += self.readbuffer[self.readoffset: \
-                                                self.readoffset+length]
-                        self.readoffset += length
-                        # did we read exactly the right amount of bytes?
-                        if len(data) == size:
-                            return data
-                    else:
-                        # partial copy, not enough bytes in the local cache to
-                        # fulfill the request
-                        part_size = min(size-len(data),
-                                        len(self.readbuffer)-self.readoffset)
-                        if part_size < 0:
-                            raise AssertionError("Internal Error")
-                        data += self.readbuffer[self.readoffset:\
-                                                self.readoffset+part_size]
-                        self.readoffset += part_size
-                        return data
+            while count < size:
+                tempbuf = self._read()
+                attempt -= 1
+                payload = self._received(tempbuf, size-count)
+                if payload is None:
+                    # received buffer only contains the modem status bytes
+                    # no data received, may be late, try again
+                    if attempt > 0:
+                        continue
+                    self._empty_read()
+                    # no more data to read
+                    break
+                # copy what fits in the destination, keep the rest in the
+                # cache
+                part_size = min(len(payload), size-count)
+                dst[count:count+part_size] = buffer(payload, 0, part_size)
+                count += part_size
+                if part_size < len(payload):
+                    self.readbuffer.write(buffer(payload, part_size))
+                if once:
+                    break
         except usb.core.USBError, e:
             raise FtdiError('UsbError: %s' % str(e))
-        # never reached
-        raise FtdiError("Internal error")
+        return count
+
+    def _received(self, tempbuf, request):
+        """Account for a USB read done to serve a request of request bytes.
+           Return its payload, or None if it only had the modem status
+           bytes"""
+        if self.latency_control:
+            self._adapt_latency(request, len(tempbuf))
+        if len(tempbuf) >= 2:
+            self._track_status(tempbuf)
+        if len(tempbuf) <= 2:
+            return None
+        if self.latency_threshold:
+            self.latency_count = 0
+            if self.latency != self.latency_min:
+                self.set_latency_timer(self.latency_min)
+                self.latency = self.latency_min
+        return self._strip_status(tempbuf)
+
+    def _empty_read(self):
+        """Nothing was received in time, raise the latency timer once it
+           happened often enough"""
+        if self.latency_threshold:
+            self.latency_count += 1
+            if self.latency != self.latency_max:
+                if self.latency_count > self.latency_threshold:
+                    self.set_latency_timer(self.latency_max)
+                    self.latency = self.latency_max
+
+    def _track_status(self, data):
+        """Keep the status bytes of the last packet of a USB read, and count
+           the packets whose line status has error bits. The line status
+           bytes are picked with an extended slice and the error bits are
+           masked with a translation table, only packets with errors are
+           looked at one by one"""
+        packet_size = self.max_packet_size
+        last = ((len(data)-1)//packet_size)*packet_size
+        self.last_status = data[last] | (data[last+1] << 8)
+        self.line_errors['packets'] += last//packet_size+1
+        errors = data[1::packet_size].tostring().translate(_LINE_ERRORS)
+        if not errors.strip('\0'):
+            return
+        for error in errors:
+            line = ord(error)
+            if not line:
+                continue
+            for bit, name in enumerate(Ftdi.MODEM_STATUS[1]):
+                if line & (1 << bit):
+                    self.line_errors[name] += 1
+
+    def _strip_status(self, data):
+        """Remove the two modem status bytes from the start of every packet
+           of a USB read. Both status bytes are dropped with an extended
+           slice deletion, a single pass over the data each, rather than
+           growing an array packet by packet. Return a buffer object"""
+        packet_size = self.max_packet_size
+        if len(data) <= packet_size:
+            return buffer(data, 2)
+        payload = bytearray(buffer(data))
+        # first status byte of every packet, then the second one which is
+        # now at the start of packets one byte shorter
+        del payload[::packet_size]
+        del payload[::packet_size-1]
+        return payload
 
     def read_data(self, size):
         """Read data in chunks from the chip.
@@ -673,28 +1126,36 @@ class Ftdi(object):
            every read."""
         return self.read_data_bytes(size).tostring()
 
-    def get_cts(self):
+    def get_cts(self, inband=False):
         """Read terminal status line: Clear To Send"""
-        status = self.poll_modem_status()
+        status = self._modem_status(inband)
         return (status & self.MODEM_CTS) and True or False
 
-    def get_dsr(self):
+    def get_dsr(self, inband=False):
         """Read terminal status line: Data Set Ready"""
-        status = self.poll_modem_status()
+        status = self._modem_status(inband)
         return (status & self.MODEM_DSR) and True or False
 
-    def get_ri(self):
+    def get_ri(self, inband=False):
         """Read terminal status line: Ring Indicator"""
-        status = self.poll_modem_status()
+        status = self._modem_status(inband)
         return (status & self.MODEM_RI) and True or False
 
-    def get_cd(self):
+    def get_cd(self, inband=False):
         """Read terminal status line: Carrier Detect"""
-        status = self.poll_modem_status()
+        status = self._modem_status(inband)
         return (status & self.MODEM_RLSD) and True or False
 
+    def _modem_status(self, inband):
+        """Status bytes of the last packet received if inband is set and
+           there was one, otherwise ask the chip"""
+        if inband and self.last_status is not None:
+            return self.last_status
+        return self.poll_modem_status()
+
     def set_dynamic_latency(self, lmin, lmax, threshold):
         """Set up or disable latency values"""
+        self.latency_control = None
         if not threshold:
             self.latency_count = 0
             self.latency_threshold = None
@@ -708,11 +1169,63 @@ class Ftdi(object):
             self.latency = lmax
             self.set_latency_timer(self.latency)
 
+    def set_adaptive_latency(self, control):
+        """Let an AdaptiveLatency pick the latency timer and the read chunk
+           size from the workload, or disable it if control is None"""
+        self.latency_control = control
+        if control:
+            # the ring holds what is left of the largest read of the control
+            if self._largest_chunk() > self.readbuffer.capacity:
+                readbuffer = RingBuffer(self._largest_chunk())
+                readbuffer.write(self.readbuffer.read(len(self.readbuffer)))
+                self.readbuffer = readbuffer
+            self.latency_count = 0
+            self.latency_threshold = None
+            self._apply_latency_profile(*control.profile())
+
+    def expect_response(self, size):
+        """Tell the adaptive latency control that a command waiting for an
+           answer of 'size' bytes is about to be written"""
+        control = self.latency_control
+        if control:
+            with self.latency_lock:
+                profile = control.expect(size)
+                if profile:
+                    self._apply_latency_profile(*profile)
+
+    def _adapt_latency(self, request, received):
+        """Feed a USB read to the adaptive latency control"""
+        with self.latency_lock:
+            profile = self.latency_control.sample(request, received,
+                                                  self.readbuffer_chunksize)
+            if profile:
+                self._apply_latency_profile(*profile)
+
+    def _largest_chunk(self):
+        """Largest read chunk size the adaptive latency can switch to"""
+        if not self.latency_control:
+            return 0
+        return max([chunk for latency, chunk in
+                    self.latency_control.profiles.values()])
+
+    def _apply_latency_profile(self, latency, chunksize):
+        """Switch the latency timer and the read chunk size, the data in the
+           read cache is kept"""
+        self.set_latency_timer(latency)
+        self.latency = latency
+        # the transfers of the asynchronous reader have a fixed size
+        if not self.async_reads:
+            self.readbuffer_chunksize = chunksize
+
     def validate_mpsse(self):
         # only useful in MPSSE mode
-        bytes_ = self.read_data(2)
-        if (len(bytes_) >=2 ) and (bytes_[0] == '\xfa'):
-            raise FtdiError("Invalid command @ %d" % ord(bytes_[1]))
+        # the chip holds the bad command answer until its latency timer
+        # runs out
+        latency = self.shadow.get('latency', Ftdi.LATENCY_MAX)
+        deadline = time.time()+(latency+Ftdi.LATENCY_MARGIN)/1000.0
+        bytes_, timed_out = self.read_exact(2, deadline)
+        if (len(bytes_) >=2 ) and (bytes_[0] == 0xfa):
+            raise FtdiError("Invalid command @ %d" % bytes_[1])
 
     def get_error_string(self):
         """Wrapper for libftdi compatibility"""
@@ -731,6 +1244,14 @@ class Ftdi(object):
             usb_api = 2
         for m in ('write', 'read'):
             setattr(self, '_%s' % m, getattr(self, '_%s_v%d' % (m, usb_api)))
+        # writing straight from memory goes around usb.core.Device.write, to
+        # the internals of pyusb
+        manager = getattr(usb.core, '_ResourceManager', None)
+        if (usb_api == 2) and hasattr(manager, 'setup_request'):
+            self._write_slice = self._write_slice_v2
+        else:
+            self._write_slice = self._write_slice_copy
+        self._read_sync = self._read
 
     def _set_interface(self, config, ifnum):
         """Select the interface to use on the FTDI device"""
@@ -752,8 +1273,22 @@ class Ftdi(object):
         if self._ctrl_transfer_out(Ftdi.SIO_RESET, Ftdi.SIO_RESET_SIO):
             raise FtdiError('Unable to reset FTDI device')
         # Invalidate data in the readbuffer
-        self.readoffset = 0
-        self.readbuffer = Array('B')
+        self.readbuffer.clear()
+
+    def _shadow_key(self):
+        """Identify the interface, a device gets a new address when it is
+           plugged in again"""
+        bus = getattr(self.usb_dev, 'bus', None)
+        address = getattr(self.usb_dev, 'address', None)
+        if bus is None or address is None:
+            return (id(self.usb_dev), self.index)
+        return (bus, address, self.index)
+
+    def _invalidate_shadow(self, *names):
+        """Forget settings, the state of the chip is unknown until they are
+           applied successfully"""
+        for name in names:
+            self.shadow.pop(name, None)
 
     def _ctrl_transfer_out(self, reqtype, value, data=''):
         """Send a control message to the device"""
@@ -778,19 +1313,75 @@ class Ftdi(object):
         return self.usb_dev.write(self.in_ep, data,
                                  self.interface, self.usb_write_timeout)
 
-    def _read_v1(self):
+    def _read_v1(self, timeout=None):
         """Read from FTDI, using the deprecated API"""
         return self.usb_dev.read(self.out_ep, self.readbuffer_chunksize,
-                                 self.interface, self.usb_read_timeout)
+                                 self.interface,
+                                 timeout or self.usb_read_timeout)
 
     def _write_v2(self, data):
         """Write to FTDI, using the API introduced with pyusb 1.0.0b2"""
         return self.usb_dev.write(self.in_ep, data, self.usb_write_timeout)
 
-    def _read_v2(self):
+    def _write_slice_copy(self, data):
+        """Write a range of memory to FTDI with the public API of pyusb,
+           which needs a copy of it"""
+        copy = Array('B')
+        copy.fromstring(string_at(data.address, data.length))
+        return self._write(copy)
+
+    def _write_slice_v2(self, data):
+        """Write a range of memory to FTDI, straight to the backend as
+           usb.core.Device.write would otherwise copy it into an array"""
+        ctx = self.usb_dev._ctx
+        intf, ep = ctx.setup_request(self.usb_dev, self.in_ep)
+        return ctx.backend.bulk_write(ctx.handle, ep.bEndpointAddress,
+                                      intf.bInterfaceNumber, data,
+                                      self.usb_write_timeout)
+
+    def _write_gathered(self, data):
+        address, count = data.buffer_info()
+        return self._write_memory(data, address, count)
+
+    def _write_memory(self, owner, address, size):
+        """Write a range of memory in chunks to the chip"""
+        offset = 0
+        while offset < size:
+            write_size = min(self.writebuffer_chunksize, size-offset)
+            length = self._write_slice(_BufferSlice(owner, address+offset,
+                                                    write_size))
+            if length <= 0:
+                raise FtdiError("Usb bulk write error")
+            offset += length
+        return offset
+
+    def _read_v2(self, timeout=None):
         """Read from FTDI, using the API introduced with pyusb 1.0.0b2"""
         return self.usb_dev.read(self.out_ep, self.readbuffer_chunksize,
-                                 self.usb_read_timeout)
+                                 timeout or self.usb_read_timeout)
+
+    def _read_async(self, timeout=None):
+        """Read from FTDI, using the transfers that are kept in flight by the
+           asynchronous reader"""
+        if not self.async_reader:
+            try:
+                reader = AsyncBulkReader(self.usb_dev, self.out_ep,
+                                         self.readbuffer_chunksize,
+                                         self.async_reads,
+                                         self.usb_read_timeout)
+            except NotImplementedError:
+                # only libusb 1.0 supports asynchronous transfers
+                self.async_reads = 0
+                self._read = self._read_sync
+                return self._read(timeout)
+            reader.start()
+            self.async_reader = reader
+        return self.async_reader.read(timeout or self.usb_read_timeout)
+
+    def _stop_async_reader(self):
+        if self.async_reader:
+            self.async_reader.stop()
+            self.async_reader = None
 
     def _get_max_packet_size(self):
         """Retrieve the maximum length of a data packet"""
@@ -808,7 +1399,21 @@ class Ftdi(object):
 
     def _convert_baudrate(self, baudrate):
         """Convert a requested baudrate into the closest possible baudrate
-           that can be assigned to the FTDI device"""
+           that can be assigned to the FTDI device
+           The divisors only depend on the IC type, they are computed once"""
+        key = (self.ic_name, baudrate)
+        try:
+            best_baud, value, index = Ftdi.BAUDRATES[key]
+        except KeyError:
+            best_baud, value, index = self._compute_baudrate(baudrate)
+            Ftdi.BAUDRATES[key] = (best_baud, value, index)
+        if self.ic_name in self.EXSPEED_DEVICES + self.HISPEED_DEVICES:
+            index |= self.index
+        return (best_baud, value, index)
+
+    def _compute_baudrate(self, baudrate):
+        """Compute the divisor of a baudrate, the interface is not part of
+           the returned index"""
         if baudrate < ((2*self.BAUDRATE_REF_BASE)//(2*16384+1)):
             raise AssertionError('Invalid baudrate (too low)')
         if baudrate > self.BAUDRATE_REF_BASE:
@@ -886,17 +1491,46 @@ class Ftdi(object):
         if self.ic_name in self.EXSPEED_DEVICES + self.HISPEED_DEVICES:
             index = (encoded_divisor >> 8) & 0xFFFF
             index &= 0xFF00
-            index |= self.index
         else:
             index = (encoded_divisor >> 16) & 0xFFFF
         if hispeed:
             index |= 1<<9 # use hispeed mode
         return (best_baud, value, index)
 
-    def _set_frequency(self, frequency):
-        """Convert a frequency value into a TCK divisor setting"""
+    def _set_frequency(self, frequency, force=False):
+        """Convert a frequency value into a TCK divisor setting
+           Skipped if the same frequency was set already, unless force is
+           set."""
         if frequency > self.frequency_max:
             raise FtdiError("Unsupported frequency: %f" % frequency)
+        shadow = self.shadow.get('frequency')
+        if not force and shadow and shadow[0] == frequency:
+            return shadow[1]
+        self._invalidate_shadow('frequency')
+        divcode, cmd, actual_freq = self._frequency_command(frequency)
+        if divcode is not None and \
+           (force or not shadow or shadow[2] != divcode):
+            cmd = Array('B', [divcode]) + cmd
+        self.write_data(cmd)
+        if force or not shadow:
+            # first clock setting since the mode was set, check that the
+            # engine took it. Later ones only change the divisor
+            self.validate_mpsse()
+            # Drain input buffer
+            self.purge_rx_buffer()
+        self.shadow['frequency'] = (frequency, actual_freq, divcode)
+        return actual_freq
+
+    def _frequency_command(self, frequency):
+        """Return the clock divide by 5 command, None if the device does not
+           have one, the TCK divisor command and the actual frequency of a
+           clock frequency. They are computed once per IC type"""
+        hispeed = self.ic_name in self.HISPEED_DEVICES
+        key = (hispeed, frequency)
+        try:
+            return Ftdi.FREQUENCIES[key]
+        except KeyError:
+            pass
         if frequency <= Ftdi.BUS_CLOCK_BASE:
             divcode = Ftdi.ENABLE_CLK_DIV5
             divisor = int(Ftdi.BUS_CLOCK_BASE/frequency)-1
@@ -909,17 +1543,12 @@ class Ftdi(object):
             actual_freq = Ftdi.BUS_CLOCK_HIGH/(divisor+1)
         else:
             raise FtdiError("Unsupported frequency: %f" % frequency)
+        if not hispeed:
+            divcode = None
         # FTDI expects little endian
-        if self.ic_name in self.HISPEED_DEVICES:
-            cmd = Array('B', [divcode])
-        else:
-            cmd = Array('B')
-        cmd.extend([Ftdi.TCK_DIVISOR, divisor&0xff, (divisor>>8)&0xff])
-        self.write_data(cmd)
-        self.validate_mpsse()
-        # Drain input buffer
-        self.purge_rx_buffer()
-        return actual_freq
+        cmd = Array('B', [Ftdi.TCK_DIVISOR, divisor&0xff, (divisor>>8)&0xff])
+        Ftdi.FREQUENCIES[key] = (divcode, cmd, actual_freq)
+        return Ftdi.FREQUENCIES[key]
 
     def __get_timeouts(self):
         return self.usb_read_timeout, self.usb_write_timeout
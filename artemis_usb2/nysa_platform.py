@@ -26,15 +26,17 @@ __author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
 
 import sys
 import os
+import time
+import threading
 import subprocess
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from nysa.host.nysa_platform import Platform
 from nysa.host.nysa_platform import SYSTEM_NAME
 from nysa.host.nysa_platform import SYSTEM_DIST
 
-import usb.core
-import usb.util
-from ftdi import Ftdi
+from usbtools import UsbTools
 
 sys.path.append(os.path.join(os.path.dirname(__file__),
                              os.pardir,
@@ -44,27 +46,163 @@ import nysa
 from nysa.ibuilder.lib.xilinx_utils import find_xilinx_path
 from artemis_usb2 import Artemis
 
+#Seconds a board is given to open and reset during a scan
+ARTEMIS_SCAN_TIMEOUT = 10.0
+#Most boards that are opened at the same time
+ARTEMIS_SCAN_WORKERS = 16
+
+class _OpenTask(object):
+    """
+    Open one board for a scan. When the scan gave up on the board the task
+    closes it as soon as it is open, so no threads or FTDI handles are left
+    behind without an owner
+    """
+
+    def __init__(self, vendor, product, sernum, status):
+        self.vendor = vendor
+        self.product = product
+        self.sernum = sernum
+        self.status = status
+        self.lock = threading.Lock()
+        self.abandoned = False
+        self.device = None
+
+    def __call__(self):
+        device = Artemis(idVendor = self.vendor,
+                         idProduct = self.product,
+                         sernum = self.sernum,
+                         status = self.status)
+        with self.lock:
+            if not self.abandoned:
+                self.device = device
+                return device
+        device.close()
+        return None
+
+    def abandon(self):
+        """
+        Give up on the board, returns the board if it opened in the meantime
+        """
+        with self.lock:
+            self.abandoned = self.device is None
+            return self.device
+
+
 class ArtemisUSB2Platform(Platform):
 
     def __init__(self, status = None):
         super (ArtemisUSB2Platform, self).__init__(status)
         self.vendor = 0x0403
         self.product = 0x8531
+        self.scan_errors = {}
 
     def get_type(self):
         return "artemis_usb2"
 
-    def scan(self):
+    def scan(self, lazy = True, parallel = True, timeout = ARTEMIS_SCAN_TIMEOUT):
+        """
+        Find all the Artemis boards that are connected
+
+        By default only the serial numbers and the locations ('location',
+        bus and hub ports) of the boards are read, a board is opened and
+        reset by its first command. Use 'close_idle' to close the boards
+        that are not used anymore
+
+        With 'lazy' False every board is opened and reset right away, which
+        takes about half a second, in parallel they all take about as long
+        as one. A board that fails or does not answer within 'timeout'
+        seconds is reported and left out, the failures of the last scan are
+        in 'scan_errors'
+
+        Args:
+            lazy (Boolean): open the boards on their first command
+            parallel (Boolean): open the boards at the same time
+            timeout (Float): seconds a board is given to open
+
+        Returns (Dictionary):
+            The boards by serial number
+        """
         self.status.Verbose("Scanning")
-        devices = usb.core.find(find_all = True)
-        for device in devices:
-            if device.idVendor == self.vendor and device.idProduct == self.product:
-                self.add_device_dict(device.serial_number, Artemis(idVendor = self.vendor,
-                                                      idProduct = self.product,
-                                                      sernum = device.serial_number,
-                                                      status = self.status))
+        self.scan_errors = {}
+        boards = UsbTools.find_locations([(self.vendor, self.product)],
+                                         nocache = True)
+        if lazy:
+            for sernum, location in boards:
+                device = Artemis(idVendor = self.vendor,
+                                 idProduct = self.product,
+                                 sernum = sernum,
+                                 status = self.status,
+                                 lazy = True)
+                device.location = location
+                self.add_device_dict(sernum, device)
+            return self.dev_dict
+
+        serials = [sernum for sernum, location in boards]
+        if len(serials) == 0:
+            return self.dev_dict
+
+        workers = 1
+        if parallel:
+            workers = min(len(serials), ARTEMIS_SCAN_WORKERS)
+        pool = ThreadPool(workers)
+        start = time.time()
+        tasks = []
+        results = []
+        timed_out = False
+        for sernum in serials:
+            task = _OpenTask(self.vendor, self.product, sernum, self.status)
+            tasks.append(task)
+            results.append(pool.apply_async(task))
+        pool.close()
+
+        for i in range(len(serials)):
+            #A board waits for the ones queued before it
+            deadline = start + timeout * (i / workers + 1)
+            try:
+                device = results[i].get(max(deadline - time.time(), 0))
+            except TimeoutError as ex:
+                device = tasks[i].abandon()
+                if device is None:
+                    self.status.Error("Artemis %s did not open within %.1f seconds" %
+                                      (serials[i], timeout))
+                    self.scan_errors[serials[i]] = ex
+                    timed_out = True
+                    continue
+            except Exception as ex:
+                self.status.Error("Failed to open Artemis %s: %s" %
+                                  (serials[i], str(ex)))
+                self.scan_errors[serials[i]] = ex
+                continue
+            device.location = boards[i][1]
+            self.add_device_dict(serials[i], device)
+
+        #A board that timed out still holds a thread of the pool, don't wait
+        #for it, the board is closed by its task when it is done
+        if timed_out:
+            pool.terminate()
+        else:
+            pool.join()
         return self.dev_dict
 
+    def close_idle(self, idle = 0):
+        """
+        Close the boards that did not get a command for 'idle' seconds, they
+        are opened again by their next command
+
+        Args:
+            idle (Float): seconds without a command
+
+        Returns:
+            Nothing
+        """
+        now = time.time()
+        for device in self.dev_dict.values():
+            if not device.is_open():
+                continue
+            if (device.last_used is None) or (now - device.last_used >= idle):
+                self.status.Verbose("Closing idle Artemis %s" % device.sernum)
+                device.close()
+
     def test_build_tools(self):
         if find_xilinx_path() is None:
             return False
@@ -174,9 +174,15 @@ class SpiController(object):
             cmd.extend(self._cs_high)
             self._ftdi.write_data(cmd)
             # USB read cycle may occur before the FTDI device has actually
-            # sent the data, so try to read more than once if no data is
-            # actually received
-            data = self._ftdi.read_data_bytes(readlen, 4)
+            # sent the data, so wait for it up to the USB read timeout
+            data, timed_out = self._ftdi.read_exact(readlen)
+            if timed_out:
+                # what is still on its way would be taken as the answer of
+                # the next transaction
+                self._flush()
+                raise SpiIOError("Timed out waiting for the SPI slave, "
+                                 "%d of %d bytes received" %
+                                 (len(data), readlen))
         else:
             cmd = Array('B', cs_cmd)
             cmd.fromstring(write_cmd)
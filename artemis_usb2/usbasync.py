@@ -0,0 +1,303 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+"""Asynchronous bulk IN transfers
+
+Keeps several bulk IN transfers queued on an endpoint with the asynchronous
+API of libusb 1.0, so the device is drained while Python is busy with
+something else. pyusb doesn't expose this API, the libusb 1.0 backend of
+pyusb is used directly.
+"""
+
+import errno
+import threading
+import collections
+from array import array as Array
+from ctypes import Structure, POINTER, byref, cast, addressof, string_at, \
+                   c_long, c_int, c_void_p, c_ubyte
+
+import usb
+import usb.core
+
+try:
+    import usb.backend.libusb1 as libusb1
+except ImportError:
+    libusb1 = None
+
+from artemis_event import ArtemisEvent
+
+
+__all__ = ['AsyncBulkReader']
+
+
+# Oldest pyusb whose libusb 1.0 backend has the internals used here
+PYUSB_MIN_VERSION = (1, 0, 0)
+# What is used of the libusb 1.0 backend of pyusb, it is not part of the
+# API of pyusb
+_LIBUSB1_NAMES = ('_LibUSB', '_libusb_transfer_p', '_libusb_transfer_cb_fn_p',
+                  '_LIBUSB_TRANSFER_TYPE_BULK', 'LIBUSB_TRANSFER_COMPLETED',
+                  'LIBUSB_TRANSFER_TIMED_OUT', 'LIBUSB_TRANSFER_CANCELLED',
+                  '_str_transfer_error', '_transfer_errno')
+
+
+def _check_pyusb(usb_dev):
+    """Raise NotImplementedError unless the device uses the libusb 1.0
+       backend of a pyusb that has the internals this module relies on"""
+    if libusb1 is None:
+        raise NotImplementedError('libusb 1.0 backend is not available')
+    version = getattr(usb, 'version_info', None)
+    if (version is None) or (tuple(version[:3]) < PYUSB_MIN_VERSION):
+        raise NotImplementedError('pyusb %s is too old for asynchronous '
+                                  'transfers' % (version,))
+    missing = [name for name in _LIBUSB1_NAMES
+               if not hasattr(libusb1, name)]
+    ctx = getattr(usb_dev, '_ctx', None)
+    if missing or not hasattr(ctx, 'managed_open') or \
+       not hasattr(ctx, 'backend'):
+        raise NotImplementedError('Unknown libusb 1.0 backend of pyusb %s'
+                                  % (version,))
+    if not isinstance(ctx.backend, libusb1._LibUSB):
+        raise NotImplementedError('Asynchronous transfers need the '
+                                  'libusb 1.0 backend')
+
+
+class _timeval(Structure):
+    _fields_ = [('tv_sec', c_long),
+                ('tv_usec', c_long)]
+
+
+class AsyncBulkReader(object):
+    """Reader of a bulk IN endpoint with a number of transfers in flight.
+       Completed transfers are queued until they are read, when too many are
+       waiting the transfers are parked so the device is throttled"""
+
+    # Time the event thread waits for events before checking if it should
+    # stop, in microseconds
+    EVENT_TIMEOUT = 100000
+    # Completed transfers that can wait to be read, for each transfer
+    QUEUE_FACTOR = 4
+    # Time flush waits for the cancelled transfers to complete, in
+    # milliseconds
+    FLUSH_TIMEOUT = 1000
+
+    def __init__(self, usb_dev, endpoint, size, count, timeout):
+        """Prepare 'count' transfers of 'size' bytes each on the endpoint.
+           Raise NotImplementedError if the device does not use the libusb
+           1.0 backend, or if the backend is not one this module knows"""
+        _check_pyusb(usb_dev)
+        backend = usb_dev._ctx.backend
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+        self._handle = usb_dev._ctx.managed_open()
+        if not hasattr(self._handle, 'handle'):
+            raise NotImplementedError('Unknown device handle of pyusb')
+        self._endpoint = endpoint
+        self._size = size
+        self._timeout = timeout
+        self._max_queued = count*self.QUEUE_FACTOR
+        self._lib.libusb_cancel_transfer.argtypes = [libusb1._libusb_transfer_p]
+        self._lib.libusb_cancel_transfer.restype = c_int
+        self._lib.libusb_handle_events_timeout.argtypes = [c_void_p,
+                                                          POINTER(_timeval)]
+        self._lib.libusb_handle_events_timeout.restype = c_int
+        # keep a reference to the callback, libusb only has a pointer to it
+        self._callback_fn = libusb1._libusb_transfer_cb_fn_p(self._callback)
+        self._transfers = []
+        self._buffers = []
+        self._index = {}
+        for _ in xrange(count):
+            transfer = self._lib.libusb_alloc_transfer(0)
+            if not transfer:
+                self._free()
+                raise usb.core.USBError('Unable to allocate a transfer')
+            buf = (c_ubyte*size)()
+            contents = transfer.contents
+            contents.dev_handle = self._handle.handle
+            contents.flags = 0
+            contents.endpoint = endpoint
+            contents.type = libusb1._LIBUSB_TRANSFER_TYPE_BULK
+            contents.timeout = timeout
+            contents.buffer = cast(buf, c_void_p)
+            contents.length = size
+            contents.num_iso_packets = 0
+            contents.callback = self._callback_fn
+            self._index[addressof(contents)] = len(self._transfers)
+            self._transfers.append(transfer)
+            self._buffers.append(buf)
+        self._queue = collections.deque()
+        self._parked = []
+        self._pending = 0
+        self._error = None
+        self._running = False
+        # Set while flush waits for the transfers in flight
+        self._flushing = False
+        self._lock = threading.Lock()
+        # Waiting on a condition with a timeout polls on Python 2, the waits
+        # are on events that don't. Set when there is something to read
+        self._ready = ArtemisEvent()
+        # Set when no transfer is in flight
+        self._idle = ArtemisEvent()
+        self._idle.set()
+        self._thread = None
+
+    def start(self):
+        """Submit all the transfers and start handling their completion"""
+        with self._lock:
+            self._running = True
+            for transfer in self._transfers:
+                self._submit(transfer)
+        self._thread = threading.Thread(target=self._handle_events)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Cancel the transfers and wait for them to complete"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._parked = []
+            for transfer in self._transfers:
+                self._lib.libusb_cancel_transfer(transfer)
+            self._update_ready()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._free()
+
+    def read(self, timeout):
+        """Return the content of the oldest completed transfer as an array,
+           status-only transfers included. Wait at most 'timeout' ms"""
+        self._ready.wait(timeout/1000.0)
+        with self._lock:
+            if len(self._queue):
+                data = self._queue.popleft()
+                if self._parked:
+                    self._submit(self._parked.pop())
+                self._update_ready()
+                return data
+            if self._error is not None:
+                raise self._error
+            if not self._running:
+                raise usb.core.USBError('Asynchronous reader is stopped')
+            raise usb.core.USBError('Operation timed out', None,
+                                    errno.ETIMEDOUT)
+
+    def flush(self):
+        """Drop the data received so far. The transfers in flight can hold
+           data from before the flush, they are cancelled and submitted
+           again. Raise USBError if they are not done within FLUSH_TIMEOUT
+           ms, the reader is unusable then"""
+        with self._lock:
+            self._queue.clear()
+            if not self._running:
+                return
+            self._flushing = True
+            for transfer in self._transfers:
+                self._lib.libusb_cancel_transfer(transfer)
+        if not self._idle.wait(self.FLUSH_TIMEOUT/1000.0):
+            with self._lock:
+                if self._pending:
+                    self._error = usb.core.USBError(
+                        'Transfers were not cancelled', None, errno.ETIMEDOUT)
+                    self._update_ready()
+                    raise self._error
+        with self._lock:
+            self._flushing = False
+            self._queue.clear()
+            while self._parked:
+                self._submit(self._parked.pop())
+            self._update_ready()
+
+    def _submit(self, transfer):
+        # Call with the lock held
+        rc = self._lib.libusb_submit_transfer(transfer)
+        if rc:
+            self._error = usb.core.USBError('Unable to submit a transfer',
+                                            rc)
+            self._update_ready()
+            return
+        self._pending += 1
+        self._idle.clear()
+
+    def _update_ready(self):
+        # Call with the lock held
+        if len(self._queue) or (self._error is not None) or \
+           not self._running:
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    def _callback(self, transfer):
+        # Called from whichever thread handles the libusb events
+        contents = transfer.contents
+        status = contents.status
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._idle.set()
+            if self._flushing:
+                # whatever the transfer holds is dropped, flush submits it
+                # again
+                if status in (libusb1.LIBUSB_TRANSFER_COMPLETED,
+                              libusb1.LIBUSB_TRANSFER_TIMED_OUT,
+                              libusb1.LIBUSB_TRANSFER_CANCELLED):
+                    self._parked.append(
+                        self._transfers[self._index[addressof(contents)]])
+                else:
+                    self._error = self._transfer_error(status)
+                    self._update_ready()
+                return
+            if status in (libusb1.LIBUSB_TRANSFER_COMPLETED,
+                          libusb1.LIBUSB_TRANSFER_TIMED_OUT):
+                length = contents.actual_length
+                # a status-only transfer is only a sign of life, there's no
+                # need to queue more than one of them
+                if (length > 2) or not len(self._queue):
+                    data = Array('B')
+                    data.fromstring(string_at(contents.buffer, length))
+                    self._queue.append(data)
+                    self._ready.set()
+                if not self._running:
+                    return
+                transfer = self._transfers[self._index[addressof(contents)]]
+                if len(self._queue) >= self._max_queued:
+                    self._parked.append(transfer)
+                else:
+                    self._submit(transfer)
+            elif status != libusb1.LIBUSB_TRANSFER_CANCELLED:
+                self._error = self._transfer_error(status)
+                self._ready.set()
+
+    def _transfer_error(self, status):
+        return usb.core.USBError(libusb1._str_transfer_error[status], status,
+                                 libusb1._transfer_errno[status])
+
+    def _handle_events(self):
+        tv = _timeval(0, self.EVENT_TIMEOUT)
+        while True:
+            with self._lock:
+                if not self._running and not self._pending:
+                    return
+            self._lib.libusb_handle_events_timeout(self._ctx, byref(tv))
+
+    def _free(self):
+        for transfer in self._transfers:
+            self._lib.libusb_free_transfer(transfer)
+        self._transfers = []
+        self._buffers = []
+        self._index = {}
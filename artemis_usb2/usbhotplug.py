@@ -0,0 +1,149 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+"""USB hotplug notifications
+
+Collects the arrival and removal of USB devices with the hotplug API of
+libusb 1.0 (libusb >= 1.0.16), so the device cache of UsbTools can follow
+the bus without enumerating it again. pyusb doesn't expose this API, the
+libusb 1.0 backend of pyusb is used directly.
+"""
+
+import threading
+import collections
+from ctypes import CFUNCTYPE, POINTER, byref, c_int, c_void_p
+
+try:
+    import usb.backend.libusb1 as libusb1
+except ImportError:
+    libusb1 = None
+
+from usbasync import _timeval
+
+
+__all__ = ['HotplugMonitor']
+
+
+LIBUSB_CAP_HAS_HOTPLUG = 0x0001
+LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED = 0x01
+LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT = 0x02
+LIBUSB_HOTPLUG_MATCH_ANY = -1
+
+_libusb_hotplug_callback_fn = CFUNCTYPE(c_int, c_void_p, c_void_p, c_int,
+                                        c_void_p)
+
+
+class HotplugMonitor(object):
+    """Queue of the devices that arrived on or left the bus. The events are
+       only collected, libusb does not allow the callback to do any I/O,
+       the owner of the monitor applies them when it is convenient"""
+
+    # Time the event thread waits for events before checking if it should
+    # stop, in microseconds
+    EVENT_TIMEOUT = 100000
+
+    def __init__(self, backend):
+        """Raise NotImplementedError if the backend is not libusb 1.0 or if
+           libusb does not support hotplug on this platform"""
+        if libusb1 is None:
+            raise NotImplementedError('libusb 1.0 backend is not available')
+        if not isinstance(backend, libusb1._LibUSB):
+            raise NotImplementedError('Hotplug needs the libusb 1.0 backend')
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+        try:
+            self._lib.libusb_has_capability.argtypes = [c_int]
+            self._lib.libusb_has_capability.restype = c_int
+            register = self._lib.libusb_hotplug_register_callback
+            deregister = self._lib.libusb_hotplug_deregister_callback
+        except AttributeError:
+            raise NotImplementedError('libusb is too old for hotplug')
+        if not self._lib.libusb_has_capability(LIBUSB_CAP_HAS_HOTPLUG):
+            raise NotImplementedError('Hotplug is not supported')
+        register.argtypes = [c_void_p, c_int, c_int, c_int, c_int, c_int,
+                             _libusb_hotplug_callback_fn, c_void_p,
+                             POINTER(c_int)]
+        register.restype = c_int
+        deregister.argtypes = [c_void_p, c_int]
+        self._lib.libusb_handle_events_timeout.argtypes = [c_void_p,
+                                                          POINTER(_timeval)]
+        self._lib.libusb_handle_events_timeout.restype = c_int
+        # keep a reference to the callback, libusb only has a pointer to it
+        self._callback_fn = _libusb_hotplug_callback_fn(self._callback)
+        self._handle = None
+        self._events = collections.deque()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Register for the events and start handling them"""
+        handle = c_int()
+        rc = self._lib.libusb_hotplug_register_callback(
+            self._ctx,
+            LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED |
+            LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT,
+            0, LIBUSB_HOTPLUG_MATCH_ANY, LIBUSB_HOTPLUG_MATCH_ANY,
+            LIBUSB_HOTPLUG_MATCH_ANY, self._callback_fn, None, byref(handle))
+        if rc:
+            raise NotImplementedError('Unable to register for hotplug '
+                                      'events (%d)' % rc)
+        self._handle = handle.value
+        self._running = True
+        self._thread = threading.Thread(target=self._handle_events)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Deregister and wait for the event thread to exit"""
+        if not self._running:
+            return
+        self._running = False
+        self._lib.libusb_hotplug_deregister_callback(self._ctx, self._handle)
+        self._thread.join()
+        self._thread = None
+        self._events.clear()
+
+    def is_running(self):
+        return self._running and self._thread.isAlive()
+
+    def events(self):
+        """Return the events received since the last call, oldest first, as
+           (arrived, (bus, address), device) tuples. 'device' can be handed
+           to usb.core.Device with the backend"""
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+    def clear(self):
+        """Drop the events received so far"""
+        self._events.clear()
+
+    def _callback(self, ctx, device, event, user_data):
+        # Called from the event thread, only read what libusb already knows
+        # about the device. Returning 0 keeps the callback registered
+        bus = self._lib.libusb_get_bus_number(device)
+        address = self._lib.libusb_get_device_address(device)
+        arrived = event == LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED
+        self._events.append((arrived, (bus, address),
+                             libusb1._Device(device)))
+        return 0
+
+    def _handle_events(self):
+        tv = _timeval(0, self.EVENT_TIMEOUT)
+        while self._running:
+            self._lib.libusb_handle_events_timeout(self._ctx, byref(tv))
@@ -15,10 +15,15 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import os
+import sys
+import json
+import time
 import threading
 import usb.core
 import usb.util
 from misc import to_int
+from usbhotplug import HotplugMonitor
 from urlparse import urlsplit
 
 __all__ = ['UsbTools']
@@ -39,6 +44,33 @@ class UsbTools(object):
     LOCK = threading.RLock()
     USBDEVICES = []
     USB_API = None
+    # pyusb backend, resolved on the first lookup, see get_backend
+    BACKEND = None
+    BACKENDS = ('libusb1', 'libusb10', 'libusb0', 'libusb01', 'openusb')
+    # Comma separated backends to use instead of BACKENDS
+    BACKEND_ENV = 'PYFTDI_BACKEND'
+    # Vendor/product pairs the cached devices are filtered with, the union
+    # of all the lookups so far
+    VPDICT = {}
+    # Monitor that keeps USBDEVICES up to date, None until the first lookup
+    # and False if hotplug is not available. Set to False before the first
+    # lookup to disable it
+    HOTPLUG = None
+    # Without hotplug, the least time between two scans of the bus (s)
+    SCAN_INTERVAL = 1.0
+    SCAN_TIME = None
+    # String descriptors already read, keyed by the location and the device
+    # descriptor of the device (see _string_key). Each entry records the
+    # address the device had, so a re-enumerated device is read again
+    STRINGS = {}
+    # JSON file the string descriptors are saved to, None to keep them in
+    # memory only
+    STRING_STORE = None
+    STRINGS_DIRTY = False
+    # Keys of the entries this process has read from the devices. An entry
+    # loaded from the store is a hint, another device of the same kind can be
+    # at that location and address since then (reboot, boards swapped)
+    STRINGS_VERIFIED = set()
 
     @staticmethod
     def find_all(vps, nocache=False):
@@ -52,6 +84,19 @@ class UsbTools(object):
             description = UsbTools.get_string(dev, dev.iProduct)
             devices.append((dev.idVendor, dev.idProduct, sernum, ifcount,
                             description))
+        UsbTools.save_strings()
+        return devices
+
+    @staticmethod
+    def find_locations(vps, nocache=False):
+        """Find all devices that match the vendor/product pairs of the vps
+           list, return their (serial number, location) pairs. Nothing is
+           opened, only the serial number string is read"""
+        devices = []
+        for dev in UsbTools._find_devices(vps, nocache):
+            devices.append((UsbTools.get_string(dev, dev.iSerialNumber),
+                            UsbTools.get_location(dev)))
+        UsbTools.save_strings()
         return devices
 
     @classmethod
@@ -74,6 +119,7 @@ class UsbTools(object):
                     devs = [dev for dev in devs if \
                               UsbTools.get_string(dev, dev.iSerialNumber) \
                                 == serial]
+                cls.save_strings()
                 try:
                     dev = devs[index]
                 except IndexError:
@@ -149,49 +195,194 @@ class UsbTools(object):
            start-up time.
            Hopefully, this kludge is temporary and replaced with a better
            implementation from PyUSB at some point.
+           The cache follows the hotplug events of libusb when they are
+           available, otherwise the bus is scanned again at most every
+           SCAN_INTERVAL seconds. A scan only creates the devices whose
+           bus/address is not in the cache yet. 'nocache' forces a scan.
         """
         cls.LOCK.acquire()
         try:
-            backend = None
-            candidates = ('libusb1', 'libusb10', 'libusb0', 'libusb01',
-                          'openusb')
-            um = __import__('usb.backend', globals(), locals(),
-                            candidates, -1)
-            for c in candidates:
-                try:
-                    m = getattr(um, c)
-                except AttributeError:
-                    continue
-                backend = m.get_backend()
-                if backend is not None:
-                    break
+            backend = cls.get_backend()
+            vpdict = {}
+            for v, p in vps:
+                vpdict.setdefault(v, [])
+                vpdict[v].append(p)
+            if cls.HOTPLUG is None:
+                cls._start_hotplug(backend)
+            # the cache is only complete for the vendor/product pairs that
+            # were looked up before
+            newvps = cls._merge_vps(vpdict)
+            now = time.time()
+            if nocache or newvps or (cls.SCAN_TIME is None):
+                rescan = True
+            elif cls.HOTPLUG and cls.HOTPLUG.is_running():
+                cls._apply_hotplug(backend)
+                rescan = False
             else:
-                raise ValueError('No backend available')
-            if not cls.USBDEVICES or nocache:
-                # not freed until Python runtime completion
-                # enumerate_devices returns a generator, so back up the
-                # generated device into a list. To save memory, we only
-                # back up the supported devices
-                cls.USBDEVICES = []
-                devlist = []
-                vpdict = {}
-                for v, p in vps:
-                    vpdict.setdefault(v, [])
-                    vpdict[v].append(p)
-                for dev in backend.enumerate_devices():
-                    device = usb.core.Device(dev, backend)
-                    vendor = device.idVendor
-                    product = device.idProduct
-                    if vendor in vpdict:
-                        products = vpdict[vendor]
-                        if products and (product not in products):
-                            continue
-                        devlist.append(device)
-                cls.USBDEVICES = devlist
-            return cls.USBDEVICES
+                rescan = (now - cls.SCAN_TIME) >= cls.SCAN_INTERVAL
+            if rescan:
+                cls._scan_devices(backend)
+                cls.SCAN_TIME = now
+            return [dev for dev in cls.USBDEVICES
+                    if cls._match(vpdict, dev.idVendor, dev.idProduct)]
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def get_backend(cls):
+        """Return the pyusb backend. The first one of the backends named by
+           the PYFTDI_BACKEND environment variable, or else of BACKENDS, that
+           loads is kept for the life of the process"""
+        if cls.BACKEND is not None:
+            return cls.BACKEND
+        cls.LOCK.acquire()
+        try:
+            if cls.BACKEND is None:
+                names = os.environ.get(cls.BACKEND_ENV)
+                if names:
+                    names = [name.strip() for name in names.split(',')]
+                else:
+                    names = cls.BACKENDS
+                cls.BACKEND = cls._load_backend(names)
+            return cls.BACKEND
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def set_backend(cls, backend):
+        """Use another pyusb backend: a backend object, or the name of a
+           module of usb.backend. None resolves the backend again on the next
+           lookup. The cached devices are dropped"""
+        cls.LOCK.acquire()
+        try:
+            if isinstance(backend, basestring):
+                backend = cls._load_backend([backend])
+            if cls.HOTPLUG:
+                cls.HOTPLUG.stop()
+            cls.HOTPLUG = None
+            cls.BACKEND = backend
+            cls.DEVICES.clear()
+            cls.USBDEVICES[:] = []
+            cls.SCAN_TIME = None
         finally:
             cls.LOCK.release()
 
+    @staticmethod
+    def _load_backend(names):
+        um = __import__('usb.backend', globals(), locals(), list(names), -1)
+        for name in names:
+            try:
+                m = getattr(um, name)
+            except AttributeError:
+                continue
+            backend = m.get_backend()
+            if backend is not None:
+                return backend
+        raise ValueError('No backend available')
+
+    @staticmethod
+    def _match(vpdict, vendor, product):
+        if vendor not in vpdict:
+            return False
+        products = vpdict[vendor]
+        return not products or (product in products)
+
+    @classmethod
+    def _merge_vps(cls, vpdict):
+        """Add the vendor/product pairs to the cache filter, return True if
+           there were new ones"""
+        new = False
+        for vendor in vpdict:
+            products = cls.VPDICT.get(vendor)
+            if products is None:
+                cls.VPDICT[vendor] = list(vpdict[vendor])
+                new = True
+                continue
+            if not products:
+                continue
+            if not vpdict[vendor]:
+                cls.VPDICT[vendor] = []
+                new = True
+                continue
+            for product in vpdict[vendor]:
+                if product not in products:
+                    products.append(product)
+                    new = True
+        return new
+
+    @classmethod
+    def _start_hotplug(cls, backend):
+        try:
+            monitor = HotplugMonitor(backend)
+            monitor.start()
+        except NotImplementedError:
+            cls.HOTPLUG = False
+            return
+        cls.HOTPLUG = monitor
+
+    @classmethod
+    def _scan_devices(cls, backend):
+        """Diff the devices on the bus against the cache: the devices that
+           are still at the same bus/address are kept as they are, only the
+           new ones are created. The cache is updated in place"""
+        if cls.HOTPLUG:
+            # the scan supersedes the pending events
+            cls.HOTPLUG.clear()
+        cached = {}
+        for dev in cls.USBDEVICES:
+            if dev.bus is not None:
+                cached[(dev.bus, dev.address)] = dev
+        devlist = []
+        for dev in backend.enumerate_devices():
+            desc = backend.get_device_descriptor(dev)
+            device = cached.get((desc.bus, desc.address))
+            # the address may have been reused by another device
+            if (device is None) or (device.idVendor != desc.idVendor) or \
+                    (device.idProduct != desc.idProduct):
+                if not cls._match(cls.VPDICT, desc.idVendor, desc.idProduct):
+                    continue
+                device = usb.core.Device(dev, backend)
+            devlist.append(device)
+        cls._update_devices(devlist)
+
+    @classmethod
+    def _apply_hotplug(cls, backend):
+        """Update the cache with the hotplug events received so far"""
+        events = cls.HOTPLUG.events()
+        if not events:
+            return
+        devlist = list(cls.USBDEVICES)
+        for arrived, location, dev in events:
+            known = [device for device in devlist
+                     if (device.bus, device.address) == location]
+            if not arrived:
+                devlist = [device for device in devlist
+                           if device not in known]
+            elif not known:
+                desc = backend.get_device_descriptor(dev)
+                if cls._match(cls.VPDICT, desc.idVendor, desc.idProduct):
+                    devlist.append(usb.core.Device(dev, backend))
+        cls._update_devices(devlist)
+
+    @classmethod
+    def _update_devices(cls, devlist):
+        """Replace the content of USBDEVICES, the open devices that are not
+           on the bus anymore are released"""
+        removed = set([id(dev) for dev in cls.USBDEVICES]) - \
+            set([id(dev) for dev in devlist])
+        for devkey in cls.DEVICES.keys():
+            dev = cls.DEVICES[devkey][0]
+            # without bus/address, the device cannot be told apart from its
+            # new instance, keep it
+            if (len(devkey) == 2) or (id(dev) not in removed):
+                continue
+            try:
+                usb.util.dispose_resources(dev)
+            except usb.core.USBError:
+                pass
+            del cls.DEVICES[devkey]
+        cls.USBDEVICES[:] = devlist
+
     @staticmethod
     def parse_url(urlstr, devclass, scheme, vdict, pdict, default_vendor):
         urlparts = urlsplit(urlstr)
@@ -341,10 +532,143 @@ class UsbTools(object):
                 print >> out, enc_report
             print >> out, ''
 
+    @classmethod
+    def set_string_store(cls, path):
+        """Keep the string descriptors in a JSON file, so they survive the
+           process. The strings already in the file are loaded, a missing or
+           unreadable file is an empty store. None disables the store. The
+           serial number of a device is read again the first time its
+           strings are looked up, the file is only a hint"""
+        cls.LOCK.acquire()
+        try:
+            cls.STRING_STORE = path
+            if path is None:
+                return
+            try:
+                with open(path, 'r') as store:
+                    strings = json.load(store)
+            except (IOError, ValueError):
+                return
+            if isinstance(strings, dict):
+                for key in strings:
+                    if isinstance(strings[key], dict):
+                        cls.STRINGS.setdefault(key, strings[key])
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def save_strings(cls):
+        """Write the string descriptors read since the last call to the
+           store, if there is one"""
+        cls.LOCK.acquire()
+        try:
+            if not cls.STRINGS_DIRTY or not cls.STRING_STORE:
+                return
+            cls.STRINGS_DIRTY = False
+            # write a new file and move it over the old one, so a reader
+            # never sees a partial file
+            tmp = '%s.%d' % (cls.STRING_STORE, os.getpid())
+            try:
+                with open(tmp, 'w') as store:
+                    json.dump(cls.STRINGS, store, indent=1, sort_keys=True)
+                os.rename(tmp, cls.STRING_STORE)
+            except (IOError, OSError), e:
+                print >> sys.stderr, \
+                    'Unable to save the USB strings to %s: %s' % \
+                    (cls.STRING_STORE, e)
+        finally:
+            cls.LOCK.release()
+
+    @staticmethod
+    def _string_key(device):
+        """Key of the string descriptors of a device: the bus, the path of
+           hub ports to the device and the device descriptor, which stays
+           the same when the device is enumerated again. None if the backend
+           does not tell where the device is"""
+        location = UsbTools.get_location(device)
+        if (location is None) or (device.address is None):
+            return None
+        return '%s/%04x:%04x:%04x:%d:%d:%d' % \
+            (location, device.idVendor, device.idProduct, device.bcdDevice,
+             device.iManufacturer, device.iProduct, device.iSerialNumber)
+
+    @staticmethod
+    def get_location(device):
+        """Return where the device is plugged in, the bus and the path of
+           hub ports as in '1-2.4', or None if the backend does not tell"""
+        bus = getattr(device, 'bus', None)
+        ports = getattr(device, 'port_numbers', None)
+        if ports is None:
+            port = getattr(device, 'port_number', None)
+            ports = port is not None and (port,) or None
+        if (bus is None) or (ports is None):
+            return None
+        return '%d-%s' % (bus, '.'.join(['%d' % p for p in ports]))
+
     @classmethod
     def get_string(cls, device, strname):
-        """Retrieve a string from the USB device, dealing with PyUSB API breaks
-        """
+        """Retrieve a string from the USB device, dealing with PyUSB API
+           breaks. The strings are cached until the device is enumerated
+           again"""
+        key = cls._string_key(device)
+        if key is None:
+            return cls._read_string(device, strname)
+        index = '%d' % strname
+        cls.LOCK.acquire()
+        try:
+            entry = cls.STRINGS.get(key)
+            if (entry is None) or (entry.get('address') != device.address):
+                # a new device, or the same one after a reset or replug
+                entry = {'address': device.address, 'strings': {}}
+                cls.STRINGS[key] = entry
+                cls.STRINGS_VERIFIED.add(key)
+            verified = key in cls.STRINGS_VERIFIED
+        finally:
+            cls.LOCK.release()
+        if not verified:
+            entry = cls._verify_strings(key, entry, device)
+        cls.LOCK.acquire()
+        try:
+            if index in entry['strings']:
+                return entry['strings'][index]
+        finally:
+            cls.LOCK.release()
+        string = cls._read_string(device, strname)
+        if string is not None:
+            cls.LOCK.acquire()
+            try:
+                entry['strings'][index] = string
+                cls.STRINGS_DIRTY = True
+            finally:
+                cls.LOCK.release()
+        return string
+
+    @classmethod
+    def _verify_strings(cls, key, entry, device):
+        """Read the serial number of a device whose strings were loaded
+           from the store, once per process. The entry is dropped if the
+           serial number isn't the one in the store"""
+        index = '%d' % device.iSerialNumber
+        serial = None
+        if device.iSerialNumber:
+            serial = cls._read_string(device, device.iSerialNumber)
+        cls.LOCK.acquire()
+        try:
+            strings = entry.get('strings')
+            if (serial is None) or not isinstance(strings, dict) or \
+               (strings.get(index) != serial):
+                entry = {'address': device.address, 'strings': {}}
+                if serial is not None:
+                    entry['strings'][index] = serial
+                cls.STRINGS[key] = entry
+                cls.STRINGS_DIRTY = True
+            cls.STRINGS_VERIFIED.add(key)
+            return entry
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def _read_string(cls, device, strname):
         if cls.USB_API is None:
             import inspect
             args, varargs, varkw, defaults = \
@@ -0,0 +1,381 @@
+#! /usr/bin/python
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" bench_transport
+
+Throughput and latency of the FTDI transport, measured against the
+simulated FT2232H of fake_ft2232h, no hardware is needed
+
+    python bench/bench_transport.py --output results.json
+    python bench/bench_transport.py --baseline results.json
+
+Every case is run for each payload size and reports MB/s, operations per
+second, p50/p99 latency of an operation and the CPU time (process wide, the
+threads of the driver and the fake device included) per byte. With
+--baseline the results are compared against an earlier run and the script
+exits with an error if a case got slower than the threshold.
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import datetime
+from array import array as Array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from artemis_usb2.ftdi import Ftdi
+from artemis_usb2.spi import SpiController
+import fake_ft2232h as fake
+
+DESCRIPTION = "Benchmark the FTDI transport against a simulated FT2232H"
+
+EPILOG = "\n" \
+"Examples:\n" \
+"\tRun all cases and save the results\n" \
+"\t\tbench_transport.py --output results.json\n" \
+"\n" \
+"\tCompare against a previous run\n" \
+"\t\tbench_transport.py --baseline results.json\n" \
+"\n" \
+"\tMeasure only the software: no latency timer, only SPI\n" \
+"\t\tbench_transport.py --latency 0 --cases spi_exchange\n"
+
+DEFAULT_SIZES = "1,64,512,4096,65536"
+
+FTDI_VENDOR = 0x0403
+FTDI_PRODUCT = 0x6010
+ARTEMIS_PRODUCT = 0x8531
+
+#Largest SPI transfer, see SpiController.PAYLOAD_MAX_LENGTH
+SPI_MAX_SIZE = 0x10000
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def percentile(values, percent):
+    """values have to be sorted"""
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def measure(op, nbytes, duration, min_ops):
+    """
+    Run 'op' over and over for at least 'duration' seconds and 'min_ops'
+    times, 'nbytes' is the number of bytes one operation moves
+    """
+    #Warm up: caches, buffers and the latency controller
+    op()
+    latencies = []
+    cpu_start = cpu_time()
+    start = time.time()
+    now = start
+    while ((now - start) < duration) or (len(latencies) < min_ops):
+        before = time.time()
+        op()
+        now = time.time()
+        latencies.append(now - before)
+    elapsed = now - start
+    cpu = cpu_time() - cpu_start
+    latencies.sort()
+    total = nbytes * len(latencies)
+    return {"ops": len(latencies),
+            "seconds": elapsed,
+            "bytes": total,
+            "mb_per_s": total / elapsed / 1000000.0,
+            "ops_per_s": len(latencies) / elapsed,
+            "p50_us": percentile(latencies, 50) * 1000000.0,
+            "p99_us": percentile(latencies, 99) * 1000000.0,
+            "cpu_ns_per_byte": cpu / total * 1000000000.0}
+
+
+def pattern(size):
+    return Array('B', [i & 0xFF for i in xrange(size)])
+
+
+class Bench(object):
+    """
+    Bench
+
+    A set of cases that share a fake device, 'cases' maps the name of a case
+    to a function that builds the operation for a payload size and returns
+    the operation and the number of bytes it moves
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.cases = {}
+
+    def make_device(self, function_a, function_b = None, product = FTDI_PRODUCT):
+        device = fake.FakeFT2232H(function_a, function_b,
+                                  product = product,
+                                  packet_size = self.args.packet_size,
+                                  latency = self.args.latency,
+                                  bandwidth = self.args.bandwidth)
+        fake.install([device])
+        return device
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+
+class FtdiBench(Bench):
+    """Raw reads and writes of the FTDI driver"""
+
+    def __init__(self, args):
+        Bench.__init__(self, args)
+        self.cases = {"ftdi_write": self.write,
+                      "ftdi_read": self.read}
+
+    def setup(self):
+        self.device = self.make_device(fake.Sink())
+        self.port = self.device.ports[0]
+        self.ftdi = Ftdi()
+        self.ftdi.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+
+    def teardown(self):
+        self.ftdi.close()
+
+    def write(self, size):
+        data = pattern(size)
+        return (lambda: self.ftdi.write_data(data)), size
+
+    def read(self, size):
+        data = bytearray(pattern(size).tostring())
+        port = self.port
+        ftdi = self.ftdi
+
+        def op():
+            port.send(data, immediate = True)
+            ftdi.read_data_bytes(size, 4)
+
+        return op, size
+
+
+class SpiBench(Bench):
+    """SPI transfers through the MPSSE engine"""
+
+    def __init__(self, args):
+        Bench.__init__(self, args)
+        self.cases = {"spi_exchange": self.exchange,
+                      "spi_switch": self.switch}
+
+    def setup(self):
+        self.make_device(fake.Mpsse())
+        self.spi = SpiController()
+        self.spi.configure(FTDI_VENDOR, FTDI_PRODUCT, 1, frequency = 30.0E6)
+        self.port = self.spi.get_port(0)
+        self.slow_port = self.spi.get_port(1)
+        self.slow_port.set_frequency(1.0E6)
+
+    def teardown(self):
+        self.spi.terminate()
+
+    def exchange(self, size):
+        size = min(size, SPI_MAX_SIZE)
+        out = pattern(size)
+        return (lambda: self.port.exchange(out, size)), size * 2
+
+    def switch(self, size):
+        """Alternate between two devices with different clocks"""
+        size = min(size, SPI_MAX_SIZE)
+        out = pattern(size)
+
+        def op():
+            self.port.exchange(out, size)
+            self.slow_port.exchange(out, size)
+
+        return op, size * 4
+
+
+class ArtemisBench(Bench):
+    """Register reads and writes of the Artemis"""
+
+    def __init__(self, args):
+        Bench.__init__(self, args)
+        self.cases = {"artemis_read": self.read,
+                      "artemis_write": self.write}
+
+    def setup(self):
+        #Nysa is needed for the Artemis
+        from artemis_usb2.artemis_usb2 import _Artemis
+        self.make_device(fake.Artemis(), fake.BitBang(), ARTEMIS_PRODUCT)
+        self.artemis = _Artemis(FTDI_VENDOR, ARTEMIS_PRODUCT)
+
+    def teardown(self):
+        #Stop the worker and reader threads so they don't keep polling
+        self.artemis.close()
+
+    def read(self, size):
+        words = max(size / 4, 1)
+        return (lambda: self.artemis.read(0x00, words)), words * 4
+
+    def write(self, size):
+        data = pattern(max(size / 4, 1) * 4)
+        return (lambda: self.artemis.write(0x00, data)), len(data)
+
+
+BENCHES = [FtdiBench, SpiBench, ArtemisBench]
+
+
+def run(args):
+    sizes = [int(s, 0) for s in args.sizes.split(",")]
+    selected = None
+    if args.cases:
+        selected = args.cases.split(",")
+
+    results = []
+    for bench_class in BENCHES:
+        bench = bench_class(args)
+        names = [name for name in sorted(bench.cases)
+                 if (selected is None) or (name in selected)]
+        if len(names) == 0:
+            continue
+        try:
+            bench.setup()
+        except ImportError as ex:
+            for name in names:
+                print "%-16s skipped: %s" % (name, str(ex))
+                results.append({"case": name, "skipped": str(ex)})
+            continue
+        try:
+            for name in names:
+                for size in sizes:
+                    op, nbytes = bench.cases[name](size)
+                    result = measure(op, nbytes, args.duration, args.min_ops)
+                    result["case"] = name
+                    result["size"] = size
+                    print_result(result)
+                    results.append(result)
+        finally:
+            bench.teardown()
+    return results
+
+
+def print_header():
+    print "%-16s %8s %8s %10s %10s %10s %10s" % ("case", "size", "MB/s",
+                                                 "ops/s", "p50 us",
+                                                 "p99 us", "cpu ns/B")
+
+
+def print_result(result):
+    print "%-16s %8d %8.2f %10.0f %10.1f %10.1f %10.2f" % (
+        result["case"], result["size"], result["mb_per_s"],
+        result["ops_per_s"], result["p50_us"], result["p99_us"],
+        result["cpu_ns_per_byte"])
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of every case against the baseline, returns the number
+    of cases whose throughput dropped more than 'threshold' percent
+    """
+    previous = {}
+    for result in baseline["results"]:
+        if "skipped" not in result:
+            previous[(result["case"], result["size"])] = result
+
+    print ""
+    print "%-16s %8s %10s %10s %10s" % ("case", "size", "MB/s %", "p50 %", "p99 %")
+    regressions = 0
+    for result in results:
+        if "skipped" in result:
+            continue
+        old = previous.get((result["case"], result["size"]))
+        if old is None:
+            continue
+        changes = []
+        for key in ("mb_per_s", "p50_us", "p99_us"):
+            changes.append((result[key] - old[key]) * 100.0 / old[key])
+        flag = ""
+        if changes[0] < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print "%-16s %8d %+10.1f %+10.1f %+10.1f%s" % (
+            result["case"], result["size"], changes[0], changes[1],
+            changes[2], flag)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.RawDescriptionHelpFormatter,
+        description = DESCRIPTION,
+        epilog = EPILOG)
+    parser.add_argument("--sizes", default = DEFAULT_SIZES,
+                        help = "Comma separated payload sizes in bytes (default: %s)" % DEFAULT_SIZES)
+    parser.add_argument("--cases",
+                        help = "Comma separated cases to run (default: all)")
+    parser.add_argument("--duration", type = float, default = 0.5,
+                        help = "Seconds each case runs for (default: 0.5)")
+    parser.add_argument("--min-ops", type = int, default = 10,
+                        help = "Least number of operations of a case (default: 10)")
+    parser.add_argument("--packet-size", type = int, default = 512,
+                        help = "USB packet size, 512 for high speed (default: 512)")
+    parser.add_argument("--latency", type = int,
+                        help = "Latency timer of the fake device in ms (default: the value set by the driver)")
+    parser.add_argument("--bandwidth", type = float,
+                        help = "Bus bandwidth in MB/s (default: unlimited)")
+    parser.add_argument("--output",
+                        help = "Save the results to this JSON file")
+    parser.add_argument("--baseline",
+                        help = "Compare against the results of an earlier run")
+    parser.add_argument("--threshold", type = float, default = 10.0,
+                        help = "Throughput drop in percent that is a regression (default: 10)")
+    args = parser.parse_args(argv)
+    if args.bandwidth is not None:
+        args.bandwidth *= 1000000.0
+
+    print_header()
+    results = run(args)
+
+    report = {"meta": {"date": datetime.datetime.now().isoformat(),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "packet_size": args.packet_size,
+                       "latency": args.latency,
+                       "bandwidth": args.bandwidth,
+                       "duration": args.duration},
+              "results": results}
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(report, f, indent = 2, sort_keys = True)
+        f.close()
+
+    if args.baseline:
+        f = open(args.baseline, "r")
+        baseline = json.load(f)
+        f.close()
+        if compare(results, baseline, args.threshold) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
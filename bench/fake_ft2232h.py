@@ -0,0 +1,579 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" fake_ft2232h
+
+A simulated FT2232H behind a pyusb backend, so the FTDI driver and
+everything built on top of it runs against it unchanged:
+
+    device = FakeFT2232H(Loopback(), BitBang())
+    install([device])
+    ftdi = Ftdi()
+    ftdi.open(0x0403, 0x6010, 1)
+
+Every bulk IN transfer is framed like the chip does it: two modem status
+bytes at the start of every packet, and a packet with less data than fits
+is only sent when the latency timer expires or a SEND_IMMEDIATE was seen.
+
+The device runs in the same process and its time is part of what is
+measured, so the functions behind the interfaces do as little as they can:
+written data is parsed but not stored.
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import sys
+import time
+import threading
+from ctypes import memmove, string_at
+
+import usb.core
+import usb.backend
+
+#Modem status bytes the chip puts at the start of every packet
+MODEM_STATUS = bytearray([0x31, 0x60])
+
+#Latency timer of the chip after a reset, in ms
+DEFAULT_LATENCY = 16
+
+#Vendor requests of the FTDI chip, see Ftdi.SIO_*
+SIO_RESET = 0
+SIO_POLL_MODEM_STATUS = 5
+SIO_SET_LATENCY_TIMER = 9
+SIO_GET_LATENCY_TIMER = 10
+SIO_SET_BITMODE = 11
+SIO_READ_PINS = 12
+
+SIO_RESET_SIO = 0
+SIO_RESET_PURGE_RX = 1
+SIO_RESET_PURGE_TX = 2
+
+USB_GET_DESCRIPTOR = 6
+USB_DESC_STRING = 3
+
+#Each fake device gets an address of its own, the FTDI driver keeps state
+#per bus and address
+_addresses = [0]
+_address_lock = threading.Lock()
+
+def _next_address():
+    with _address_lock:
+        _addresses[0] += 1
+        return _addresses[0]
+
+
+class _Descriptor(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class Port(object):
+    """
+    Port
+
+    One interface of the chip: the RX FIFO the host reads from, the latency
+    timer and the function that handles what the host writes
+    """
+
+    def __init__(self, function, packet_size, latency, bandwidth):
+        self.function = function
+        self.packet_size = packet_size
+        #None to follow the latency timer that was set by the driver
+        self.fixed_latency = latency
+        self.bandwidth = bandwidth
+        self.latency = DEFAULT_LATENCY
+        self.bitmode = 0
+        self.pins = 0xFF
+        #Modem and line status sent with every packet
+        self.status = bytearray(MODEM_STATUS)
+        self.fifo = bytearray()
+        self.immediate = False
+        self.sent = time.time()
+        self.cond = threading.Condition()
+
+    def send(self, data, immediate = False):
+        """
+        Queue data for the host, 'immediate' flushes it without waiting for
+        the latency timer like SEND_IMMEDIATE
+        """
+        with self.cond:
+            self.fifo.extend(data)
+            if immediate:
+                self.immediate = True
+            self.cond.notify_all()
+
+    def purge_rx(self):
+        with self.cond:
+            del self.fifo[:]
+            self.immediate = False
+
+    def purge_tx(self):
+        self.function.reset()
+
+    def write(self, data):
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        self.function.write(self, data)
+
+    def read_into(self, buff, timeout):
+        """
+        Fill an array with as many packets as it holds, return the number of
+        bytes, status bytes included
+        """
+        packet_size = self.packet_size
+        room = packet_size - len(MODEM_STATUS)
+        packets = max(len(buff) / packet_size, 1)
+        with self.cond:
+            latency = self.fixed_latency
+            if latency is None:
+                latency = self.latency
+            deadline = min(self.sent + latency / 1000.0,
+                           time.time() + timeout / 1000.0)
+            while (len(self.fifo) < room) and not self.immediate:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+            count = min(len(self.fifo), packets * room)
+            #The read timed out, the data waits for the latency timer
+            held = (count < room) and not self.immediate and \
+                   (time.time() < self.sent + latency / 1000.0)
+            if held:
+                count = 0
+            out = bytearray()
+            pos = 0
+            while True:
+                out.extend(self.status)
+                out.extend(buffer(self.fifo, pos, min(room, count - pos)))
+                pos += room
+                if pos >= count:
+                    break
+            del self.fifo[:count]
+            if len(self.fifo) == 0:
+                self.immediate = False
+            if not held:
+                self.sent = time.time()
+        if self.bandwidth:
+            time.sleep(len(out) / self.bandwidth)
+        address, length = buff.buffer_info()
+        memmove(address, str(out), len(out))
+        return len(out)
+
+
+class FakeFT2232H(object):
+    """
+    FakeFT2232H
+
+    A dual interface FT2232H, each interface has a function that answers
+    what is written to it
+
+    Args:
+        function_a: function behind interface A
+        function_b: function behind interface B
+        vendor, product: USB identifiers
+        serial (String): serial number string descriptor
+        packet_size (Integer): size of the bulk packets, 512 on a high speed
+            bus, 64 on a full speed bus
+        latency (Integer): latency timer in ms, None to follow the value set
+            by the driver
+        bandwidth (Float): bytes per second the bus carries, None for as
+            fast as possible
+    """
+
+    def __init__(self, function_a, function_b = None, vendor = 0x0403,
+                 product = 0x6010, serial = "FAKE0001", packet_size = 512,
+                 latency = None, bandwidth = None):
+        if function_b is None:
+            function_b = Sink()
+        self.vendor = vendor
+        self.product = product
+        self.strings = {1: "FTDI", 2: "Fake FT2232H", 3: serial}
+        self.packet_size = packet_size
+        self.bus = 0
+        self.address = _next_address()
+        self.ports = [Port(function_a, packet_size, latency, bandwidth),
+                      Port(function_b, packet_size, latency, bandwidth)]
+        self.control_transfers = 0
+
+    def port(self, index):
+        """Port of a vendor request, index 0 and 1 both mean interface A"""
+        return self.ports[max(index & 0xFF, 1) - 1]
+
+    def endpoint_port(self, endpoint):
+        return self.ports[((endpoint & 0x7F) - 1) / 2]
+
+    def get_string(self, index):
+        return self.strings.get(index)
+
+
+class FakeBackend(usb.backend.IBackend):
+    """
+    FakeBackend
+
+    pyusb backend that enumerates fake devices
+    """
+
+    def __init__(self, devices):
+        usb.backend.IBackend.__init__(self)
+        self.devices = devices
+
+    def enumerate_devices(self):
+        return iter(self.devices)
+
+    def get_device_descriptor(self, dev):
+        return _Descriptor(bLength = 18, bDescriptorType = 1, bcdUSB = 0x200,
+                           bDeviceClass = 0, bDeviceSubClass = 0,
+                           bDeviceProtocol = 0, bMaxPacketSize0 = 64,
+                           idVendor = dev.vendor, idProduct = dev.product,
+                           bcdDevice = 0x700, iManufacturer = 1, iProduct = 2,
+                           iSerialNumber = 3, bNumConfigurations = 1,
+                           address = dev.address, bus = dev.bus,
+                           port_number = dev.address,
+                           port_numbers = (dev.address,), speed = 3)
+
+    def get_configuration_descriptor(self, dev, config):
+        if config != 0:
+            raise IndexError("Invalid configuration index")
+        return _Descriptor(bLength = 9, bDescriptorType = 2,
+                           wTotalLength = 55, bNumInterfaces = 2,
+                           bConfigurationValue = 1, iConfiguration = 0,
+                           bmAttributes = 0x80, bMaxPower = 45,
+                           extra_descriptors = [])
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        if (intf > 1) or (alt != 0):
+            raise IndexError("Invalid interface index")
+        return _Descriptor(bLength = 9, bDescriptorType = 4,
+                           bInterfaceNumber = intf, bAlternateSetting = 0,
+                           bNumEndpoints = 2, bInterfaceClass = 0xFF,
+                           bInterfaceSubClass = 0xFF,
+                           bInterfaceProtocol = 0xFF, iInterface = 2,
+                           extra_descriptors = [])
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        if ep > 1:
+            raise IndexError("Invalid endpoint index")
+        if ep == 0:
+            address = 0x81 + 2 * intf
+        else:
+            address = 0x02 + 2 * intf
+        return _Descriptor(bLength = 7, bDescriptorType = 5,
+                           bEndpointAddress = address, bmAttributes = 0x02,
+                           wMaxPacketSize = dev.packet_size, bInterval = 0,
+                           bRefresh = 0, bSynchAddress = 0,
+                           extra_descriptors = [])
+
+    def open_device(self, dev):
+        return dev
+
+    def close_device(self, dev_handle):
+        pass
+
+    def set_configuration(self, dev_handle, config_value):
+        pass
+
+    def get_configuration(self, dev_handle):
+        return 1
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        pass
+
+    def claim_interface(self, dev_handle, intf):
+        pass
+
+    def release_interface(self, dev_handle, intf):
+        pass
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        address, length = data.buffer_info()
+        length *= data.itemsize
+        dev_handle.endpoint_port(ep).write(string_at(address, length))
+        return length
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        return dev_handle.endpoint_port(ep).read_into(buff, timeout)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue,
+                      wIndex, data, timeout):
+        dev = dev_handle
+        dev.control_transfers += 1
+        if (bmRequestType & 0x60) == 0:
+            #Standard request, only string descriptors are supported
+            if (bRequest == USB_GET_DESCRIPTOR) and \
+               ((wValue >> 8) == USB_DESC_STRING):
+                index = wValue & 0xFF
+                if index == 0:
+                    #Supported languages: English (US)
+                    value = bytearray([4, USB_DESC_STRING, 0x09, 0x04])
+                else:
+                    string = dev.get_string(index)
+                    if string is None:
+                        raise usb.core.USBError("Pipe error", 32)
+                    encoded = string.encode("utf-16-le")
+                    value = bytearray([len(encoded) + 2, USB_DESC_STRING])
+                    value.extend(encoded)
+                return self._reply(data, value)
+            raise usb.core.USBError("Pipe error", 32)
+
+        port = dev.port(wIndex)
+        if bmRequestType & 0x80:
+            if bRequest == SIO_GET_LATENCY_TIMER:
+                return self._reply(data, bytearray([port.latency]))
+            if bRequest == SIO_READ_PINS:
+                return self._reply(data, bytearray([port.pins]))
+            if bRequest == SIO_POLL_MODEM_STATUS:
+                return self._reply(data, port.status)
+            return self._reply(data, bytearray(len(data)))
+
+        if bRequest == SIO_RESET:
+            if wValue in (SIO_RESET_SIO, SIO_RESET_PURGE_RX):
+                port.purge_rx()
+            if wValue in (SIO_RESET_SIO, SIO_RESET_PURGE_TX):
+                port.purge_tx()
+        elif bRequest == SIO_SET_LATENCY_TIMER:
+            port.latency = wValue
+        elif bRequest == SIO_SET_BITMODE:
+            port.bitmode = wValue
+        return len(data)
+
+    def _reply(self, data, value):
+        length = min(len(data), len(value))
+        data[:length] = data.__class__(data.typecode, str(value[:length]))
+        return length
+
+
+class Sink(object):
+    """Discards what is written"""
+
+    def write(self, port, data):
+        pass
+
+    def reset(self):
+        pass
+
+
+class Loopback(object):
+    """Sends back what is written"""
+
+    def write(self, port, data):
+        port.send(data)
+
+    def reset(self):
+        pass
+
+
+class Mpsse(object):
+    """
+    Mpsse
+
+    The commands of the MPSSE engine the SPI controller uses. Data clocked
+    out of a read-write command comes back as if MISO was tied to MOSI, a
+    read only command returns 0xFF bytes
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pending = bytearray()
+        #Data bytes of a write command that were not received yet
+        self.skip = 0
+        self.echo = False
+
+    def write(self, port, data):
+        data = bytearray(data)
+        pos = 0
+        if self.skip:
+            pos = min(self.skip, len(data))
+            if self.echo:
+                port.send(buffer(data, 0, pos))
+            self.skip -= pos
+        self.pending.extend(buffer(data, pos))
+        pending = self.pending
+        pos = 0
+        immediate = False
+        out = bytearray()
+        while pos < len(pending):
+            opcode = pending[pos]
+            if opcode & 0x80:
+                if opcode in (0x80, 0x82, 0x86):
+                    size = 3
+                elif opcode in (0x81, 0x83):
+                    size = 1
+                    out.append(port.pins)
+                else:
+                    size = 1
+                if pos + size > len(pending):
+                    break
+                if opcode == 0x87:
+                    immediate = True
+                elif opcode not in (0x80, 0x81, 0x82, 0x83, 0x84, 0x85,
+                                    0x86, 0x8A, 0x8B, 0x8C, 0x8D, 0x8E,
+                                    0x8F, 0x96, 0x97, 0x9E):
+                    out.extend([0xFA, opcode])
+                pos += size
+                continue
+            if opcode & 0x40:
+                #TMS bits: opcode, length, data
+                size = 3
+                if pos + size > len(pending):
+                    break
+                if opcode & 0x20:
+                    out.append(0xFF)
+                pos += size
+                continue
+            if opcode & 0x02:
+                #Bit mode: opcode, length, one data byte if writing
+                size = 2 + ((opcode & 0x10) and 1 or 0)
+                if pos + size > len(pending):
+                    break
+                if opcode & 0x20:
+                    out.append(0xFF)
+                pos += size
+                continue
+            if pos + 3 > len(pending):
+                break
+            length = pending[pos + 1] + (pending[pos + 2] << 8) + 1
+            pos += 3
+            if opcode & 0x10:
+                #Data follows the command, it may not have arrived yet
+                count = min(length, len(pending) - pos)
+                if opcode & 0x20:
+                    out.extend(buffer(pending, pos, count))
+                pos += count
+                if count < length:
+                    self.skip = length - count
+                    self.echo = (opcode & 0x20) != 0
+                    break
+            elif opcode & 0x20:
+                out.extend("\xFF" * length)
+        del pending[:pos]
+        if len(out) or immediate:
+            port.send(out, immediate)
+
+
+class BitBang(object):
+    """
+    Interface used as GPIOs, the pins read back as all high. What is
+    written is kept in 'written', it is only a few bytes
+    """
+
+    def __init__(self):
+        self.written = bytearray()
+
+    def write(self, port, data):
+        self.written.extend(data)
+
+    def reset(self):
+        pass
+
+
+class Artemis(object):
+    """
+    Artemis
+
+    The FPGA side of the Artemis protocol: answers reads with a pattern,
+    acknowledges writes and pings. Write data is counted but not stored.
+    Call interrupt to send an interrupt packet
+    """
+
+    def __init__(self, pattern_size = 0x40000):
+        self.pattern = bytearray(i & 0xFF for i in xrange(pattern_size))
+        self.reset()
+
+    def reset(self):
+        self.pending = bytearray()
+        self.skip = 0
+
+    def interrupt(self, port, interrupts):
+        packet = bytearray([0xDC, 0xF3, 0, 0, 0, 0, 0, 0, 0])
+        packet.extend([(interrupts >> 24) & 0xFF, (interrupts >> 16) & 0xFF,
+                       (interrupts >> 8) & 0xFF, interrupts & 0xFF])
+        port.send(packet)
+
+    def write(self, port, data):
+        pos = min(self.skip, len(data))
+        self.skip -= pos
+        if pos == len(data):
+            return
+        self.pending.extend(buffer(data, pos))
+        pending = self.pending
+        pos = 0
+        out = bytearray()
+        while pos + 9 <= len(pending):
+            if pending[pos] != 0xCD:
+                #Not the start of a command, the FPGA drops the byte
+                pos += 1
+                continue
+            command = pending[pos + 1]
+            status = (~command) & 0xFF
+            length = (pending[pos + 2] << 16) | (pending[pos + 3] << 8) | \
+                     pending[pos + 4]
+            kind = command & 0x0F
+            if kind == 0x01:
+                out.extend([0xDC, status])
+                out.extend(buffer(pending, pos + 2, 7))
+                out.extend([0, 0, 0, 0])
+                pos += 9
+                count = min(length * 4, len(pending) - pos)
+                pos += count
+                if count < length * 4:
+                    self.skip = length * 4 - count
+                    break
+            elif kind == 0x02:
+                out.extend([0xDC, status])
+                out.extend(buffer(pending, pos + 2, 7))
+                size = length * 4
+                while size > 0:
+                    part = min(size, len(self.pattern))
+                    out.extend(buffer(self.pattern, 0, part))
+                    size -= part
+                pos += 9
+            else:
+                if pos + 13 > len(pending):
+                    break
+                if kind == 0x00:
+                    out.extend([0xDC, 0xFF])
+                    out.extend(bytearray(11))
+                elif kind == 0x0F:
+                    out.extend([0xDC, status, 0, 0, 2])
+                    out.extend(bytearray(8))
+                pos += 13
+        del pending[:pos]
+        if len(out):
+            port.send(out)
+
+
+def install(devices):
+    """
+    Make UsbTools enumerate the fake devices instead of the devices on the
+    bus, returns the backend
+
+    Some modules of the platform import the FTDI driver as part of the
+    package and others on its own, every copy of UsbTools that is loaded at
+    this point is switched over
+    """
+    backend = FakeBackend(devices)
+    for module in sys.modules.values():
+        tools = getattr(module, "UsbTools", None)
+        if (tools is None) or not module.__name__.endswith("usbtools"):
+            continue
+        tools.set_backend(backend)
+    return backend
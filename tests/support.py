@@ -0,0 +1,49 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" support
+
+Shared setup of the tests: the repository and the simulated FT2232H of
+bench/fake_ft2232h.py on the path. The tests run without hardware
+
+    python -m unittest discover -s tests
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, ROOT)
+
+import fake_ft2232h as fake
+
+FTDI_VENDOR = 0x0403
+FTDI_PRODUCT = 0x6010
+ARTEMIS_PRODUCT = 0x8531
+
+
+def need_nysa(test):
+    """Skip a test of the Artemis when Nysa is not installed"""
+    try:
+        import nysa.host.nysa
+    except ImportError:
+        return unittest.skip("Nysa is not installed")(test)
+    return test
@@ -0,0 +1,168 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_artemis
+
+Commands and interrupts of an Artemis board behind a simulated FT2232H
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import time
+import threading
+import unittest
+
+from support import fake, need_nysa, FTDI_VENDOR, ARTEMIS_PRODUCT
+
+
+class LoggedArtemis(fake.Artemis):
+    """Keeps the order of the writes and the purges of the TX buffer"""
+
+    def __init__(self):
+        self.log = []
+        fake.Artemis.__init__(self)
+
+    def reset(self):
+        self.log.append("purge")
+        fake.Artemis.reset(self)
+
+    def write(self, port, data):
+        self.log.append("write")
+        fake.Artemis.write(self, port, data)
+
+
+@need_nysa
+class ArtemisTest(unittest.TestCase):
+
+    def setUp(self):
+        from artemis_usb2.artemis_usb2 import _Artemis
+        self.fpga = LoggedArtemis()
+        self.board = fake.FakeFT2232H(self.fpga, fake.BitBang(),
+                                      product = ARTEMIS_PRODUCT)
+        fake.install([self.board])
+        self.artemis = _Artemis(FTDI_VENDOR, ARTEMIS_PRODUCT)
+        self.artemis.read(0, 1)
+
+    def tearDown(self):
+        self.artemis.close()
+
+    def test_drained_pipeline_is_purged(self):
+        self.artemis.read(0, 1)
+        time.sleep(0.05)
+        #The FTDI is purged once the response is in, not in front of the
+        #next command
+        self.assertEqual(self.fpga.log[-2:], ["write", "purge"])
+
+    def test_read_latency(self):
+        #The latency timer is 2 ms, a purge in front of the command used to
+        #wait for a read of the reader thread to finish first
+        times = []
+        for i in range(20):
+            start = time.time()
+            self.artemis.read(0, 1)
+            times.append(time.time() - start)
+        times.sort()
+        self.assertLess(times[len(times) / 2], 0.005)
+
+    def test_stalled_stream(self):
+        from nysa.host.nysa import NysaCommError
+        stream = self.artemis.read_stream(0, 0x100 * 32, chunk_words = 0x100)
+        self.assertEqual(len(next(stream)), 0x400)
+        #The stream isn't read anymore, the other commands go on
+        start = time.time()
+        self.assertEqual(len(self.artemis.read(0, 1)), 4)
+        self.assertLess(time.time() - start, 2)
+        self.assertRaises(NysaCommError, list, stream)
+
+    def test_interrupt_latency(self):
+        woken = []
+        def wait():
+            if self.artemis.wait_for_interrupts(wait_time = 5):
+                woken.append(time.time())
+        waiter = threading.Thread(target = wait)
+        waiter.start()
+        #Long enough for a waiter that polls to sleep 50 ms at a time
+        time.sleep(0.3)
+        sent = time.time()
+        self.fpga.interrupt(self.board.ports[0], 0x01)
+        waiter.join()
+        self.assertEqual(len(woken), 1)
+        #The latency timer is 2 ms
+        self.assertLess(woken[0] - sent, 0.01)
+
+
+
+@need_nysa
+class LazyTest(unittest.TestCase):
+    """A lazy handle opens on its first command and again after a close"""
+
+    def setUp(self):
+        from artemis_usb2.artemis_usb2 import _Artemis
+        self.fpga = fake.Artemis()
+        self.board = fake.FakeFT2232H(self.fpga, fake.BitBang(),
+                                      product = ARTEMIS_PRODUCT)
+        fake.install([self.board])
+        self.artemis = _Artemis(FTDI_VENDOR, ARTEMIS_PRODUCT, lazy = True)
+
+    def tearDown(self):
+        self.artemis.close()
+
+    def test_first_command_opens(self):
+        self.assertFalse(self.artemis.is_open())
+        self.assertEqual(self.board.control_transfers, 0)
+        self.assertEqual(len(self.artemis.read(0, 2)), 8)
+        self.assertTrue(self.artemis.is_open())
+
+    def test_close_and_reopen(self):
+        self.artemis.read(0, 1)
+        reader = self.artemis.reader
+        self.artemis.close()
+        self.assertFalse(self.artemis.is_open())
+        self.assertIsNone(self.artemis.dev)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(len(self.artemis.read(0, 1)), 4)
+        self.assertTrue(self.artemis.is_open())
+
+    def test_close_while_reading(self):
+        errors = []
+        done = threading.Event()
+        def read():
+            try:
+                for i in range(20):
+                    self.artemis.read(0, 1)
+            except Exception as ex:
+                errors.append(ex)
+            done.set()
+        reader = threading.Thread(target = read)
+        reader.start()
+        while not done.is_set():
+            self.artemis.close()
+            time.sleep(0.01)
+        reader.join()
+        self.assertEqual(errors, [])
+
+    def test_interrupt_callbacks_are_kept(self):
+        called = threading.Event()
+        self.artemis.register_interrupt_callback(0, called.set)
+        self.artemis.close()
+        self.artemis.open()
+        self.fpga.interrupt(self.board.ports[0], 0x01)
+        self.assertTrue(called.wait(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_async_artemis
+
+The event loop interface of an Artemis behind a simulated FT2232H
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import unittest
+
+from support import fake, need_nysa, FTDI_VENDOR, ARTEMIS_PRODUCT
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+def need_asyncio(test):
+    if asyncio is None:
+        return unittest.skip("asyncio or trollius is not installed")(test)
+    return test
+
+
+class WriteLog(fake.Artemis):
+    """Keeps the addresses of the writes in the order they reach the FPGA"""
+
+    def __init__(self):
+        self.data = bytearray()
+        fake.Artemis.__init__(self)
+
+    def addresses(self):
+        data = self.data
+        found = []
+        for pos in range(len(data) - 8):
+            if (data[pos] == 0xCD) and (data[pos + 1] == 0x01):
+                found.append((data[pos + 5] << 24) | (data[pos + 6] << 16) |
+                             (data[pos + 7] << 8) | data[pos + 8])
+        return found
+
+    def write(self, port, data):
+        self.data.extend(data)
+        fake.Artemis.write(self, port, data)
+
+
+class BrokenCommand(object):
+    """A command whose result is an error that isn't a NysaCommError"""
+
+    def result(self, timeout):
+        raise ValueError("broken")
+
+
+@need_nysa
+@need_asyncio
+class AsyncArtemisTest(unittest.TestCase):
+
+    def setUp(self):
+        from artemis_usb2.artemis_usb2 import _Artemis
+        from artemis_usb2.async_artemis import AsyncArtemis
+        self.fpga = fake.Artemis()
+        self.board = fake.FakeFT2232H(self.fpga, fake.BitBang(),
+                                      product = ARTEMIS_PRODUCT)
+        fake.install([self.board])
+        self.artemis = _Artemis(FTDI_VENDOR, ARTEMIS_PRODUCT, lazy = True)
+        self.loop = asyncio.new_event_loop()
+        self.async = AsyncArtemis(self.artemis, loop = self.loop)
+
+    def tearDown(self):
+        self.artemis.close()
+        self.loop.close()
+
+    def test_open_does_not_block_the_loop(self):
+        ticks = []
+        def tick():
+            ticks.append(self.loop.time())
+            self.loop.call_later(0.01, tick)
+        self.loop.call_soon(tick)
+        #Opening resets the board, that takes 0.4 s
+        futures = [self.async.read(0, 1), self.async.ping(),
+                   self.async.read(1, 2)]
+        self.loop.run_until_complete(asyncio.wait(futures, loop = self.loop))
+        self.assertEqual(len(futures[0].result()), 4)
+        self.assertEqual(len(futures[2].result()), 8)
+        self.assertGreater(len(ticks), 20)
+
+    def test_commands_keep_their_order(self):
+        from array import array as Array
+        from artemis_usb2 import artemis_usb2
+        self.fpga = WriteLog()
+        self.board = fake.FakeFT2232H(self.fpga, fake.BitBang(),
+                                      product = ARTEMIS_PRODUCT)
+        fake.install([self.board])
+        #A queue with a single slot is full most of the time
+        size = artemis_usb2.MAX_WRITE_QUEUE_SIZE
+        artemis_usb2.MAX_WRITE_QUEUE_SIZE = 1
+        try:
+            self.artemis.open()
+        finally:
+            artemis_usb2.MAX_WRITE_QUEUE_SIZE = size
+        data = Array('B', [0x00] * 4)
+        futures = [self.async.write(0x100 + i, data) for i in range(50)]
+        self.loop.run_until_complete(asyncio.wait(futures, loop = self.loop))
+        self.assertEqual(self.fpga.addresses(), range(0x100, 0x100 + 50))
+
+    def test_interrupt_wakes_the_waiter(self):
+        self.artemis.open()
+        future = self.async.wait_for_interrupts(wait_time = 1)
+        self.fpga.interrupt(self.board.ports[0], 0x01)
+        self.assertTrue(self.loop.run_until_complete(future))
+        #The interrupt is kept, the next wait sees it right away
+        start = self.loop.time()
+        future = self.async.wait_for_interrupts(wait_time = 1)
+        self.assertTrue(self.loop.run_until_complete(future))
+        self.assertLess(self.loop.time() - start, 0.5)
+
+    def test_interrupt_timeout(self):
+        future = self.async.wait_for_interrupts(wait_time = 0.1)
+        self.assertFalse(self.loop.run_until_complete(future))
+
+    def test_any_error_completes_the_future(self):
+        future = asyncio.Future(loop = self.loop)
+        self.async._complete(future, BrokenCommand())
+        self.assertRaises(ValueError, future.result)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_bitbang
+
+The bitbang controller drives the board it was opened for
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import unittest
+
+from support import fake, FTDI_VENDOR, ARTEMIS_PRODUCT
+
+#The controller loads its own copy of the FTDI driver, it has to be loaded
+#before the fake devices are installed
+from artemis_usb2.bitbang.bitbang import BitBangController
+
+
+class MultiBoardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gpio = [fake.BitBang(), fake.BitBang()]
+        self.boards = [fake.FakeFT2232H(fake.Sink(), self.gpio[0],
+                                        product = ARTEMIS_PRODUCT,
+                                        serial = "A1"),
+                       fake.FakeFT2232H(fake.Sink(), self.gpio[1],
+                                        product = ARTEMIS_PRODUCT,
+                                        serial = "B2")]
+        fake.install(self.boards)
+
+    def test_reset_pulse_reaches_the_selected_board(self):
+        bbc = BitBangController(FTDI_VENDOR, ARTEMIS_PRODUCT, 2,
+                                serial = "B2")
+        bbc.set_soft_reset_to_output()
+        bbc.soft_reset_high()
+        bbc.soft_reset_low()
+        bbc.soft_reset_high()
+        bbc.set_pins_to_input()
+        self.assertEqual(len(self.gpio[0].written), 0)
+        pulse = bytearray([0x01, 0xFF, 0x00, 0x7F, 0x01, 0xFF])
+        self.assertIn(str(pulse), str(self.gpio[1].written))
+        #The other board was never switched to bitbang
+        self.assertEqual(self.boards[0].ports[1].bitmode, 0)
+        bbc.f.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_ftdi
+
+Behavior of the FTDI driver against the simulated FT2232H
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import time
+import unittest
+from array import array as Array
+
+import usb.core
+
+from support import fake, FTDI_VENDOR, FTDI_PRODUCT
+
+from artemis_usb2 import ftdi
+from artemis_usb2.ftdi import Ftdi, FtdiError, RingBuffer, AdaptiveLatency
+
+
+class PurgeTest(unittest.TestCase):
+    """Purges and resets always reach the chip"""
+
+    def setUp(self):
+        self.device = fake.FakeFT2232H(fake.Sink())
+        fake.install([self.device])
+        self.port = self.device.ports[0]
+        self.ftdi = Ftdi()
+        self.ftdi.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+
+    def tearDown(self):
+        self.ftdi.close()
+
+    def test_purge_drops_unsolicited_data(self):
+        self.ftdi.purge_buffers()
+        #Data the device sent on its own, like an Artemis interrupt
+        self.port.send(bytearray("stale"), immediate = True)
+        self.ftdi.purge_buffers()
+        self.port.send(bytearray("fresh"), immediate = True)
+        self.assertEqual(self.ftdi.read_data(5), "fresh")
+
+    def test_reopen_resets_the_chip(self):
+        self.port.send(bytearray("stale"), immediate = True)
+        self.ftdi.close()
+        self.ftdi = Ftdi()
+        self.ftdi.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+        self.port.send(bytearray("fresh"), immediate = True)
+        self.assertEqual(self.ftdi.read_data(5), "fresh")
+
+    def test_every_purge_is_sent(self):
+        before = self.device.control_transfers
+        self.ftdi.purge_buffers()
+        self.ftdi.purge_buffers()
+        self.assertEqual(self.device.control_transfers - before, 4)
+
+    def test_configuration_is_not_sent_twice(self):
+        self.ftdi.set_latency_timer(5)
+        before = self.device.control_transfers
+        self.ftdi.set_latency_timer(5)
+        self.ftdi.set_bitmode(0, Ftdi.BITMODE_BITBANG)
+        self.ftdi.set_bitmode(0, Ftdi.BITMODE_BITBANG)
+        self.assertEqual(self.device.control_transfers - before, 1)
+
+
+
+class ValidateMpsseTest(unittest.TestCase):
+    """The bad command answer is held back by the latency timer"""
+
+    def setUp(self):
+        fake.install([fake.FakeFT2232H(fake.Mpsse())])
+        self.ftdi = Ftdi()
+        self.ftdi.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+        self.ftdi.set_latency_timer(16)
+
+    def tearDown(self):
+        self.ftdi.close()
+
+    def test_bad_command(self):
+        #An empty read restarts the latency timer of the chip
+        self.ftdi.read_exact(1, time.time())
+        self.ftdi.write_data(Array('B', [0xAB]))
+        self.assertRaises(FtdiError, self.ftdi.validate_mpsse)
+
+    def test_good_command(self):
+        self.ftdi.write_data(Array('B', [0x80, 0x00, 0x00]))
+        self.ftdi.validate_mpsse()
+
+
+class WriteTest(unittest.TestCase):
+    """What is written comes back from a loopback in the same order"""
+
+    def open(self):
+        fake.install([fake.FakeFT2232H(fake.Loopback())])
+        self.ftdi = Ftdi()
+        self.ftdi.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+
+    def tearDown(self):
+        self.ftdi.close()
+
+    def loopback(self, buffers):
+        expected = "".join([str(buffer(data)) for data in buffers])
+        self.ftdi.write_datav(buffers)
+        self.assertEqual(self.ftdi.read_data(len(expected)), expected)
+
+    def test_arrays_of_any_type_are_gathered(self):
+        self.open()
+        self.loopback([Array('H', [0x0201, 0x0403]), bytearray("ab"),
+                       Array('L', [0x08070605]), Array('B', [9, 10])])
+
+    def test_write_without_pyusb_internals(self):
+        self.open()
+        manager = usb.core._ResourceManager
+        #A pyusb whose resource manager is not the one that was known
+        usb.core._ResourceManager = object
+        try:
+            self.ftdi._wrap_api()
+        finally:
+            usb.core._ResourceManager = manager
+        self.assertEqual(self.ftdi._write_slice, self.ftdi._write_slice_copy)
+        self.loopback([bytearray(range(256)) * 16, bytearray("tail")])
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_wrap_around(self):
+        ring = RingBuffer(8)
+        ring.write(bytearray("abcdef"))
+        self.assertEqual(ring.read(4).tostring(), "abcd")
+        ring.write(bytearray("ghijkl"))
+        self.assertEqual(ring.capacity, 8)
+        self.assertEqual(ring.read(8).tostring(), "efghijkl")
+
+    def test_overflow_is_an_error(self):
+        ring = RingBuffer(8)
+        ring.write(bytearray("abcdef"))
+        self.assertRaises(FtdiError, ring.write, bytearray("ghi"))
+        self.assertEqual(ring.capacity, 8)
+        self.assertEqual(ring.read(8).tostring(), "abcdef")
+
+    def test_ring_holds_the_largest_adaptive_read(self):
+        fake.install([fake.FakeFT2232H(fake.Sink())])
+        dev = Ftdi()
+        dev.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+        try:
+            dev.readbuffer.write(bytearray("kept"))
+            dev.set_adaptive_latency(AdaptiveLatency(chunk_max = 0x10000))
+            self.assertGreaterEqual(dev.readbuffer.capacity, 0x10000)
+            self.assertEqual(dev.readbuffer.read(4).tostring(), "kept")
+        finally:
+            dev.close()
+
+
+class Clock(object):
+    """Stands in for the time module, the test moves the time forward"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class AdaptiveLatencyTest(unittest.TestCase):
+    """The bulk profile is entered slowly and left right away"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time, ftdi.time = ftdi.time, self.clock
+        self.control = AdaptiveLatency(lmin = 2, lmax = 16, window = 0.25,
+                                       settle = 2, min_interval = 1.0)
+
+    def tearDown(self):
+        ftdi.time = self.time
+
+    def window(self, request, received, capacity = 16384):
+        """Reads for one window, returns the answer at the end of it"""
+        for i in range(9):
+            self.clock.now += 0.026
+            self.assertIsNone(self.control.sample(request, received, capacity))
+        self.clock.now += 0.026
+        return self.control.sample(request, received, capacity)
+
+    def bulk(self):
+        self.window(0x10000, 16384)
+        self.assertEqual(self.window(0x10000, 16384), (16, 16384))
+
+    def test_bulk_needs_settled_windows(self):
+        self.assertIsNone(self.window(0x10000, 16384))
+        self.assertEqual(self.window(0x10000, 16384), (16, 16384))
+
+    def test_small_command_leaves_bulk_right_away(self):
+        self.bulk()
+        self.assertIsNone(self.control.expect(0x10000))
+        self.assertEqual(self.control.expect(13), (2, 4096))
+        self.assertEqual(self.control.mode, AdaptiveLatency.INTERACTIVE)
+
+    def test_quiet_window_leaves_bulk_right_away(self):
+        self.bulk()
+        #No settling and no minimum interval on the way down
+        self.assertEqual(self.window(13, 16), (2, 4096))
+
+    def test_expect_response_sets_the_latency_timer(self):
+        device = fake.FakeFT2232H(fake.Sink())
+        fake.install([device])
+        dev = Ftdi()
+        dev.open(FTDI_VENDOR, FTDI_PRODUCT, 1)
+        try:
+            self.control.mode = AdaptiveLatency.BULK
+            dev.set_adaptive_latency(self.control)
+            self.assertEqual(device.ports[0].latency, 16)
+            dev.expect_response(13)
+            self.assertEqual(device.ports[0].latency, 2)
+        finally:
+            dev.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_platform
+
+Scanning for boards with ArtemisUSB2Platform
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import sys
+import time
+import unittest
+
+from support import fake, need_nysa, ARTEMIS_PRODUCT
+
+
+class SlowBitBang(fake.BitBang):
+    """The first write takes 'delay' seconds, like a board that hangs"""
+
+    def __init__(self, delay):
+        fake.BitBang.__init__(self)
+        self.delay = delay
+
+    def write(self, port, data):
+        delay, self.delay = self.delay, 0
+        time.sleep(delay)
+        fake.BitBang.write(self, port, data)
+
+
+def board(serial, gpio = None):
+    if gpio is None:
+        gpio = fake.BitBang()
+    return fake.FakeFT2232H(fake.Artemis(), gpio, product = ARTEMIS_PRODUCT,
+                            serial = serial)
+
+
+@need_nysa
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        from artemis_usb2 import nysa_platform
+        self.artemis = sys.modules["artemis_usb2.artemis_usb2"]
+        self.artemis._artemis_instances.clear()
+        self.platform = nysa_platform.ArtemisUSB2Platform()
+
+    def tearDown(self):
+        for device in self.artemis._artemis_instances.values():
+            device.close()
+        self.artemis._artemis_instances.clear()
+
+    def test_timed_out_board_is_closed(self):
+        fake.install([board("A1"), board("B2", SlowBitBang(2.0))])
+        boards = self.platform.scan(lazy = False, timeout = 1.0)
+        self.assertEqual(sorted(boards), ["A1"])
+        self.assertEqual(sorted(self.platform.scan_errors), ["B2"])
+        #A reset takes 0.4 s. The board opens after the scan gave up on it and is closed then
+        deadline = time.time() + 8
+        while "B2" not in self.artemis._artemis_instances:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        late = self.artemis._artemis_instances["B2"]
+        while late.is_open() or late.dev is not None:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_lazy_scan_opens_nothing(self):
+        fake.install([board("A1"), board("B2")])
+        boards = self.platform.scan()
+        self.assertEqual(sorted(boards), ["A1", "B2"])
+        for device in boards.values():
+            self.assertFalse(device.is_open())
+            self.assertIsNotNone(device.location)
+
+
+if __name__ == "__main__":
+    unittest.main()
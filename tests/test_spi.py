@@ -0,0 +1,67 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_spi
+
+The SPI controller against the MPSSE engine of a simulated FT2232H
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import unittest
+
+from support import fake, FTDI_VENDOR, FTDI_PRODUCT
+
+from artemis_usb2.spi import SpiController, SpiIOError
+
+
+class MuteMpsse(fake.Mpsse):
+    """Doesn't answer at all while 'mute' is set"""
+
+    mute = False
+
+    def write(self, port, data):
+        if not self.mute:
+            fake.Mpsse.write(self, port, data)
+
+
+class ExchangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpsse = MuteMpsse()
+        fake.install([fake.FakeFT2232H(self.mpsse)])
+        self.spi = SpiController()
+        self.spi.configure(FTDI_VENDOR, FTDI_PRODUCT, 1)
+        self.port = self.spi.get_port(0)
+
+    def tearDown(self):
+        self.spi.terminate()
+
+    def test_exchange(self):
+        self.assertEqual(self.port.exchange([0x9F], 3).tolist(),
+                         [0xFF, 0xFF, 0xFF])
+
+    def test_timeout_is_an_error(self):
+        self.spi._ftdi.usb_read_timeout = 100
+        self.mpsse.mute = True
+        self.assertRaises(SpiIOError, self.port.exchange, [0x9F], 3)
+        self.mpsse.mute = False
+        self.assertEqual(len(self.port.exchange([0x9F], 3)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_usbasync
+
+Completion and flush of the AsyncBulkReader transfers, libusb is replaced
+by a mock that completes the transfers when the test says so
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import time
+import threading
+import collections
+import unittest
+from ctypes import pointer, memmove
+
+import support    #puts the package on the path
+
+from artemis_usb2 import usbasync
+libusb1 = usbasync.libusb1
+
+LIBUSB_ERROR_NOT_FOUND = -5
+
+
+class MockLib(object):
+    """
+    The functions of libusb the reader uses. Submitted transfers wait for
+    'complete', cancelled transfers are completed from the event thread
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        #Transfers submitted and not completed yet, oldest first
+        self.in_flight = []
+        #Transfers that completed, handed to the reader by handle_events
+        self.completed = collections.deque()
+        self.submits = 0
+        #Transfer in flight that holds data already and the data
+        self.holding = None
+        #Cancelled transfers don't complete
+        self.stuck = False
+        for name in ("libusb_alloc_transfer", "libusb_free_transfer",
+                     "libusb_submit_transfer", "libusb_cancel_transfer",
+                     "libusb_handle_events_timeout", "libusb_exit"):
+            setattr(self, name, self.function(getattr(self, "_" + name[7:])))
+
+    def function(self, method):
+        #ctypes functions get argtypes and restype set, methods can't
+        def call(*args):
+            return method(*args)
+        return call
+
+    def _alloc_transfer(self, iso_packets):
+        return pointer(libusb1._libusb_transfer())
+
+    def _free_transfer(self, transfer):
+        pass
+
+    def _exit(self, ctx):
+        pass
+
+    def _submit_transfer(self, transfer):
+        with self.cond:
+            self.in_flight.append(transfer)
+            self.submits += 1
+        return 0
+
+    def _cancel_transfer(self, transfer):
+        with self.cond:
+            for pending in self.in_flight:
+                if pending.contents.buffer == transfer.contents.buffer:
+                    break
+            else:
+                return LIBUSB_ERROR_NOT_FOUND
+            if self.stuck:
+                return 0
+            if (self.holding is not None) and (self.holding[0] is pending):
+                #Completed before the cancel got to it
+                self.finish(pending, libusb1.LIBUSB_TRANSFER_COMPLETED, "")
+            else:
+                self.finish(pending, libusb1.LIBUSB_TRANSFER_CANCELLED, "")
+        return 0
+
+    def _handle_events_timeout(self, ctx, tv):
+        with self.cond:
+            if not self.completed:
+                self.cond.wait(0.01)
+            completed = list(self.completed)
+            self.completed.clear()
+        for transfer in completed:
+            transfer.contents.callback(transfer)
+        return 0
+
+    def finish(self, transfer, status, data):
+        #Call with the condition held
+        if (self.holding is not None) and (self.holding[0] is transfer):
+            data = self.holding[1] + data
+            self.holding = None
+        self.in_flight.remove(transfer)
+        contents = transfer.contents
+        memmove(contents.buffer, data, len(data))
+        contents.actual_length = len(data)
+        contents.status = status
+        self.completed.append(transfer)
+        self.cond.notify_all()
+
+    def hold(self, data):
+        """The oldest transfer in flight receives 'data' but doesn't
+           complete yet"""
+        with self.cond:
+            self.holding = (self.in_flight[0], data)
+
+    def complete(self, data):
+        """Complete the oldest transfer in flight with 'data'"""
+        with self.cond:
+            self.finish(self.in_flight[0], libusb1.LIBUSB_TRANSFER_COMPLETED,
+                        data)
+
+
+class MockHandle(object):
+    handle = None
+
+
+class MockResources(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def managed_open(self):
+        return MockHandle()
+
+
+class MockDevice(object):
+
+    def __init__(self, lib):
+        backend = libusb1._LibUSB.__new__(libusb1._LibUSB)
+        backend.lib = lib
+        backend.ctx = None
+        self._ctx = MockResources(backend)
+
+
+@unittest.skipIf(libusb1 is None, "pyusb has no libusb 1.0 backend")
+class AsyncBulkReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = MockLib()
+        self.reader = usbasync.AsyncBulkReader(MockDevice(self.lib), 0x81,
+                                               512, 4, 1000)
+        self.reader.start()
+
+    def tearDown(self):
+        self.reader.stop()
+
+    def test_reads_come_in_order(self):
+        self.lib.complete("\x32\x60first")
+        self.lib.complete("\x32\x60second")
+        self.assertEqual(self.reader.read(1000).tostring(), "\x32\x60first")
+        self.assertEqual(self.reader.read(1000).tostring(), "\x32\x60second")
+
+    def test_transfers_are_submitted_again(self):
+        for i in range(10):
+            self.lib.complete("\x32\x60data")
+            self.reader.read(1000)
+        self.assertEqual(self.lib.submits, 14)
+        self.assertEqual(len(self.lib.in_flight), 4)
+
+    def test_flush_drops_transfers_in_flight(self):
+        self.lib.complete("\x32\x60queued")
+        #A transfer that got data from before the purge and didn't complete
+        self.lib.hold("\x32\x60in flight")
+        time.sleep(0.05)
+        self.reader.flush()
+        self.assertEqual(len(self.lib.in_flight), 4)
+        self.lib.complete("\x32\x60fresh")
+        self.assertEqual(self.reader.read(1000).tostring(), "\x32\x60fresh")
+
+    def test_read_wakes_up_right_away(self):
+        def complete():
+            #Long enough for a reader that polls to sleep 50 ms at a time
+            time.sleep(0.3)
+            self.lib.complete("\x32\x60late")
+            completed.append(time.time())
+        completed = []
+        thread = threading.Thread(target = complete)
+        thread.start()
+        self.assertEqual(self.reader.read(1000).tostring(), "\x32\x60late")
+        woken = time.time()
+        thread.join()
+        self.assertLess(woken - completed[0], 0.01)
+
+    def test_flush_timeout(self):
+        self.reader.FLUSH_TIMEOUT = 100
+        self.lib.stuck = True
+        try:
+            self.assertRaises(usbasync.usb.core.USBError, self.reader.flush)
+            self.assertRaises(usbasync.usb.core.USBError, self.reader.read, 10)
+        finally:
+            self.lib.stuck = False
+
+    def test_unknown_pyusb_is_not_used(self):
+        version = usbasync.usb.version_info
+        usbasync.usb.version_info = (0, 4, 0)
+        try:
+            self.assertRaises(NotImplementedError, usbasync.AsyncBulkReader,
+                              MockDevice(MockLib()), 0x81, 512, 4, 1000)
+        finally:
+            usbasync.usb.version_info = version
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (c) 2013 Dave McCoy (dave.mccoy@cospandesign.com)
+
+# This file is part of Nysa (wiki.cospandesign.com/index.php?title=Nysa).
+#
+# Nysa is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# any later version.
+#
+# Nysa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nysa; If not, see <http://www.gnu.org/licenses/>.
+
+""" test_usbtools
+
+String descriptor cache of UsbTools against simulated FT2232Hs
+"""
+
+__author__ = 'dave.mccoy@cospandesign.com (Dave McCoy)'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from support import fake, FTDI_VENDOR, FTDI_PRODUCT
+
+from artemis_usb2.usbtools import UsbTools
+
+
+VPS = [(FTDI_VENDOR, FTDI_PRODUCT)]
+
+
+class StringStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "strings.json")
+        self.new_process()
+
+    def tearDown(self):
+        self.new_process()
+        UsbTools.set_string_store(None)
+        shutil.rmtree(self.dir)
+
+    def new_process(self):
+        """Forget what was read, like a process that starts over"""
+        UsbTools.STRINGS.clear()
+        UsbTools.STRINGS_VERIFIED.clear()
+        UsbTools.STRINGS_DIRTY = False
+
+    def serials(self, devices):
+        fake.install(devices)
+        UsbTools.set_string_store(self.path)
+        return sorted([device[2] for device in UsbTools.find_all(VPS)])
+
+    def test_strings_are_read_once(self):
+        device = fake.FakeFT2232H(fake.Sink(), serial = "A1")
+        self.assertEqual(self.serials([device]), ["A1"])
+        before = device.control_transfers
+        self.assertEqual(self.serials([device]), ["A1"])
+        self.assertEqual(device.control_transfers, before)
+
+    def test_store_saves_the_reads(self):
+        device = fake.FakeFT2232H(fake.Sink(), serial = "A1")
+        self.assertEqual(self.serials([device]), ["A1"])
+        self.new_process()
+        before = device.control_transfers
+        self.assertEqual(self.serials([device]), ["A1"])
+        #Only the serial number is read again: the language IDs and the string
+        self.assertEqual(device.control_transfers - before, 2)
+
+    def test_swapped_boards_are_read_again(self):
+        first = fake.FakeFT2232H(fake.Sink(), serial = "A1")
+        self.assertEqual(self.serials([first]), ["A1"])
+        #After a reboot another board of the same kind is at the same
+        #location and got the same address
+        self.new_process()
+        second = fake.FakeFT2232H(fake.Sink(), serial = "B2")
+        second.address = first.address
+        self.assertEqual(self.serials([second]), ["B2"])
+
+    def test_failed_save_is_reported(self):
+        device = fake.FakeFT2232H(fake.Sink(), serial = "A1")
+        fake.install([device])
+        UsbTools.set_string_store(os.path.join(self.dir, "missing", "x.json"))
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            UsbTools.find_all(VPS)
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("Unable to save the USB strings", errors)
+
+
+if __name__ == "__main__":
+    unittest.main()